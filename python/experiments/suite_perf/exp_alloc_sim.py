@@ -0,0 +1,108 @@
+"""
+Replay a mixed circuit size trace through each of the QPM allocation
+policies and report utilization, queue wait and fragmentation.
+
+The simulation mirrors how the QPM schedules: circuits are started in
+arrival order and a circuit which doesn't fit blocks the ones behind it
+until enough slots are released. Since every policy may spread a
+circuit over several hosts, placement shows up as communication cost:
+each extra host a circuit spans slows it down by HOST_PENALTY and
+spanning racks by RACK_PENALTY.
+"""
+
+import yaml, os, random, heapq
+from statistics import mean
+from util.qpm.util_allocator import ALLOC_POLICIES, make_allocator
+from defw_exception import DEFwOutOfResources
+
+NUM_HOSTS = 16
+PPN = 8
+HOST_GROUPS = {'rack0': [f'node{i:02d}' for i in range(0, 8)],
+			   'rack1': [f'node{i:02d}' for i in range(8, 16)]}
+NUM_CIRCUITS = int(os.environ.get('QFW_BENCH_NUM_CIRCUITS', 5000))
+# np: probability
+NP_MIX = {1: 0.40, 2: 0.20, 4: 0.15, 8: 0.15, 16: 0.07, 32: 0.03}
+MEAN_RUNTIME = 10.0
+TARGET_LOAD = 0.7
+HOST_PENALTY = 0.05
+RACK_PENALTY = 0.25
+SEED = 42
+
+def make_trace(num_circuits=NUM_CIRCUITS, seed=SEED):
+	rnd = random.Random(seed)
+	sizes = list(NP_MIX.keys())
+	weights = list(NP_MIX.values())
+	mean_np = sum(n * w for n, w in NP_MIX.items())
+	# arrival rate which keeps the slots TARGET_LOAD busy on average
+	rate = TARGET_LOAD * NUM_HOSTS * PPN / (mean_np * MEAN_RUNTIME)
+	trace = []
+	t = 0.0
+	for i in range(num_circuits):
+		t += rnd.expovariate(rate)
+		trace.append((t, rnd.choices(sizes, weights)[0],
+					  rnd.expovariate(1 / MEAN_RUNTIME)))
+	return trace
+
+def simulate(policy, trace):
+	free_hosts = {f'node{i:02d}': PPN for i in range(NUM_HOSTS)}
+	allocator = make_allocator(free_hosts, PPN, policy=policy,
+							   groups=HOST_GROUPS)
+	total_slots = NUM_HOSTS * PPN
+	running = []
+	queue = []
+	waits = []
+	frag = []
+	spanning = 0
+	busy = 0.0
+	now = 0.0
+	group_of = {h: g for g, hosts in HOST_GROUPS.items() for h in hosts}
+
+	def start_queued(now):
+		nonlocal spanning, busy
+		while queue:
+			arrival, np, runtime = queue[0]
+			try:
+				alloc = allocator.allocate(np)
+			except DEFwOutOfResources:
+				break
+			queue.pop(0)
+			waits.append(now - arrival)
+			frag.append(allocator.fragmentation())
+			runtime *= 1 + HOST_PENALTY * (len(alloc) - 1)
+			if len(set(group_of[h] for h in alloc)) > 1:
+				spanning += 1
+				runtime *= 1 + RACK_PENALTY
+			busy += np * runtime
+			heapq.heappush(running, (now + runtime, id(alloc), alloc))
+
+	for arrival, np, runtime in trace:
+		while running and running[0][0] <= arrival:
+			now, _, alloc = heapq.heappop(running)
+			allocator.release(alloc)
+			start_queued(now)
+		now = arrival
+		queue.append((arrival, np, runtime))
+		start_queued(now)
+	while running:
+		now, _, alloc = heapq.heappop(running)
+		allocator.release(alloc)
+		start_queued(now)
+
+	waits.sort()
+	# utilization includes the time lost to the placement penalties
+	return {'policy': policy,
+			'makespan_sec': round(now, 1),
+			'utilization': round(busy / (total_slots * now), 3),
+			'mean_wait_sec': round(mean(waits), 2),
+			'p95_wait_sec': round(waits[int(len(waits) * 0.95)], 2),
+			'mean_fragmentation': round(mean(frag), 3),
+			'cross_rack_allocations': spanning}
+
+def run():
+	trace = make_trace()
+	results = [simulate(policy, trace) for policy in ALLOC_POLICIES]
+	print(yaml.dump(results, sort_keys=False))
+	return results
+
+if __name__ == '__main__':
+	run()
@@ -0,0 +1,44 @@
+"""
+Measure how many processes per second the launcher can start.
+
+Compares the posix_spawn launch path with the subprocess.Popen one.
+Every launch runs /bin/true with a small environment override, so the
+cost measured is dominated by process creation and environment setup.
+"""
+
+import yaml, time, os
+import svc_launcher
+import svc_launcher.svc_launcher as launcher_mod
+
+NUM_LAUNCHES = int(os.environ.get('QFW_BENCH_NUM_LAUNCHES', 2000))
+LAUNCH_CMD = '/bin/true'
+SPAWN_METHODS = ['posix_spawn', 'popen']
+
+def measure(method, num_launches=NUM_LAUNCHES):
+	saved = launcher_mod.SPAWN_METHOD
+	launcher_mod.SPAWN_METHOD = method
+	launcher = svc_launcher.Launcher()
+	try:
+		env = {'QFW_BENCH_ENV': '1'}
+		start = time.perf_counter()
+		pids = [launcher.launch(LAUNCH_CMD, env=env) for i in range(num_launches)]
+		elapsed = time.perf_counter() - start
+		pending = set(pids)
+		while pending:
+			for pid in launcher.wait_completed(pending, timeout=5):
+				pending.discard(pid)
+		total = time.perf_counter() - start
+	finally:
+		launcher.shutdown()
+		launcher_mod.SPAWN_METHOD = saved
+	return {'method': method, 'launches': num_launches,
+			'launches_per_sec': round(num_launches / elapsed, 1),
+			'completed_per_sec': round(num_launches / total, 1)}
+
+def run():
+	results = [measure(m) for m in SPAWN_METHODS]
+	print(yaml.dump(results, sort_keys=False))
+	return results
+
+if __name__ == '__main__':
+	run()
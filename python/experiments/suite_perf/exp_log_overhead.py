@@ -0,0 +1,53 @@
+"""
+Measure the logging overhead added to every RPC at each log level.
+
+Each iteration goes through the same work request/event construction
+and logging calls an RPC goes through on the send and receive paths,
+without putting anything on the wire.
+"""
+
+import yaml, time, logging
+import defw_common_def as common
+from defw_common_def import populate_rpc_req, set_logging_level
+from defw_workers import WorkerRequest, WorkerEvent
+from defw import me
+
+NUM_RPCS = 2000
+LOG_LEVELS = ['critical', 'error', 'debug']
+
+def rpc_iteration(rpc_str):
+	rpc = populate_rpc_req(me.my_endpoint(), me.my_endpoint(), 'method_call',
+						   'exp_log_overhead', 'Bench', 'noop', 'bench-id')
+	wr = WorkerRequest(WorkerRequest.WR_SEND_MSG,
+					   remote_uuid=me.my_uuid(), blk_uuid=me.my_uuid(),
+					   msg=rpc, blocking=False)
+	we = WorkerEvent(WorkerEvent.EVENT_INCOMING_RESPONSE,
+					 uuid=wr.get_uuid(), msg=rpc_str)
+	logging.debug("handling response %s", we.msg_yaml)
+	logging.debug("Time taken in %s is %s", 'noop', 0)
+
+def measure(level, num_rpcs=NUM_RPCS):
+	rpc = populate_rpc_req(me.my_endpoint(), me.my_endpoint(), 'method_call',
+						   'exp_log_overhead', 'Bench', 'noop', 'bench-id')
+	rpc_str = yaml.dump(rpc)
+	set_logging_level(level, save=False)
+	start = time.perf_counter()
+	for i in range(num_rpcs):
+		rpc_iteration(rpc_str)
+	elapsed = time.perf_counter() - start
+	return {'level': level, 'rpcs': num_rpcs,
+			'usec_per_rpc': round(elapsed * 1e6 / num_rpcs, 2)}
+
+def run():
+	saved_level = common.global_pref['loglevel']
+	results = []
+	try:
+		for level in LOG_LEVELS:
+			results.append(measure(level))
+	finally:
+		set_logging_level(saved_level, save=False)
+	print(yaml.dump(results, sort_keys=False))
+	return results
+
+if __name__ == '__main__':
+	run()
@@ -0,0 +1,66 @@
+"""
+Measure the throughput of the streaming QASM analyzer on generated
+circuits.
+
+Circuits mix single qubit rotations with CX gates between neighbouring
+or random qubits. Each is analyzed from memory and, for the largest, from
+a file, to show the analyzer keeps up with large QASM without holding a
+parsed representation of it.
+"""
+
+import yaml, time, os, random, tempfile
+
+NUM_QUBITS = int(os.environ.get('QFW_BENCH_NUM_QUBITS', 32))
+GATE_COUNTS = [int(g) for g in
+			   os.environ.get('QFW_BENCH_GATE_COUNTS', '1000,100000,1000000').split(',')]
+
+def generate_qasm(num_qubits, num_gates, local=True, seed=0):
+	rng = random.Random(seed)
+	lines = ['OPENQASM 2.0;', 'include "qelib1.inc";',
+			 f'qreg q[{num_qubits}];', f'creg c[{num_qubits}];']
+	for i in range(num_gates):
+		if rng.random() < 0.5:
+			lines.append(f'rz({rng.random():.6f}) q[{rng.randrange(num_qubits)}];')
+			continue
+		a = rng.randrange(num_qubits - 1)
+		b = a + 1 if local else rng.randrange(a + 1, num_qubits)
+		lines.append(f'cx q[{a}],q[{b}];')
+	lines.append('measure q -> c;')
+	return '\n'.join(lines) + '\n'
+
+def measure(num_gates, local, from_file=False):
+	from util.qpm.util_qasm import analyze_qasm, analyze_qasm_file, CostModel
+	qasm = generate_qasm(NUM_QUBITS, num_gates, local)
+	path = None
+	if from_file:
+		fd, path = tempfile.mkstemp(suffix='.qasm')
+		with os.fdopen(fd, 'w') as f:
+			f.write(qasm)
+	start = time.perf_counter()
+	if path:
+		analyzer = analyze_qasm_file(path)
+		os.remove(path)
+	else:
+		analyzer = analyze_qasm(qasm)
+	elapsed = time.perf_counter() - start
+	plan = CostModel(10, 64).plan(analyzer)
+	return {'gates': num_gates, 'local': local, 'from_file': from_file,
+			'mbytes': round(len(qasm) / 1e6, 2),
+			'seconds': round(elapsed, 4),
+			'mbytes_per_sec': round(len(qasm) / 1e6 / elapsed, 1),
+			'gates_per_sec': round(num_gates / elapsed),
+			'depth': max(analyzer.depth),
+			'np': plan['np'],
+			'backend': plan['recommended_backend']}
+
+def run():
+	results = []
+	for g in GATE_COUNTS:
+		for local in [True, False]:
+			results.append(measure(g, local))
+	results.append(measure(GATE_COUNTS[-1], True, from_file=True))
+	print(yaml.dump(results, sort_keys=False))
+	return results
+
+if __name__ == '__main__':
+	run()
@@ -0,0 +1,70 @@
+"""
+Compare submitting circuits one RPC at a time with the QPM batch API.
+
+Needs a running resource manager and QPM service. Submits the same
+parameterized circuit NUM_CIRCUITS times, first with one async_run() RPC
+per circuit followed by wait_cq() for each, then with a single
+async_run_batch() followed by read_cq_batch().
+"""
+
+import yaml, time, os
+from defw_app_util import defw_get_resource_mgr, defw_reserve_service_by_name
+
+NUM_CIRCUITS = int(os.environ.get('QFW_BENCH_NUM_CIRCUITS', 1000))
+NUM_QUBITS = 4
+NUM_SHOTS = 100
+
+QASM = """OPENQASM 2.0;
+include "qelib1.inc";
+qreg q[4];
+creg c[4];
+rx({theta}) q[0];
+cx q[0],q[1];
+cx q[1],q[2];
+cx q[2],q[3];
+measure q -> c;
+"""
+
+def make_infos(num_circuits):
+	return [{'qasm': QASM.format(theta=i / num_circuits),
+			 'num_qubits': NUM_QUBITS, 'num_shots': NUM_SHOTS,
+			 'compiler': 'staq'} for i in range(num_circuits)]
+
+def measure_single(qpm, num_circuits=NUM_CIRCUITS):
+	infos = make_infos(num_circuits)
+	start = time.perf_counter()
+	cids = [qpm.async_run(info) for info in infos]
+	submit = time.perf_counter() - start
+	for cid in cids:
+		qpm.wait_cq(cid)
+	total = time.perf_counter() - start
+	return {'mode': 'per_circuit', 'circuits': num_circuits,
+			'submit_sec': round(submit, 3), 'total_sec': round(total, 3),
+			'rpcs': 2 * num_circuits}
+
+def measure_batch(qpm, num_circuits=NUM_CIRCUITS):
+	infos = make_infos(num_circuits)
+	start = time.perf_counter()
+	cids = qpm.async_run_batch(infos)
+	submit = time.perf_counter() - start
+	rpcs = 1
+	pending = cids
+	while pending:
+		done = qpm.read_cq_batch(pending, timeout=30)
+		rpcs += 1
+		done = set(r['cid'] for r in done)
+		pending = [cid for cid in pending if cid not in done]
+	total = time.perf_counter() - start
+	return {'mode': 'batch', 'circuits': num_circuits,
+			'submit_sec': round(submit, 3), 'total_sec': round(total, 3),
+			'rpcs': rpcs}
+
+def run():
+	resmgr = defw_get_resource_mgr()
+	qpm = defw_reserve_service_by_name(resmgr, 'QPM')[0]
+	results = [measure_single(qpm), measure_batch(qpm)]
+	print(yaml.dump(results, sort_keys=False))
+	return results
+
+if __name__ == '__main__':
+	run()
@@ -0,0 +1,57 @@
+"""
+Measure the CPU used by a QRC runner while it waits for many concurrent
+circuits to complete.
+
+The runner polls the launcher every millisecond for all its active
+tasks. This compares polling every pid through Launcher.status(), which
+raises DEFwInProgress for every running task, with a single
+Launcher.poll_completed() call per pass.
+"""
+
+import yaml, time, os
+import svc_launcher
+from defw_exception import DEFwInProgress
+
+NUM_CIRCUITS = int(os.environ.get('QFW_BENCH_NUM_CIRCUITS', 1000))
+CIRCUIT_CMD = 'sleep 2'
+POLL_INTERVAL = 0.001
+
+def wait_status(launcher, pids):
+	pending = set(pids)
+	while pending:
+		for pid in list(pending):
+			try:
+				launcher.status(pid)
+			except DEFwInProgress:
+				continue
+			pending.remove(pid)
+		time.sleep(POLL_INTERVAL)
+
+def wait_poll_completed(launcher, pids):
+	pending = set(pids)
+	while pending:
+		for pid in launcher.poll_completed(pending):
+			pending.remove(pid)
+		time.sleep(POLL_INTERVAL)
+
+def measure(name, wait_fn, num_circuits=NUM_CIRCUITS):
+	launcher = svc_launcher.Launcher()
+	pids = [launcher.launch(CIRCUIT_CMD) for i in range(num_circuits)]
+	wall = time.perf_counter()
+	cpu = time.process_time()
+	wait_fn(launcher, pids)
+	cpu = time.process_time() - cpu
+	wall = time.perf_counter() - wall
+	launcher.shutdown()
+	return {'mode': name, 'circuits': num_circuits,
+			'wall_sec': round(wall, 3), 'cpu_sec': round(cpu, 3),
+			'cpu_util': round(cpu / wall, 3)}
+
+def run():
+	results = [measure('status', wait_status),
+			   measure('poll_completed', wait_poll_completed)]
+	print(yaml.dump(results, sort_keys=False))
+	return results
+
+if __name__ == '__main__':
+	run()
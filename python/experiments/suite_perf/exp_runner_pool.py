@@ -0,0 +1,76 @@
+"""
+Compare running small circuits through a one shot launch per circuit
+with running them on the warm QRC runner pool.
+
+Both modes run exp_runner_pool_backend.py. In one shot mode it is launched
+once per circuit, paying the interpreter startup and the backend setup
+every time, while the pool workers load it once.
+"""
+
+import yaml, time, os, threading
+
+NUM_CIRCUITS = int(os.environ.get('QFW_BENCH_NUM_CIRCUITS', 200))
+POOL_SIZE = int(os.environ.get('QFW_BENCH_POOL_SIZE', 4))
+
+BACKEND = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+					   'exp_runner_pool_backend.py')
+
+def measure_one_shot(num_circuits=NUM_CIRCUITS):
+	import svc_launcher
+	from util.qpm.util_runner_pool import get_pool_python
+	launcher = svc_launcher.Launcher()
+	cmd = f'{get_pool_python()} {BACKEND}'
+	start = time.perf_counter()
+	pending = set()
+	for i in range(num_circuits):
+		while len(pending) >= POOL_SIZE:
+			for pid in launcher.wait_completed(pending, timeout=5):
+				pending.discard(pid)
+		pending.add(launcher.launch(cmd))
+	while pending:
+		for pid in launcher.wait_completed(pending, timeout=5):
+			pending.discard(pid)
+	elapsed = time.perf_counter() - start
+	launcher.shutdown()
+	return {'mode': 'one_shot', 'circuits': num_circuits,
+			'circuits_per_sec': round(num_circuits / elapsed, 1)}
+
+def measure_pool(num_circuits=NUM_CIRCUITS):
+	from util.qpm.util_runner_pool import RunnerPool
+	from defw_exception import DEFwOutOfResources
+	pool = RunnerPool(BACKEND, POOL_SIZE)
+	cond = threading.Condition()
+	completed = []
+	def notify(tid):
+		with cond:
+			completed.append(tid)
+			cond.notify()
+	# don't count the pool startup
+	while pool.get_stats()['workers'] and \
+		  any(w['state'] == 0 for w in pool.get_stats()['workers'].values()):
+		time.sleep(0.01)
+	start = time.perf_counter()
+	submitted = 0
+	while submitted < num_circuits:
+		try:
+			pool.submit('bench.qasm', {'num_qubits': 4, 'num_shots': 100},
+						completion_cb=notify)
+			submitted += 1
+		except DEFwOutOfResources:
+			with cond:
+				done = len(completed)
+				cond.wait_for(lambda: len(completed) > done, timeout=1)
+	with cond:
+		cond.wait_for(lambda: len(completed) == num_circuits, timeout=60)
+	elapsed = time.perf_counter() - start
+	pool.shutdown()
+	return {'mode': 'pool', 'circuits': num_circuits,
+			'circuits_per_sec': round(num_circuits / elapsed, 1)}
+
+def run():
+	results = [measure_one_shot(), measure_pool()]
+	print(yaml.dump(results, sort_keys=False))
+	return results
+
+if __name__ == '__main__':
+	run()
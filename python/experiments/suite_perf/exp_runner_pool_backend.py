@@ -0,0 +1,26 @@
+"""
+QRC runner pool backend used by exp_runner_pool.py.
+
+setup() stands in for loading the simulator libraries, taking
+QFW_BENCH_BACKEND_SETUP seconds, and run() for simulating a small
+circuit. Run without a circuit, as a script or from the suite, it does
+both once, the way a one shot launch would.
+"""
+
+import os, time
+
+SETUP_TIME = float(os.environ.get('QFW_BENCH_BACKEND_SETUP', 0.2))
+
+BENCH_CIRCUIT = {'num_qubits': 4, 'num_shots': 100}
+
+def setup():
+	time.sleep(SETUP_TIME)
+
+def run(qasm_file=None, info=None):
+	if info is None:
+		setup()
+		info = BENCH_CIRCUIT
+	return {'0' * info['num_qubits']: info['num_shots']}
+
+if __name__ == '__main__':
+	run()
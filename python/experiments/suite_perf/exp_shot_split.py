@@ -0,0 +1,77 @@
+"""
+Compare the time to result of a circuit with many shots run as a single
+process with the same circuit split into shards by the QPM.
+
+The QRC used runs a shell command which sleeps for a time proportional
+to the number of shots and prints them as the count of a single
+outcome, so the time measured is the QPM scheduling and the parallelism
+gained by splitting, not the simulator.
+"""
+
+import yaml, time, os, socket, tempfile
+
+NUM_SLOTS = int(os.environ.get('QFW_BENCH_NUM_SLOTS', 8))
+NUM_SHOTS = int(os.environ.get('QFW_BENCH_NUM_SHOTS', 100000))
+SECONDS_PER_SHOT = float(os.environ.get('QFW_BENCH_SECONDS_PER_SHOT', 0.00002))
+MIN_SHOTS = [0, 50000, 25000, 12500]
+
+os.environ.setdefault('QFW_QPM_ASSIGNED_HOSTS', f'{socket.gethostname()}:{NUM_SLOTS}')
+os.environ.setdefault('QFW_DVM_URI_PATH', '/dev/null')
+
+QASM = """OPENQASM 2.0;
+include "qelib1.inc";
+qreg q[2];
+creg c[2];
+h q[0];
+cx q[0],q[1];
+measure q -> c;
+"""
+
+# sleep $1 seconds then print $2
+SLEEP_SCRIPT = 'sleep $1\necho $2\n'
+
+def make_qpm(script):
+	from util.qpm import util_qpm
+	from util.qpm.util_qrc import UTIL_QRC
+
+	class SleepQRC(UTIL_QRC):
+		# the counts don't depend on sampling, so any seed will do
+		SEED_SUPPORT = True
+
+		def form_cmd(self, circ, qasm_file):
+			shots = circ.info['num_shots']
+			return f"/bin/sh {script} {shots * SECONDS_PER_SHOT} {shots}"
+
+		def parse_result(self, out):
+			return {'11': int(out.decode().strip())}
+
+	util_qpm.qpm_initialized = True
+	return util_qpm.UTIL_QPM(SleepQRC(num_workers=NUM_SLOTS))
+
+def measure(qpm, min_shots):
+	from util.qpm import util_shots
+	util_shots.SHOT_SPLIT_MIN = min_shots
+	start = time.perf_counter()
+	cid = qpm.async_run({'qasm': QASM, 'num_qubits': 2, 'num_shots': NUM_SHOTS})
+	r = qpm.wait_cq(cid, timeout=600)
+	elapsed = time.perf_counter() - start
+	assert r['rc'] == 0 and r['result']['11'] == NUM_SHOTS
+	return {'min_shots_per_shard': min_shots,
+			'shards': r.get('shards', 1),
+			'seconds': round(elapsed, 3)}
+
+def run():
+	fd, script = tempfile.mkstemp(suffix='.sh')
+	with os.fdopen(fd, 'w') as f:
+		f.write(SLEEP_SCRIPT)
+	qpm = make_qpm(script)
+	try:
+		results = [measure(qpm, m) for m in MIN_SHOTS]
+	finally:
+		qpm.shutdown()
+		os.remove(script)
+	print(yaml.dump(results, sort_keys=False))
+	return results
+
+if __name__ == '__main__':
+	run()
@@ -2,6 +2,7 @@ from pathlib import Path
 from cdefw_agent import *
 from defw_common_def import *
 import defw_common_def as common
+from defw_common_def import dump_log_ring
 from defw_exception import DEFwError, DEFwDumper, DEFwCommError, DEFwNotFound
 from defw_cmd import defw_exec_local_cmd
 import importlib, socket
@@ -1334,8 +1335,8 @@ def connect_to_services(endpoints):
 		active_service_agents.connect(ep)
 		logging.debug(f"Connection request finished: {ep}")
 
-def connect_to_resource(service_infos, res_name):
-	ep = resmgr.reserve(me.my_endpoint(), service_infos)
+def connect_to_resource(service_infos, res_name, *args, **kwargs):
+	ep = resmgr.reserve(me.my_endpoint(), service_infos, *args, **kwargs)
 	connect_to_services(ep)
 	apis = []
 	for service_info in service_infos:
@@ -1433,6 +1434,7 @@ if not cdefw_global.get_defw_initialized():
 
 	def sigkill_handler(signum, frame):
 		logging.critical("DEFw received a SIGKILL")
+		dump_log_ring()
 		me.exit()
 
 	signal.signal(signal.SIGABRT, sigkill_handler)
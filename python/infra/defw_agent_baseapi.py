@@ -28,18 +28,18 @@ class BaseAgentAPI(BaseRemote):
 		return svcs
 
 	'''
-	reserve the svc passed in from the agent described by info
+	reserve the svc passed in from the agent described by info. Service
+	classes implement reserve() as a classmethod, so reserving doesn't
+	create an instance of the service.
 	'''
 	def reserve(self, svc_info, client_ep, *args, **kwargs):
 		from defw import services
 		class_name = svc_info.get_class_name()
 		mod_name = svc_info.get_module_name()
-		if mod_name in services:
-			mod = services[mod_name]
-			for c in mod.service_classes:
-				if class_name == c.__class__.__name__:
-					obj = c()
-					return obj.reserve(svc_info, client_ep, *args, **kwargs)
+		for svc, module in services:
+			for c in getattr(module, 'service_classes', []):
+				if class_name == c.__name__ and mod_name == c.__module__:
+					return c.reserve(svc_info, client_ep, *args, **kwargs)
 
 	def release(self, services):
 		prformat(fg.bold+fg.lightgrey+bg.red, "Client doesn't implement RELEASE API")
@@ -12,7 +12,8 @@ def defw_get_resource_mgr(timeout=SYSTEM_UP_TIMEOUT):
 	return defw.resmgr
 
 def defw_reserve_service_by_name(resmgr, svc_name, svc_type = -1,
-								 svc_cap = -1, timeout=SYSTEM_UP_TIMEOUT):
+								 svc_cap = -1, timeout=SYSTEM_UP_TIMEOUT,
+								 **kwargs):
 	wait = 0
 	while wait < timeout:
 		service_infos = resmgr.get_services(svc_name, svc_type, svc_cap)
@@ -27,7 +28,18 @@ def defw_reserve_service_by_name(resmgr, svc_name, svc_type = -1,
 
 	logging.debug(f"Received service_infos: {service_infos}")
 
-	svc_apis = defw.connect_to_resource(service_infos, svc_name)
+	# kwargs are passed to the reserve() of the services
+	svc_apis = defw.connect_to_resource(service_infos, svc_name, **kwargs)
 
 	return svc_apis
 
+def defw_reserve_qpm_pool(resmgr, svc_type = -1, svc_cap = -1,
+						  timeout=SYSTEM_UP_TIMEOUT, policy=None, **kwargs):
+	from api_qpm import QPMPool
+
+	qpms = defw_reserve_service_by_name(resmgr, 'QPM', svc_type, svc_cap,
+										timeout, **kwargs)
+	if policy:
+		return QPMPool(qpms, policy=policy)
+	return QPMPool(qpms)
+
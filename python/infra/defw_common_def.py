@@ -1,11 +1,14 @@
 import cdefw_global
 from defw_exception import DEFwError, DEFwDumper, DEFwNotFound
-import logging, os, yaml, shutil, threading, time, sys
-import cdefw_global
+import logging, logging.handlers, os, yaml, shutil, threading, time, sys
+import cdefw_global, queue, struct, atexit
 from pathlib import Path
 from collections import deque
 
 FILE_HANDLER = None
+QUEUE_HANDLER = None
+QUEUE_LISTENER = None
+RING_HANDLER = None
 CUSTOM_LEVELS = {}
 
 # DEFAULT LOG LEVELS
@@ -119,6 +122,19 @@ def get_rpc_req_base():
 
 global_class_db = {}
 
+# endpoint of the request being handled by the calling thread
+rpc_context = threading.local()
+
+def set_rpc_source(ep):
+	rpc_context.source = ep
+
+def get_rpc_source():
+	"""
+	Endpoint which sent the RPC the calling thread is handling, or None
+	if it isn't handling one
+	"""
+	return getattr(rpc_context, 'source', None)
+
 def system_shutdown():
 	global g_system_shutdown
 	logging.debug("System Shutting down")
@@ -126,14 +142,13 @@ def system_shutdown():
 
 def is_system_up():
 	global g_system_shutdown
-	logging.debug(f"System is {not g_system_shutdown}")
 	return not g_system_shutdown
 
 def add_to_class_db(instance, class_id):
 	if class_id in global_class_db:
 		raise DEFwError("Duplicate class_id. Contention in timing")
-	logging.debug(f"created instance for {type(instance).__name__} "\
-			      f"with id {class_id}")
+	logging.debug("created instance for %s with id %s",
+				  type(instance).__name__, class_id)
 	global_class_db[class_id] = instance
 
 def get_class_from_db(class_id):
@@ -252,13 +267,22 @@ def set_logging_level_helper(levelno):
 
 	root_logger.setLevel(levelno)
 
-	FILE_HANDLER.setLevel(levelno)
-	for filt in FILE_HANDLER.filters[:]:
-		FILE_HANDLER.removeFilter(filt)
-	if levelno in CUSTOM_LEVELS.values():
-		FILE_HANDLER.addFilter(ExclusiveLevelFilter(levelno))
-
-	root_logger.addHandler(FILE_HANDLER)
+	# the ring buffer keeps what would have made it to the log file
+	for handler in [FILE_HANDLER, RING_HANDLER]:
+		if not handler:
+			continue
+		handler.setLevel(levelno)
+		for filt in handler.filters[:]:
+			handler.removeFilter(filt)
+		if levelno in CUSTOM_LEVELS.values():
+			handler.addFilter(ExclusiveLevelFilter(levelno))
+
+	# The hot threads only enqueue the record. The file I/O happens on
+	# the QueueListener thread.
+	if QUEUE_HANDLER:
+		root_logger.addHandler(QUEUE_HANDLER)
+	else:
+		root_logger.addHandler(FILE_HANDLER)
 
 class ExclusiveLevelFilter(logging.Filter):
 	def __init__(self, levelno):
@@ -318,6 +342,117 @@ def setup_log_file():
 	FILE_HANDLER = logging.FileHandler(flog_name, mode=flog_mode)
 	FILE_HANDLER.setFormatter(logging.Formatter(printformat))
 
+	setup_log_listener(printformat)
+
+def setup_log_listener(printformat):
+	global QUEUE_HANDLER
+	global QUEUE_LISTENER
+	global RING_HANDLER
+
+	handlers = [FILE_HANDLER]
+
+	# DEFW_LOG_RING_SIZE is the number of bytes of recent log records to
+	# keep in memory. They are dumped on a crash or through dump_log_ring()
+	try:
+		ring_size = int(os.environ['DEFW_LOG_RING_SIZE'])
+	except:
+		ring_size = 0
+	if ring_size > 0:
+		RING_HANDLER = LogRingBuffer(ring_size)
+		RING_HANDLER.setFormatter(logging.Formatter(printformat))
+		handlers.append(RING_HANDLER)
+		install_crash_hooks()
+
+	QUEUE_HANDLER = logging.handlers.QueueHandler(queue.SimpleQueue())
+	QUEUE_LISTENER = logging.handlers.QueueListener(QUEUE_HANDLER.queue,
+									*handlers, respect_handler_level=True)
+	QUEUE_LISTENER.start()
+	atexit.register(stop_log_listener)
+
+def stop_log_listener():
+	global QUEUE_LISTENER
+
+	if not QUEUE_LISTENER:
+		return
+	# flushes all the pending records before returning
+	QUEUE_LISTENER.stop()
+	QUEUE_LISTENER = None
+
+class LogRingBuffer(logging.Handler):
+	'''
+	Keep the most recent log records in memory. Each record is packed as:
+		<time:double><levelno:uint32><length:uint32><utf-8 message>
+	Oldest records are dropped once the buffer exceeds its size in bytes.
+	'''
+	HEADER = struct.Struct('<dII')
+
+	def __init__(self, size):
+		super().__init__()
+		self.size = size
+		self.used = 0
+		self.ring = deque()
+
+	def emit(self, record):
+		try:
+			msg = self.format(record).encode('utf-8', 'replace')
+		except Exception:
+			self.handleError(record)
+			return
+		msg = msg[-(self.size - self.HEADER.size):]
+		entry = self.HEADER.pack(record.created, record.levelno, len(msg)) + msg
+		with self.lock:
+			self.ring.append(entry)
+			self.used += len(entry)
+			while self.used > self.size:
+				self.used -= len(self.ring.popleft())
+
+	def records(self):
+		with self.lock:
+			entries = list(self.ring)
+		for entry in entries:
+			created, levelno, length = self.HEADER.unpack_from(entry)
+			yield created, levelno, \
+				  entry[self.HEADER.size:self.HEADER.size+length].decode('utf-8')
+
+	def dump(self, path):
+		with open(path, 'w') as f:
+			for created, levelno, msg in self.records():
+				f.write(f"{logging.getLevelName(levelno)} {msg}\n")
+		return path
+
+def dump_log_ring(path=None):
+	'''
+	Dump the in-memory log ring buffer to a file. The ring buffer is
+	enabled by setting DEFW_LOG_RING_SIZE to the number of bytes to keep.
+	'''
+	if not RING_HANDLER:
+		return None
+	if not path:
+		path = os.path.join(cdefw_global.get_defw_tmp_dir(),
+							f"defw_py_ring_{os.getpid()}.log")
+	return RING_HANDLER.dump(path)
+
+def install_crash_hooks():
+	orig_excepthook = sys.excepthook
+	orig_thread_excepthook = threading.excepthook
+
+	def excepthook(exc_type, exc_value, exc_tb):
+		try:
+			dump_log_ring()
+		except:
+			pass
+		orig_excepthook(exc_type, exc_value, exc_tb)
+
+	def thread_excepthook(args):
+		try:
+			dump_log_ring()
+		except:
+			pass
+		orig_thread_excepthook(args)
+
+	sys.excepthook = excepthook
+	threading.excepthook = thread_excepthook
+
 def setup_log_levels():
 	add_logging_level(DEFW_LOG_LEVEL_INFRA, DEFW_LOG_LEVEL_INFRA_NAME)
 	add_logging_level(DEFW_LOG_LEVEL_SERVICES, DEFW_LOG_LEVEL_SERVICES_NAME)
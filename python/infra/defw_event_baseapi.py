@@ -54,6 +54,12 @@ class BaseEventAPI:
 			self.__event_queue.append(event)
 			os.write(self.__write_fd, b"x")
 
+	def put_batch(self, events):
+		# get() hands these out one event at a time, same as put()
+		with self.__event_lock:
+			self.__event_queue += events
+			os.write(self.__write_fd, b"x" * len(events))
+
 	def get(self, criteria=None, equalto=equalto_noop,
 			 recordtime=recordtime_noop):
 		res = []
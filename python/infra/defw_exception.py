@@ -1,5 +1,5 @@
 from inspect import *
-import traceback
+import traceback, linecache
 import yaml, sys
 import cdefw_global
 
@@ -15,13 +15,76 @@ class DEFwError(Exception):
 		self.msg = msg
 		self.arg = arg
 		self.halt = halt
-		self.filename, self.lineno, self.function, self.code_context, self.index = getframeinfo(currentframe().f_back)
-		exception_list = traceback.format_stack()
-		exception_list = exception_list[:-2]
-		exception_list.extend(traceback.format_tb(sys.exc_info()[2]))
-		exception_list.extend(traceback.format_exception_only(sys.exc_info()[0], sys.exc_info()[1]))
-		self.stacktrace = exception_str = "Traceback (most recent call last):\n"
-		self.stacktrace = "\n".join(exception_list)
+		# Skip the exception constructors to get to the frame which
+		# created the exception.
+		frame = currentframe().f_back
+		while frame.f_back and frame.f_code.co_filename == __file__:
+			frame = frame.f_back
+		self.filename = frame.f_code.co_filename
+		self.lineno = frame.f_lineno
+		self.function = frame.f_code.co_name
+		# Exceptions are used for flow control in polling paths, so only
+		# record where we are. The source lines and the formatted stack
+		# trace are produced the first time they are needed.
+		self.__stack = traceback.StackSummary.extract(traceback.walk_stack(frame),
+													 lookup_lines=False)
+		self.__stack.reverse()
+		# Only a summary of the exception being handled is kept. Holding
+		# on to its traceback would keep all of its frames alive.
+		exc_type, exc_value, exc_tb = sys.exc_info()
+		self.__exc = None
+		if exc_type:
+			self.__exc = traceback.TracebackException(exc_type, exc_value,
+								exc_tb, lookup_lines=False)
+		self.__code_context = None
+		self.__index = None
+		self.__stacktrace = None
+
+	@property
+	def code_context(self):
+		if self.__code_context is None and self.filename:
+			self.__code_context = [linecache.getline(self.filename, self.lineno)]
+			self.__index = 0
+		return self.__code_context
+
+	@code_context.setter
+	def code_context(self, code_context):
+		self.__code_context = code_context
+
+	@property
+	def index(self):
+		if self.__index is None:
+			self.code_context
+		return self.__index
+
+	@index.setter
+	def index(self, index):
+		self.__index = index
+
+	@property
+	def stacktrace(self):
+		if self.__stacktrace is None:
+			exception_list = self.__stack.format()
+			if self.__exc:
+				exception_list.extend(self.__exc.stack.format())
+				exception_list.extend(self.__exc.format_exception_only())
+			else:
+				exception_list.extend(traceback.format_exception_only(None, None))
+			self.__stacktrace = "\n".join(exception_list)
+			self.__stack = None
+			self.__exc = None
+		return self.__stacktrace
+
+	@stacktrace.setter
+	def stacktrace(self, stacktrace):
+		self.__stacktrace = stacktrace
+
+	def __reduce__(self):
+		# The captured stack and exception info can't be serialized. Format
+		# them before the exception is sent over the wire.
+		self.stacktrace
+		self.code_context
+		return (type(self), self.args, self.__dict__)
 
 	def __repr__(self):
 		return self.__str__()
@@ -109,6 +172,16 @@ class DEFwOperationFailure(DEFwError):
 	def __init__(self, msg='', arg=None, halt=False, nname=cdefw_global.get_node_name()):
 		super().__init__(msg, arg, halt, nname)
 
+# arg is {'retry_after': seconds}
+class DEFwRetryLater(DEFwError):
+	def __init__(self, msg='', arg=None, halt=False, nname=None):
+		super().__init__(msg, arg, halt, nname)
+
+	def get_retry_after(self):
+		if isinstance(self.arg, dict):
+			return self.arg.get('retry_after')
+		return None
+
 def defw_error_representer(dumper, data):
 	mapping = {'node-name': data.node_name, 'msg': data.msg, 'arg': data.arg, 'halt': data.halt, 'filename': data.filename,
 		   'lineno': data.lineno, 'function': data.function, 'code_context': data.code_context,
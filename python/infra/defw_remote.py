@@ -74,7 +74,8 @@ class BaseRemote(object):
 								self.__class_id,
 								self.__blocking,
 								*args, **kwargs)
-					logging.debug(f"Time taken in {attr.__name__} is {time.time() - start}")
+					logging.debug("Time taken in %s is %s", attr.__name__,
+								  time.time() - start)
 				else:
 					result = attr(*args, **kwargs)
 				return result
@@ -0,0 +1,268 @@
+import os, logging, threading
+from contextlib import contextmanager
+
+SYSFS_CPU = '/sys/devices/system/cpu'
+SYSFS_NODE = '/sys/devices/system/node'
+
+# How threads are placed on the CPUs this process can use:
+#	compact: fill the cores of one L3 domain before the next one, and
+#	         the hyperthread siblings after all the cores
+#	scatter: round robin over the L3 domains, alternating NUMA nodes
+#	avoid-l3-core0: compact, but the first core of each L3 domain, which
+#	         takes most of the interrupts and OS noise, is used last
+#	none: don't bind threads
+# Workers (the QRC runners) are placed from the start of the order, and
+# service threads (the launcher reapers, the RPC worker) from the end.
+# Threads and processes inherit the CPUs of the thread creating them, so
+# bound threads create them under unbound().
+try:
+	CPU_BIND_POLICY = os.environ['DEFW_CPU_BIND_POLICY']
+except:
+	CPU_BIND_POLICY = 'avoid-l3-core0'
+
+BIND_POLICIES = ['compact', 'scatter', 'avoid-l3-core0', 'none']
+SERVICE_ROLES = ['reaper', 'rpc']
+
+def parse_cpu_list(s):
+	"""
+	Parse a sysfs CPU list, like 0-3,8,10-11
+	"""
+	cpus = []
+	for part in s.strip().split(','):
+		if not part:
+			continue
+		if '-' in part:
+			lo, hi = part.split('-')
+			cpus += range(int(lo), int(hi) + 1)
+		else:
+			cpus.append(int(part))
+	return cpus
+
+def read_sysfs(path, default=None):
+	try:
+		with open(path) as f:
+			return f.read().strip()
+	except OSError:
+		return default
+
+class CPU:
+	def __init__(self, cpu, core, node, l3):
+		self.cpu = cpu
+		# (package, core id), shared by hyperthread siblings
+		self.core = core
+		self.node = node
+		# first CPU of the L3 domain
+		self.l3 = l3
+
+	def get(self):
+		return {'cpu': self.cpu, 'core': list(self.core),
+				'node': self.node, 'l3': self.l3}
+
+class Topology:
+	"""
+	CPUs this process can run on, grouped by NUMA node, L3 domain and
+	core, as read from sysfs. Without sysfs every CPU is taken to be a
+	core of its own in a single domain.
+	"""
+	def __init__(self, cpu_root=SYSFS_CPU, node_root=SYSFS_NODE, allowed=None):
+		if allowed is None:
+			allowed = os.sched_getaffinity(0)
+		online = read_sysfs(os.path.join(cpu_root, 'online'))
+		if online is not None:
+			allowed = set(allowed) & set(parse_cpu_list(online))
+		nodes = self.__read_nodes(node_root)
+		self.cpus = {}
+		for cpu in sorted(allowed):
+			base = os.path.join(cpu_root, f'cpu{cpu}')
+			package = read_sysfs(os.path.join(base, 'topology', 'physical_package_id'), '0')
+			core_id = read_sysfs(os.path.join(base, 'topology', 'core_id'), str(cpu))
+			self.cpus[cpu] = CPU(cpu, (int(package), int(core_id)),
+								 nodes.get(cpu, 0), self.__read_l3(base, cpu))
+		# l3 domain: cores, each a list of its hyperthreads
+		self.domains = {}
+		self.domain_nodes = {}
+		for c in self.cpus.values():
+			self.domain_nodes.setdefault(c.l3, c.node)
+			cores = self.domains.setdefault(c.l3, {})
+			cores.setdefault(c.core, []).append(c.cpu)
+
+	def __read_nodes(self, node_root):
+		nodes = {}
+		try:
+			entries = os.listdir(node_root)
+		except OSError:
+			return nodes
+		for entry in entries:
+			if not entry.startswith('node') or not entry[4:].isdigit():
+				continue
+			cpulist = read_sysfs(os.path.join(node_root, entry, 'cpulist'), '')
+			for cpu in parse_cpu_list(cpulist):
+				nodes[cpu] = int(entry[4:])
+		return nodes
+
+	def __read_l3(self, base, cpu):
+		# the domain is named after the first CPU sharing the cache.
+		# CPUs without an L3 are a domain of their own.
+		cache = os.path.join(base, 'cache')
+		try:
+			indexes = os.listdir(cache)
+		except OSError:
+			return 0
+		for index in indexes:
+			if read_sysfs(os.path.join(cache, index, 'level')) == '3':
+				shared = read_sysfs(os.path.join(cache, index, 'shared_cpu_list'), '')
+				return min(parse_cpu_list(shared) or [cpu])
+		return cpu
+
+	def __domain_order(self, l3):
+		cores = [self.domains[l3][k] for k in sorted(self.domains[l3].keys())]
+		# one thread of every core, then their siblings
+		order = []
+		depth = max(len(c) for c in cores)
+		for i in range(depth):
+			order += [c[i] for c in cores if i < len(c)]
+		return order
+
+	def order(self, policy):
+		"""
+		CPUs in the order threads are placed on them by policy
+		"""
+		l3s = sorted(self.domains.keys())
+		if policy == 'compact':
+			return [cpu for l3 in l3s for cpu in self.__domain_order(l3)]
+		if policy == 'avoid-l3-core0':
+			# the first cores of all domains go last
+			front, back = [], []
+			for l3 in l3s:
+				cpus = self.__domain_order(l3)
+				first = set(self.domains[l3][min(self.domains[l3].keys())])
+				if len(self.domains[l3]) == 1:
+					first = set()
+				front += [c for c in cpus if c not in first]
+				back += [c for c in cpus if c in first]
+			return front + back
+		if policy == 'scatter':
+			# alternate NUMA nodes, then domains within a node
+			by_node = {}
+			for l3 in l3s:
+				by_node.setdefault(self.domain_nodes[l3], []).append(l3)
+			ranked = []
+			for node, domains in by_node.items():
+				ranked += [(i, node, l3) for i, l3 in enumerate(domains)]
+			lists = [self.__domain_order(l3) for i, node, l3 in sorted(ranked)]
+			order = []
+			for i in range(max(len(l) for l in lists)):
+				order += [l[i] for l in lists if i < len(l)]
+			return order
+		raise ValueError(f"Unknown CPU bind policy {policy}")
+
+	def get(self):
+		return {'cpus': len(self.cpus),
+				'cores': sum(len(c) for c in self.domains.values()),
+				'l3_domains': len(self.domains),
+				'nodes': len(set(c.node for c in self.cpus.values()))}
+
+topology = None
+topology_lock = threading.Lock()
+# native thread id: where the thread is bound
+bindings = {}
+
+# CPUs the process started with, which unbound threads run on
+try:
+	process_cpus = os.sched_getaffinity(0)
+except (AttributeError, OSError):
+	process_cpus = None
+
+def get_topology():
+	global topology
+
+	with topology_lock:
+		if not topology:
+			topology = Topology()
+		return topology
+
+def prune_bindings_locked():
+	alive = set(t.native_id for t in threading.enumerate())
+	for tid in [tid for tid in bindings.keys() if tid not in alive]:
+		del bindings[tid]
+
+def next_service_slot_locked():
+	# lowest slot not taken by a live service thread, so service threads
+	# don't pile up on the same CPU
+	used = set(b['index'] for b in bindings.values()
+			   if b['role'] in SERVICE_ROLES)
+	slot = 0
+	while slot in used:
+		slot += 1
+	return slot
+
+def bind_thread(role, index=None, policy=None):
+	"""
+	Bind the calling thread to a CPU according to policy. Workers are
+	placed from the start of the policy's CPU order and service threads
+	from its end. Service threads without an index take the first slot
+	no other live service thread has. Returns the CPU, or None if the
+	thread wasn't bound.
+	"""
+	if policy is None:
+		policy = CPU_BIND_POLICY
+	if policy == 'none':
+		return None
+	try:
+		topo = get_topology()
+		order = topo.order(policy)
+		with topology_lock:
+			prune_bindings_locked()
+			if index is None:
+				index = next_service_slot_locked() if role in SERVICE_ROLES else 0
+			if role in SERVICE_ROLES:
+				order = order[::-1]
+			cpu = order[index % len(order)]
+			os.sched_setaffinity(0, {cpu})
+			bindings[threading.get_native_id()] = dict(topo.cpus[cpu].get(),
+				role=role, index=index, policy=policy,
+				thread=threading.current_thread().name)
+	except Exception as e:
+		logging.critical(f"Failed to bind the {role} thread {index}: {e}")
+		return None
+	logging.debug(f"bound {role} thread {index} ({threading.current_thread().name}) to CPU {cpu} ({policy})")
+	return cpu
+
+def unbind_thread():
+	"""
+	Put the calling thread back on the CPUs the process started with
+	and forget its binding
+	"""
+	with topology_lock:
+		bound = bindings.pop(threading.get_native_id(), None)
+	if bound and process_cpus:
+		try:
+			os.sched_setaffinity(0, process_cpus)
+		except OSError as e:
+			logging.critical(f"Failed to unbind {bound['thread']}: {e}")
+
+@contextmanager
+def unbound():
+	"""
+	Run the block on the CPUs the process started with, so threads and
+	processes created in it don't inherit the calling thread's binding
+	"""
+	with topology_lock:
+		bound = threading.get_native_id() in bindings
+	if not bound or not process_cpus:
+		yield
+		return
+	cpus = os.sched_getaffinity(0)
+	os.sched_setaffinity(0, process_cpus)
+	try:
+		yield
+	finally:
+		os.sched_setaffinity(0, cpus)
+
+def get_bindings():
+	"""
+	Where each live bound thread runs, keyed by native thread id
+	"""
+	with topology_lock:
+		prune_bindings_locked()
+		return {tid: dict(b) for tid, b in bindings.items()}
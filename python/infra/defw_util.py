@@ -160,11 +160,16 @@ def get_thread_names():
 	return thread_names
 
 def print_thread_stack_trace_to_logger(level='debug'):
-	stack_trace_str = "".join(traceback.format_stack())
+	# formatting the stack is expensive. Don't do it unless it's going
+	# to be logged
 	if level == 'critical':
-		logging.critical(f"{stack_trace_str}")
+		levelno = logging.CRITICAL
 	else:
-		logging.debug(f"{stack_trace_str}")
+		levelno = logging.DEBUG
+	if not logging.getLogger().isEnabledFor(levelno):
+		return
+	stack_trace_str = "".join(traceback.format_stack()[:-1])
+	logging.log(levelno, stack_trace_str)
 
 def print_all_thread_stack_traces_to_logger():
 	frames = sys._current_frames()
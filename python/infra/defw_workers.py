@@ -8,6 +8,7 @@ from defw import client_agents, service_agents, \
 				active_client_agents, active_service_agents, \
 				me, preferences, service_apis
 from defw_util import print_thread_stack_trace_to_logger
+from defw_topology import bind_thread, unbound
 import defw
 
 from collections import deque
@@ -32,8 +33,7 @@ class WorkerEvent:
 			if msg:
 				self.msg_yaml = yaml.load(msg, Loader=yaml.Loader)
 		logging.debug("workerEvent generated from: ")
-		stack_trace_str = "".join(traceback.format_stack())
-		logging.debug(f"{stack_trace_str}")
+		print_thread_stack_trace_to_logger()
 
 	def __check_type(self, we_type):
 		if we_type != WorkerEvent.EVENT_INCOMING_REQUEST and \
@@ -94,10 +94,9 @@ class WorkerRequest:
 			self.queue = queue.Queue()
 		else:
 			self.queue = None
-		logging.debug(f"WorkRequest({self.type2str(self.wr_type)}, " \
-					  f"{self.blocking}, {self.req_uuid})")
-		stack_trace_str = "".join(traceback.format_stack())
-		logging.debug(f"{stack_trace_str}")
+		logging.debug("WorkRequest(%s, %s, %s)", self.type2str(self.wr_type),
+					  self.blocking, self.req_uuid)
+		print_thread_stack_trace_to_logger()
 
 	def __check_type(self, wr_type):
 		if wr_type != WorkerRequest.WR_SEND_MSG and \
@@ -114,8 +113,8 @@ class WorkerRequest:
 	def wait(self):
 		if not self.queue:
 			return None
-		logging.debug(f"Waiting for WorkRequest({self.type2str(self.wr_type)}) " \
-					  f"{self.req_uuid} to complete")
+		logging.debug("Waiting for WorkRequest(%s) %s to complete",
+					  self.type2str(self.wr_type), self.req_uuid)
 
 		t = time.time()
 		while t < self.deadline:
@@ -127,12 +126,14 @@ class WorkerRequest:
 			except queue.Empty:
 				pass
 			t = time.time()
-			logging.debug(f"cur time {str(t)}, deadline {str(self.deadline)}")
+			logging.debug("cur time %s, deadline %s", t, self.deadline)
 			if event:
-				logging.debug(f"Completed {self.type2str(self.wr_type)} " \
-							  f"ev: {event.type2str([event.ev_type])} " \
-							  f"WorkRequest {self.req_uuid} exp " \
-							  f"{event.type2str(self.expected_events)}")
+				if logging.getLogger().isEnabledFor(logging.DEBUG):
+					logging.debug("Completed %s ev: %s WorkRequest %s exp %s",
+								  self.type2str(self.wr_type),
+								  event.type2str([event.ev_type]),
+								  self.req_uuid,
+								  event.type2str(self.expected_events))
 				if event.ev_type == WorkerEvent.EVENT_CONN_COMPLETE:
 					with self.expected_events_lock:
 						ev = self.expected_events[0]
@@ -221,10 +222,14 @@ class WorkerThread:
 	def spawn_temporary_worker(self, cb, *args, **kwargs):
 		tmp_thread = threading.Thread(target=cb, args=args, kwargs=kwargs)
 		tmp_thread.daemon = True
-		tmp_thread.start()
+		# the handlers, and whatever they launch, shouldn't be confined
+		# to this thread's CPU
+		with unbound():
+			tmp_thread.start()
 
 	# This thread should never do any blocking calls
 	def handle(self):
+		bind_thread('rpc')
 		shutdown = False
 		while not shutdown:
 			try:
@@ -232,14 +237,15 @@ class WorkerThread:
 			except queue.Empty:
 				continue
 
-			logging.debug(f"Received event {we.type2str([we.ev_type])}")
+			if logging.getLogger().isEnabledFor(logging.DEBUG):
+				logging.debug("Received event %s", we.type2str([we.ev_type]))
 
 			if we.ev_type == WorkerEvent.EVENT_INCOMING_REQUEST:
-				logging.debug(f"handling request {we.msg_yaml}")
+				logging.debug("handling request %s", we.msg_yaml)
 				self.spawn_temporary_worker(self.handle_rpc_req, we.msg_yaml, we.uuid)
 			elif we.ev_type == WorkerEvent.EVENT_INCOMING_RESPONSE:
 				# find request
-				logging.debug(f"handling response {we.msg_yaml}")
+				logging.debug("handling response %s", we.msg_yaml)
 				try:
 					with self.req_db_lock:
 						wr = self.req_db[we.msg_yaml['rpc']['req-uuid']]
@@ -254,7 +260,7 @@ class WorkerThread:
 				del_entries = []
 				with self.req_db_lock:
 					for k, v in self.req_db.items():
-						logging.debug(f"Got a refresh event. looking at {k}:{v}")
+						logging.debug("Got a refresh event. looking at %s:%s", k, v)
 						# satisfy the event in order to avoid out of order
 						# refresh events which get misinterpreted
 						# TODO: Is there a bug here?
@@ -268,7 +274,7 @@ class WorkerThread:
 									del_entries.append(k)
 						elif WorkerEvent.EVENT_REFRESH in v.expected_events:
 							raise DEFwCommError(f"Unordered events {v.expected_events}")
-					logging.debug(f"deleting entries from req_db {del_entries}")
+					logging.debug("deleting entries from req_db %s", del_entries)
 					for k in del_entries:
 						del self.req_db[k]
 				logging.debug("Finished handling refresh")
@@ -276,7 +282,7 @@ class WorkerThread:
 				try:
 					with self.req_db_lock:
 						wr = self.req_db[we.uuid]
-					logging.debug(f"Queuing Event Complete on WR {we.uuid}")
+					logging.debug("Queuing Event Complete on WR %s", we.uuid)
 					wr.queue.put(we)
 				except:
 					logging.critical(f"Unmatched response. DB = {self.req_db}")
@@ -334,28 +340,29 @@ class WorkerThread:
 		elif rpc_type == 'instantiate_class' or rpc_type == 'destroy_class':
 			class_name = y['rpc']['class']
 			class_id = y['rpc']['class_id']
-			logging.debug(f"instantiate_class {class_name} with {class_id}")
+			logging.debug("instantiate_class %s with %s", class_name, class_id)
 		else:
 			raise DEFwError('Unexpected rpc')
 
 		# any remote invocation implies that module which needs to be
 		# imported is in the python/icpa-be/
-		logging.debug("module name is: %s " % mname)
-		logging.debug("rpc type is: %s " % rpc_type)
+		logging.debug("module name is: %s ", mname)
+		logging.debug("rpc type is: %s ", rpc_type)
 		module = importlib.import_module(mname)
 		importlib.reload(module)
-		logging.debug(f"module is: {module.__name__}")
+		logging.debug("module is: %s", module.__name__)
 		args = y['rpc']['parameters']['args']
 		kwargs = y['rpc']['parameters']['kwargs']
 		defw_exception_string = None
+		common.set_rpc_source(source)
 		try:
 			if rpc_type == 'function_call':
-				logging.debug(f'remote call to function {function_name}')
+				logging.debug('remote call to function %s', function_name)
 				module_func = getattr(module, function_name)
 				if hasattr(module_func, '__call__'):
 					rc = module_func(*args, **kwargs)
 			elif rpc_type == 'instantiate_class':
-				logging.debug(f'remote call to instantiate class {class_name}')
+				logging.debug('remote call to instantiate class %s', class_name)
 				if me.is_resmgr() and class_name == 'DEFwResMgr':
 					common.add_to_class_db(defw.resmgr, class_id)
 				else:
@@ -368,7 +375,7 @@ class WorkerThread:
 						instance = my_class(*args, **kwargs)
 						common.add_to_class_db(instance, class_id)
 			elif rpc_type == 'destroy_class':
-				logging.debug(f'remote call to destroy class {class_name}')
+				logging.debug('remote call to destroy class %s', class_name)
 				if me.is_resmgr() and class_name == 'DEFwResMgr':
 					common.del_entry_from_class_db(class_id)
 				else:
@@ -382,8 +389,8 @@ class WorkerThread:
 								   f"but id refers to class {type(instance).__name__}")
 				start = time.time()
 				rc = getattr(instance, method_name)(*args, **kwargs)
-				logging.debug(f'remote call to method call {class_name}.{method_name} took '\
-							  f'{time.time() - start}')
+				logging.debug('remote call to method call %s.%s took %s',
+							  class_name, method_name, time.time() - start)
 		except Exception as e:
 			# NOTE: I can just send the exception as is to the other end, however,
 			# it won't have a backtrace. I put the back trace in the DEFwError representation
@@ -402,6 +409,8 @@ class WorkerThread:
 				header = "Traceback (most recent call last):\n"
 				stacktrace = "".join(exception_list)
 				defw_exception_string = header+stacktrace
+		finally:
+			common.set_rpc_source(None)
 		if defw_exception_string:
 			rc_yaml = common.populate_rpc_rsp(target, source, rc, defw_exception_string)
 		else:
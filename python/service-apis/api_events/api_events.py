@@ -21,3 +21,6 @@ class BaseEventAPI(BaseRemote):
 	def put(self, event):
 		pass
 
+	def put_batch(self, events):
+		pass
+
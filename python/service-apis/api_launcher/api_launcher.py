@@ -17,6 +17,9 @@ class Launcher(BaseRemote):
 	def status(self, pid):
 		pass
 
+	def poll_completed(self, pids=None):
+		pass
+
 	def shutdown(self):
 		pass
 
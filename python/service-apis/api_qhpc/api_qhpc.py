@@ -7,7 +7,7 @@ class Qhpc(BaseRemote):
 	def create_circuit(self, qasm, nbits=1):
 		pass
 
-	def delete_circuit(self):
+	def delete_circuit(self, cid):
 		pass
 
 	def sync_run(self, cid):
@@ -25,4 +25,10 @@ class Qhpc(BaseRemote):
 	def peek_cq(self, cid=None):
 		pass
 
+	def wait_cq(self, cid=None, timeout=None):
+		pass
+
+	def get_stats(self):
+		pass
+
 
@@ -1,5 +1,7 @@
 from defw_util import prformat, fg, bg
 from .api_qpm import *
+from .api_counts import PackedCounts
+from .api_pool import QPMPool
 
 # This is used by the infrastructure to display information about
 # the service module. The name is also used as a key through out the
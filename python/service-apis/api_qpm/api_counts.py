@@ -0,0 +1,186 @@
+from collections.abc import Mapping
+import base64, array, sys, yaml
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+COUNTS_TAG = '!qfw/counts'
+
+class PackedCounts(Mapping):
+	"""
+	Measurement histogram stored as two packed arrays: the outcomes, as
+	integers of num_bits bits, and their counts.
+
+	It reads like the bitstring: count dictionary it replaces. Bit i of
+	an outcome is character -(i+1) of its bitstring, so the rightmost
+	character is bit 0. When NumPy is available outcomes(), counts(),
+	bits(), marginal() and expectation() work on arrays.
+
+	Over RPC it is sent as a tagged mapping with the arrays base64
+	encoded, instead of one YAML entry per outcome.
+	"""
+	def __init__(self, num_bits, outcomes, counts):
+		self.num_bits = num_bits
+		# outcomes are ints, big endian in bytes of width bytes
+		self.width = max((num_bits + 7) // 8, 1)
+		self.__outcomes = bytes(outcomes)
+		self.__counts = array.array('Q', counts)
+		self.__index = None
+
+	@classmethod
+	def from_dict(cls, d):
+		"""
+		Pack a bitstring: count dictionary. Raises ValueError if it isn't
+		one.
+		"""
+		num_bits = 0
+		for k in d.keys():
+			num_bits = max(num_bits, len(k.replace(' ', '')))
+		width = max((num_bits + 7) // 8, 1)
+		outcomes = bytearray()
+		counts = []
+		for k, v in d.items():
+			if type(v) is not int:
+				raise ValueError(f"Count of {k} is not an integer")
+			outcomes += int(k.replace(' ', ''), 2).to_bytes(width, 'big')
+			counts.append(v)
+		return cls(num_bits, outcomes, counts)
+
+	@classmethod
+	def from_arrays(cls, num_bits, outcomes, counts):
+		width = max((num_bits + 7) // 8, 1)
+		packed = bytearray()
+		for o in outcomes:
+			packed += int(o).to_bytes(width, 'big')
+		return cls(num_bits, packed, [int(c) for c in counts])
+
+	def __len__(self):
+		return len(self.__counts)
+
+	def outcome(self, i):
+		w = self.width
+		return int.from_bytes(self.__outcomes[i*w:(i+1)*w], 'big')
+
+	def bitstring(self, i):
+		return format(self.outcome(i), f'0{self.num_bits}b')
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self.bitstring(i)
+
+	def __getitem__(self, key):
+		if self.__index is None:
+			self.__index = {self.outcome(i): i for i in range(len(self))}
+		try:
+			return self.__counts[self.__index[int(key.replace(' ', ''), 2)]]
+		except (KeyError, ValueError, AttributeError):
+			raise KeyError(key)
+
+	def __repr__(self):
+		return f"PackedCounts({dict(self)})"
+
+	def to_dict(self):
+		return dict(self.items())
+
+	def shots(self):
+		return sum(self.__counts)
+
+	def outcomes(self):
+		if self.num_bits > 64:
+			raise ValueError(f"{self.num_bits} bit outcomes don't fit an integer array. Use bits()")
+		if np is None:
+			return [self.outcome(i) for i in range(len(self))]
+		raw = np.frombuffer(self.__outcomes, dtype=np.uint8).reshape(-1, self.width)
+		padded = np.zeros((len(self), 8), dtype=np.uint8)
+		padded[:, 8 - self.width:] = raw
+		return padded.view('>u8').reshape(-1).astype(np.uint64)
+
+	def counts(self):
+		if np is None:
+			return list(self.__counts)
+		return np.frombuffer(self.__counts, dtype=np.uint64)
+
+	def bits(self):
+		"""
+		len(self) x num_bits array of the outcome bits. Column i is bit i.
+		"""
+		if np is None:
+			raise ImportError("bits() requires numpy")
+		raw = np.frombuffer(self.__outcomes, dtype=np.uint8).reshape(-1, self.width)
+		# unpacked columns are most significant first
+		unpacked = np.unpackbits(raw, axis=1)[:, self.width * 8 - self.num_bits:]
+		return unpacked[:, ::-1]
+
+	def marginal(self, bits):
+		"""
+		Counts over the given bit positions only. Bit j of the result is
+		bits[j] of the outcomes.
+		"""
+		if np is not None:
+			sub = self.bits()[:, list(bits)]
+			weights = 1 << np.arange(len(bits), dtype=np.uint64)
+			keys = (sub.astype(np.uint64) * weights).sum(axis=1)
+			uniq, inverse = np.unique(keys, return_inverse=True)
+			summed = np.bincount(inverse, weights=self.counts()).astype(np.uint64)
+			return PackedCounts.from_arrays(len(bits), uniq, summed)
+		merged = {}
+		for i in range(len(self)):
+			o = self.outcome(i)
+			k = sum(((o >> b) & 1) << j for j, b in enumerate(bits))
+			merged[k] = merged.get(k, 0) + self.__counts[i]
+		return PackedCounts.from_arrays(len(bits), merged.keys(), merged.values())
+
+	def expectation(self, bits=None):
+		"""
+		Expectation value of the product of Z on the given bit positions,
+		all of them if None.
+		"""
+		if bits is None:
+			bits = range(self.num_bits)
+		total = self.shots()
+		if not total:
+			return 0.0
+		if np is not None:
+			parity = self.bits()[:, list(bits)].sum(axis=1) & 1
+			return float(((1 - 2 * parity.astype(np.int64)) * self.counts()).sum()) / total
+		value = 0
+		for i in range(len(self)):
+			o = self.outcome(i)
+			parity = sum((o >> b) & 1 for b in bits) & 1
+			value += -self.__counts[i] if parity else self.__counts[i]
+		return value / total
+
+	def encode(self):
+		# counts are sent as 32 bit integers when they fit
+		counts = self.__counts
+		if not counts or max(counts) < (1 << 32):
+			counts = array.array('I', counts)
+		else:
+			counts = array.array('Q', counts)
+		if sys.byteorder != 'little':
+			counts.byteswap()
+		return {'num_bits': self.num_bits,
+				'count_size': counts.itemsize,
+				'outcomes': base64.b64encode(self.__outcomes).decode('ascii'),
+				'counts': base64.b64encode(counts.tobytes()).decode('ascii')}
+
+	@classmethod
+	def decode(cls, d):
+		counts = array.array('I' if d.get('count_size') == 4 else 'Q')
+		counts.frombytes(base64.b64decode(d['counts']))
+		if sys.byteorder != 'little':
+			counts.byteswap()
+		return cls(d['num_bits'], base64.b64decode(d['outcomes']), counts)
+
+def represent_packed_counts(dumper, data):
+	return dumper.represent_mapping(COUNTS_TAG, data.encode())
+
+def construct_packed_counts(loader, node):
+	return PackedCounts.decode(loader.construct_mapping(node))
+
+for dumper in [yaml.Dumper, yaml.SafeDumper]:
+	dumper.add_representer(PackedCounts, represent_packed_counts)
+for loader in [yaml.Loader, yaml.FullLoader, yaml.SafeLoader]:
+	loader.add_constructor(COUNTS_TAG, construct_packed_counts)
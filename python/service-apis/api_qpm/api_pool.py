@@ -0,0 +1,396 @@
+from defw_exception import DEFwInProgress, DEFwNotFound, DEFwOutOfResources, \
+						   DEFwCommError, DEFwReserveError, DEFwRetryLater
+import logging, threading, random, time, os
+
+# How circuits are routed. 'jsq' sends each circuit to the least loaded
+# QPM, 'p2c' to the less loaded of two QPMs picked at random.
+try:
+	POOL_POLICY = os.environ['QFW_QPM_POOL_POLICY']
+except:
+	POOL_POLICY = 'p2c'
+
+# Seconds the load reported by a QPM is used before asking again
+try:
+	LOAD_TTL = float(os.environ['QFW_QPM_POOL_LOAD_TTL'])
+except:
+	LOAD_TTL = 0.5
+
+# Seconds before a QPM which failed is sent circuits again
+try:
+	RETRY_INTERVAL = float(os.environ['QFW_QPM_POOL_RETRY_INTERVAL'])
+except:
+	RETRY_INTERVAL = 30.0
+
+# Longest a read of the merged completion queue waits on one QPM before
+# checking the others
+try:
+	POLL_INTERVAL = float(os.environ['QFW_QPM_POOL_POLL_INTERVAL'])
+except:
+	POLL_INTERVAL = 0.1
+
+# Errors about the circuit rather than the QPM
+CIRCUIT_ERRORS = (DEFwInProgress, DEFwNotFound)
+# The QPM is fine but can't take the circuit now
+BUSY_ERRORS = (DEFwOutOfResources, DEFwRetryLater)
+
+class PoolMember:
+	def __init__(self, idx, qpm):
+		self.idx = idx
+		self.qpm = qpm
+		self.load = None
+		self.load_time = 0
+		# circuits sent since the load was reported
+		self.sent = 0
+		# pool cid: cid on this QPM
+		self.circuits = {}
+		self.down_until = 0
+		self.submitted = 0
+		self.failures = 0
+
+	def healthy(self, now):
+		return now >= self.down_until
+
+	def refresh(self, now):
+		if self.load and now - self.load_time < LOAD_TTL:
+			return
+		try:
+			self.load = self.qpm.get_load()
+		except Exception as e:
+			# QPMs which don't report their load are balanced on the
+			# circuits outstanding on them
+			logging.debug(f"QPM {self.idx} didn't report its load: {e}")
+			self.load = None
+		self.load_time = now
+		self.sent = 0
+
+	def score(self):
+		# circuits queued and running per slot
+		if not self.load:
+			return len(self.circuits)
+		depth = self.load['queued'] + self.load['running'] + self.sent
+		return depth / max(self.load['total_slots'], 1)
+
+	def get_stats(self, now):
+		return {'healthy': self.healthy(now),
+				'outstanding': len(self.circuits),
+				'submitted': self.submitted,
+				'failures': self.failures,
+				'load': self.load}
+
+class QPMPool:
+	"""
+	Spreads circuits across several QPM services, for example the list
+	returned by defw_reserve_service_by_name(). Each circuit goes to the
+	QPM with the fewest circuits queued and running per slot, as
+	reported by get_load(), and the completion queues of all the QPMs
+	are read as one.
+
+	If a QPM fails, the circuits it hasn't completed are sent to the
+	others and it gets no new circuits for RETRY_INTERVAL seconds. A
+	circuit keeps the cid it was first given when it moves.
+	"""
+	def __init__(self, qpms, policy=POOL_POLICY):
+		if not qpms:
+			raise DEFwReserveError("QPMPool needs at least one QPM")
+		if policy not in ('jsq', 'p2c'):
+			raise ValueError(f"Unknown QPM pool policy {policy}")
+		self.members = [PoolMember(i, q) for i, q in enumerate(qpms)]
+		self.policy = policy
+		self.lock = threading.RLock()
+		# pool cid: member running it
+		self.owner = {}
+		# pool cid: info, to resend it if its QPM fails
+		self.infos = {}
+		# (member index, cid on the QPM): pool cid
+		self.aliases = {}
+		# results read from the QPMs but not yet by the client
+		self.ready = {}
+		self.rr = 0
+
+	def __len__(self):
+		return len(self.members)
+
+	def __pick_locked(self, exclude):
+		now = time.time()
+		candidates = [m for m in self.members
+					  if m not in exclude and m.healthy(now)]
+		if not candidates:
+			# they may have recovered
+			candidates = [m for m in self.members if m not in exclude]
+		if not candidates:
+			raise DEFwCommError("No QPM in the pool can run the circuit")
+		if self.policy == 'p2c' and len(candidates) > 2:
+			candidates = random.sample(candidates, 2)
+		for m in candidates:
+			m.refresh(now)
+		return min(candidates, key=lambda m: m.score())
+
+	def __register_locked(self, cid, m, rcid, info):
+		self.owner[cid] = m
+		self.infos[cid] = info
+		self.aliases[(m.idx, rcid)] = cid
+		m.circuits[cid] = rcid
+		m.submitted += 1
+
+	def __submit_locked(self, info, exclude):
+		exclude = set(exclude)
+		busy = None
+		while True:
+			try:
+				m = self.__pick_locked(exclude)
+			except DEFwCommError:
+				# all the QPMs which are up are busy
+				if busy:
+					raise busy
+				raise
+			try:
+				rcid = m.qpm.async_run(info)
+			except BUSY_ERRORS as e:
+				busy = e
+				exclude.add(m)
+				continue
+			except CIRCUIT_ERRORS:
+				raise
+			except Exception as e:
+				self.__member_failed_locked(m, e)
+				exclude.add(m)
+				continue
+			m.sent += 1
+			return m, rcid
+
+	def __member_failed_locked(self, m, e):
+		logging.critical(f"QPM {m.idx} failed, moving {len(m.circuits)} circuits: {e}")
+		m.down_until = time.time() + RETRY_INTERVAL
+		m.failures += 1
+		m.load = None
+		moved = list(m.circuits.items())
+		m.circuits = {}
+		for cid, rcid in moved:
+			self.aliases.pop((m.idx, rcid), None)
+			self.owner.pop(cid, None)
+			info = self.infos[cid]
+			try:
+				n, nrcid = self.__submit_locked(info, [m])
+			except Exception as e2:
+				self.infos.pop(cid)
+				now = time.time()
+				self.ready[cid] = {'cid': cid, 'result': str(e2), 'rc': -1,
+						'launch_time': now, 'exec_time': now,
+						'completion_time': now}
+				continue
+			self.__register_locked(cid, n, nrcid, info)
+
+	def __translate_locked(self, m, r):
+		# results of circuits which were moved are dropped
+		cid = self.aliases.pop((m.idx, r['cid']), None)
+		if cid is None:
+			return None
+		m.circuits.pop(cid, None)
+		self.owner.pop(cid, None)
+		self.infos.pop(cid, None)
+		r['cid'] = cid
+		return r
+
+	def __take_ready_locked(self, max_n):
+		results = []
+		for cid in list(self.ready.keys())[:max_n]:
+			results.append(self.ready.pop(cid))
+		return results
+
+	def __owner_locked(self, cid):
+		m = self.owner.get(cid)
+		if not m:
+			raise DEFwNotFound(f"{cid} is not in the QPM pool")
+		return m, m.circuits[cid]
+
+	def async_run(self, info):
+		with self.lock:
+			m, rcid = self.__submit_locked(info, [])
+			self.__register_locked(rcid, m, rcid, info)
+			return rcid
+
+	def async_run_batch(self, infos):
+		"""
+		Spread infos across the QPMs and send each QPM its share in one
+		batch. Returns the cids in the order of infos.
+		"""
+		with self.lock:
+			groups = {}
+			for i, info in enumerate(infos):
+				m = self.__pick_locked([])
+				m.sent += 1
+				groups.setdefault(m, []).append(i)
+			cids = [None] * len(infos)
+			for m, idxs in groups.items():
+				batch = [infos[i] for i in idxs]
+				try:
+					rcids = m.qpm.async_run_batch(batch)
+				except CIRCUIT_ERRORS:
+					raise
+				except Exception as e:
+					if not isinstance(e, BUSY_ERRORS):
+						self.__member_failed_locked(m, e)
+					for i in idxs:
+						n, rcid = self.__submit_locked(infos[i], [m])
+						self.__register_locked(rcid, n, rcid, infos[i])
+						cids[i] = rcid
+					continue
+				for i, rcid in zip(idxs, rcids):
+					self.__register_locked(rcid, m, rcid, infos[i])
+					cids[i] = rcid
+			return cids
+
+	def sync_run(self, info):
+		cid = self.async_run(info)
+		while True:
+			try:
+				return self.wait_cq(cid)
+			except DEFwInProgress:
+				pass
+
+	def __poll(self, max_n, timeout):
+		# read up to max_n results, waiting up to timeout on the QPM with
+		# the most circuits outstanding if none are ready
+		with self.lock:
+			results = self.__take_ready_locked(max_n)
+			members = [m for m in self.members if m.circuits]
+			n = len(self.members)
+			self.rr = (self.rr + 1) % n
+			members.sort(key=lambda m: (m.idx - self.rr) % n)
+		for m in members:
+			if len(results) >= max_n:
+				break
+			results += self.__read_member(m, max_n - len(results), 0)
+		if results or timeout <= 0 or not members:
+			return results
+		busiest = max(members, key=lambda m: len(m.circuits))
+		return self.__read_member(busiest, max_n, timeout)
+
+	def __read_member(self, m, max_n, timeout):
+		try:
+			rs = m.qpm.read_cq_many(max_n, timeout=timeout)
+		except Exception as e:
+			with self.lock:
+				self.__member_failed_locked(m, e)
+			return []
+		with self.lock:
+			results = [self.__translate_locked(m, r) for r in rs]
+		return [r for r in results if r]
+
+	def read_cq_many(self, max_n=64, timeout=0):
+		"""
+		Up to max_n results from any of the QPMs. If none are available
+		wait up to timeout seconds for the first one.
+		"""
+		deadline = time.time() + (timeout or 0)
+		while True:
+			remaining = deadline - time.time()
+			results = self.__poll(max_n, min(remaining, POLL_INTERVAL))
+			if results or remaining <= 0 or not self.owner:
+				return results
+
+	def read_cq(self, cid=None):
+		if not cid:
+			results = self.read_cq_many(1)
+			if not results:
+				raise DEFwInProgress("No ready QTs")
+			return results[0]
+		return self.wait_cq(cid, timeout=0)
+
+	def wait_cq(self, cid=None, timeout=None):
+		if not cid:
+			results = self.read_cq_many(1, timeout=timeout)
+			if not results:
+				raise DEFwInProgress("No ready QTs")
+			return results[0]
+		# retried when the circuit moves to another QPM
+		for attempt in range(len(self.members) + 1):
+			with self.lock:
+				if cid in self.ready:
+					return self.ready.pop(cid)
+				m, rcid = self.__owner_locked(cid)
+			try:
+				if timeout == 0:
+					r = m.qpm.read_cq(rcid)
+				else:
+					r = m.qpm.wait_cq(rcid, timeout=timeout)
+			except CIRCUIT_ERRORS:
+				raise
+			except Exception as e:
+				with self.lock:
+					self.__member_failed_locked(m, e)
+				continue
+			with self.lock:
+				r = self.__translate_locked(m, r)
+			if r:
+				return r
+		raise DEFwInProgress(f"{cid} still in progress")
+
+	def read_cq_batch(self, cids, timeout=0):
+		"""
+		Results of the cids which completed, in the order of cids.
+		Waits up to timeout seconds for all of them.
+		"""
+		deadline = time.time() + (timeout or 0)
+		done = {}
+		with self.lock:
+			groups = {}
+			for cid in cids:
+				if cid in self.ready:
+					done[cid] = self.ready.pop(cid)
+				elif cid in self.owner:
+					m, rcid = self.__owner_locked(cid)
+					groups.setdefault(m, []).append(rcid)
+		for m, rcids in groups.items():
+			try:
+				rs = m.qpm.read_cq_batch(rcids,
+						timeout=max(deadline - time.time(), 0))
+			except Exception as e:
+				with self.lock:
+					self.__member_failed_locked(m, e)
+				continue
+			with self.lock:
+				for r in rs:
+					r = self.__translate_locked(m, r)
+					if r:
+						done[r['cid']] = r
+		return [done[cid] for cid in cids if cid in done]
+
+	def delete_circuit(self, cid):
+		with self.lock:
+			if self.ready.pop(cid, None):
+				return
+			m, rcid = self.__owner_locked(cid)
+			m.qpm.delete_circuit(rcid)
+			self.__translate_locked(m, {'cid': rcid})
+
+	def get_queue_info(self, cid):
+		with self.lock:
+			m, rcid = self.__owner_locked(cid)
+		info = m.qpm.get_queue_info(rcid)
+		info['cid'] = cid
+		return info
+
+	def is_ready(self):
+		for m in self.members:
+			try:
+				if m.qpm.is_ready():
+					return True
+			except Exception:
+				pass
+		return False
+
+	def get_load(self):
+		with self.lock:
+			now = time.time()
+			for m in self.members:
+				if m.healthy(now):
+					m.refresh(now)
+			return [m.load for m in self.members]
+
+	def get_stats(self):
+		with self.lock:
+			now = time.time()
+			return {'policy': self.policy,
+					'ready': len(self.ready),
+					'members': [m.get_stats(now) for m in self.members]}
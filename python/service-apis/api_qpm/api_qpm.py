@@ -27,15 +27,73 @@ class QPM(BaseRemote):
 	def async_run(self, info):
 		pass
 
+	def sync_run_batch(self, infos):
+		pass
+
+	def async_run_batch(self, infos):
+		pass
+
 	def is_ready(self):
 		pass
 
+	def get_queue_info(self, cid=None):
+		pass
+
+	def get_load(self):
+		pass
+
+	def get_cache_stats(self):
+		pass
+
+	def get_credit_stats(self):
+		pass
+
+	def get_cpu_bindings(self):
+		pass
+
+	def get_analysis_cache_stats(self):
+		pass
+
+	def get_ingest_stats(self):
+		pass
+
+	def get_runner_pool_stats(self):
+		pass
+
+	def get_publisher_stats(self):
+		pass
+
+	# QB QPMs only
+	def get_vqpu_stats(self):
+		pass
+
+	def analyze_circuit(self, info):
+		pass
+
+	def estimate(self, info):
+		pass
+
+	def stats(self):
+		pass
+
+	def reset_stats(self):
+		pass
+
 	def read_cq(self, cid=None):
 		pass
 
 	def peek_cq(self, cid=None):
 		pass
 
+	def wait_cq(self, cid=None, timeout=None):
+		pass
+
+	def read_cq_many(self, max_n=64, timeout=0):
+		pass
+
+	def read_cq_batch(self, cids, timeout=0):
+		pass
+
 	def register_event_notification(self, ep, evtype, class_id):
 		pass
 
@@ -13,5 +13,11 @@ class QRC(BaseRemote):
 	def read_cq(self, cid=None):
 		pass
 
+	def wait_cq(self, cid=None, timeout=None):
+		pass
+
+	def read_cq_many(self, max_n, timeout=0):
+		pass
+
 	def test(self):
 		pass
@@ -1,26 +1,147 @@
 from defw_agent_info import *
 from defw_util import prformat, fg, bg
 from defw import me
-import os, subprocess, copy, yaml, logging, sys, threading, socket, psutil, traceback
-from time import sleep
+import os, subprocess, yaml, logging, sys, threading, socket, traceback
+import select, signal, fcntl, collections
 from defw_exception import DEFwError, DEFwInProgress
 sys.path.append(os.path.split(os.path.abspath(__file__))[0])
 import launcher_common as common
 from defw_cmd import defw_exec_remote_cmd
+from defw_topology import bind_thread, unbind_thread, unbound
+
+# Default number of bytes of each of stdout/stderr kept in memory per
+# process. Anything beyond that is only available in the spill files.
+try:
+	MAX_CAPTURED_OUTPUT = int(os.environ['QFW_LAUNCHER_MAX_OUTPUT'])
+except:
+	MAX_CAPTURED_OUTPUT = 4 * 1024 * 1024
+
+# posix_spawn avoids copying the page tables of the (large) python
+# process on every launch. QFW_LAUNCHER_SPAWN=popen reverts to the
+# subprocess.Popen fork/exec path.
+try:
+	SPAWN_METHOD = os.environ['QFW_LAUNCHER_SPAWN']
+except:
+	SPAWN_METHOD = 'posix_spawn'
+if not hasattr(os, 'posix_spawnp'):
+	SPAWN_METHOD = 'popen'
+
+# Number of environments kept for reuse by the launched processes
+try:
+	ENV_TEMPLATES_MAX = int(os.environ['QFW_LAUNCHER_ENV_TEMPLATES'])
+except:
+	ENV_TEMPLATES_MAX = 32
+
+# Environments passed to the launched processes keyed by the overrides
+# requested, least recently used first. Building one means copying the
+# whole os.environ.
+g_env_templates = collections.OrderedDict()
+g_env_templates_lock = threading.Lock()
+# Launched processes get /dev/null as stdin. It's opened once and shared.
+g_devnull_fd = -1
+
+def get_env_template(env):
+	if env and type(env) == dict:
+		key = tuple(sorted((str(k), str(v)) for k, v in env.items()))
+	else:
+		key = ()
+	with g_env_templates_lock:
+		if key in g_env_templates:
+			g_env_templates.move_to_end(key)
+			return g_env_templates[key]
+		template = dict(os.environ)
+		for k, v in key:
+			template[k] = v
+		g_env_templates[key] = template
+		while len(g_env_templates) > ENV_TEMPLATES_MAX:
+			g_env_templates.popitem(last=False)
+		return template
+
+def clear_env_templates():
+	# needs to be called if os.environ is modified after launching
+	with g_env_templates_lock:
+		g_env_templates.clear()
+
+def get_devnull_fd():
+	global g_devnull_fd
+	with g_env_templates_lock:
+		if g_devnull_fd == -1:
+			g_devnull_fd = os.open(os.devnull, os.O_RDONLY | os.O_CLOEXEC)
+		return g_devnull_fd
+
+class OutputCapture:
+	"""
+	Drains one of the output pipes of a process. Only the last max_bytes
+	are kept in memory. If spill_path is provided all the output is
+	written there as well.
+	"""
+	def __init__(self, pipe, max_bytes, spill_path=None):
+		self.pipe = pipe
+		self.fd = pipe.fileno()
+		os.set_blocking(self.fd, False)
+		self.max_bytes = max_bytes
+		self.tail = bytearray()
+		self.captured_bytes = 0
+		self.truncated = False
+		self.eof = False
+		self.spill_path = spill_path
+		self.__spill = None
+		if spill_path:
+			self.__spill = open(spill_path, 'wb')
+		# the reaper drains outside of the launcher's lock, so a kill can
+		# close the capture while it's being drained
+		self.__lock = threading.Lock()
+
+	def drain(self):
+		# Read whatever is available without blocking. Returns False once
+		# the other end has been closed.
+		with self.__lock:
+			return self.__drain()
+
+	def __drain(self):
+		while not self.eof:
+			try:
+				data = os.read(self.fd, 65536)
+			except BlockingIOError:
+				return True
+			if not data:
+				self.eof = True
+				break
+			self.captured_bytes += len(data)
+			if self.__spill:
+				self.__spill.write(data)
+			self.tail += data
+			if len(self.tail) > self.max_bytes:
+				del self.tail[:len(self.tail) - self.max_bytes]
+				self.truncated = True
+		return False
+
+	def close(self):
+		with self.__lock:
+			self.eof = True
+			if self.__spill:
+				self.__spill.close()
+				self.__spill = None
+			self.pipe.close()
 
 class Process:
-	def __init__(self, cmd, env, path):
+	def __init__(self, cmd, env, path, max_output=None, spill_dir=None,
+				 stdin_data=None):
 		if path:
-			self.__cmd = os.path.join(path, proc).split()
+			self.__cmd = os.path.join(path, cmd).split()
 		else:
 			self.__cmd = cmd.split()
 		self.__pid = 0
 		self.__process = None
+		self.__returncode = None
 		self.__appended_env = env
-		self.__env = copy.deepcopy(dict(os.environ))
-		if env and type(env) == dict:
-			for k, v in env.items():
-				self.__env[k] = v
+		self.__env = get_env_template(env)
+		if max_output is None:
+			max_output = MAX_CAPTURED_OUTPUT
+		self.__max_output = max_output
+		self.__spill_dir = spill_dir
+		self.__stdin_data = stdin_data
+		self.__captures = []
 
 	def __str__(self):
 		return f"Process(pid={self.__pid}, {self.__process}, env={self.__appended_env})"
@@ -28,72 +149,333 @@ class Process:
 	def __repr__(self):
 		return f"Process(pid={self.__pid}, {self.__process}, env={self.__appended_env})"
 
+	def __spawn(self):
+		# The child's ends are closed once it's spawned. The parent's
+		# ends only if the spawn fails.
+		child_fds = []
+		parent_fds = []
+		try:
+			stdout_r, stdout_w = os.pipe2(os.O_CLOEXEC)
+			parent_fds.append(stdout_r)
+			child_fds.append(stdout_w)
+			stderr_r, stderr_w = os.pipe2(os.O_CLOEXEC)
+			parent_fds.append(stderr_r)
+			child_fds.append(stderr_w)
+			stdin_r = stdin_w = -1
+			if self.__stdin_data is not None:
+				stdin_r, stdin_w = os.pipe2(os.O_CLOEXEC)
+				parent_fds.append(stdin_w)
+				child_fds.append(stdin_r)
+			file_actions = [(os.POSIX_SPAWN_DUP2,
+							 stdin_r if stdin_r != -1 else get_devnull_fd(), 0),
+							(os.POSIX_SPAWN_DUP2, stdout_w, 1),
+							(os.POSIX_SPAWN_DUP2, stderr_w, 2)]
+			self.__pid = os.posix_spawnp(self.__cmd[0], self.__cmd, self.__env,
+										 file_actions=file_actions, setsid=True)
+		except:
+			for fd in parent_fds:
+				os.close(fd)
+			raise
+		finally:
+			for fd in child_fds:
+				os.close(fd)
+		if stdin_w != -1:
+			self.__feed_stdin(stdin_w)
+		return os.fdopen(stdout_r, 'rb', buffering=0), \
+			   os.fdopen(stderr_r, 'rb', buffering=0)
+
+	def __feed_stdin(self, fd):
+		# Takes ownership of fd. Grow the pipe so the data can be written
+		# without blocking. Anything which doesn't fit is written by a
+		# helper thread.
+		data = memoryview(self.__stdin_data)
+		self.__stdin_data = None
+		try:
+			if len(data) > select.PIPE_BUF and hasattr(fcntl, 'F_SETPIPE_SZ'):
+				fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, len(data))
+		except OSError:
+			pass
+		os.set_blocking(fd, False)
+		try:
+			while data:
+				data = data[os.write(fd, data):]
+		except BlockingIOError:
+			pass
+		except BrokenPipeError:
+			data = None
+		if not data:
+			os.close(fd)
+			return
+
+		def writer():
+			nonlocal data
+			os.set_blocking(fd, True)
+			try:
+				while data:
+					data = data[os.write(fd, data):]
+			except OSError:
+				pass
+			os.close(fd)
+		threading.Thread(target=writer, daemon=True).start()
+
 	def launch(self):
 		try:
-			self.__process = subprocess.Popen(self.__cmd, env=self.__env,
-							stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-							stdin=subprocess.PIPE, start_new_session=True)
-			self.__pid = self.__process.pid
+			if SPAWN_METHOD == 'posix_spawn':
+				stdout, stderr = self.__spawn()
+			else:
+				stdin = subprocess.DEVNULL
+				if self.__stdin_data is not None:
+					stdin = subprocess.PIPE
+				self.__process = subprocess.Popen(self.__cmd, env=self.__env,
+								stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+								stdin=stdin, start_new_session=True)
+				self.__pid = self.__process.pid
+				stdout, stderr = self.__process.stdout, self.__process.stderr
+				if self.__stdin_data is not None:
+					fd = os.dup(self.__process.stdin.fileno())
+					self.__process.stdin.close()
+					self.__feed_stdin(fd)
 		except Exception as e:
 			logging.critical(f"hit exception: {e}")
 			raise e
+		stdout_path = stderr_path = None
+		if self.__spill_dir:
+			stdout_path = os.path.join(self.__spill_dir, f"{self.__pid}.stdout")
+			stderr_path = os.path.join(self.__spill_dir, f"{self.__pid}.stderr")
+		self.__captures = [OutputCapture(stdout, self.__max_output, stdout_path),
+						   OutputCapture(stderr, self.__max_output, stderr_path)]
 		return self.__pid
 
+	def get_captures(self):
+		return self.__captures
+
+	def captured_bytes(self):
+		return self.__captures[0].captured_bytes, self.__captures[1].captured_bytes
+
+	def finish_capture(self):
+		# Non-blocking. Called once the process has exited. Output written
+		# after this point by any children holding the pipes is dropped.
+		for c in self.__captures:
+			if not c.eof:
+				c.drain()
+			c.close()
+
 	def get_result(self):
-		output, error = self.__process.communicate()
-		return output, error, self.__process.returncode
+		pending = [c for c in self.__captures if not c.eof]
+		while pending:
+			select.select([c.fd for c in pending], [], [])
+			pending = [c for c in pending if c.drain()]
+		rc = self.wait()
+		for c in self.__captures:
+			c.close()
+		out, err = self.__captures
+		if out.truncated or err.truncated:
+			logging.debug(f"{self.__pid} output truncated to the last "
+						  f"{self.__max_output} bytes")
+		return (bytes(out.tail), bytes(err.tail), rc)
+
+	def __signal(self, sig):
+		if self.__process:
+			self.__process.send_signal(sig)
+		elif self.__returncode is None:
+			try:
+				os.kill(self.__pid, sig)
+			except ProcessLookupError:
+				pass
 
 	def kill(self):
 		logging.debug(f"Kill process with pid: {self.__pid}")
-		self.__process.kill()
-		try:
-			os.waitpid(self.__pid, 0)
-		except:
-			pass
+		self.__signal(signal.SIGKILL)
+		self.wait()
+		self.finish_capture()
 
 	def terminate(self):
 		logging.debug(f"Terminate process with pid: {self.__pid}")
-		self.__process.terminate()
+		self.__signal(signal.SIGTERM)
+		self.wait()
+		self.finish_capture()
+
+	def __waitpid(self, flags):
+		if self.__returncode is not None:
+			return self.__returncode
 		try:
-			os.waitpid(self.__pid, 0)
-		except:
-			pass
+			pid, status = os.waitpid(self.__pid, flags)
+		except ChildProcessError:
+			# somebody else already reaped it
+			self.__returncode = -1
+			return self.__returncode
+		if pid == self.__pid:
+			self.__returncode = os.waitstatus_to_exitcode(status)
+		return self.__returncode
+
+	def wait(self):
+		if self.__process:
+			return self.__process.wait()
+		return self.__waitpid(0)
 
 	def poll(self):
-		return self.__process.poll()
+		if self.__process:
+			return self.__process.poll()
+		return self.__waitpid(os.WNOHANG)
 
 	def returncode(self):
-		return self.__process.returncode
+		if self.__process:
+			return self.__process.returncode
+		return self.__returncode
 
 	def getpid(self):
 		return self.__pid
 
 class Launcher:
+	# How long the reaper sleeps between passes when pidfds aren't
+	# supported and it has to poll the processes.
+	POLL_INTERVAL = 0.01
+
 	def __init__(self, start=False):
 		self.__proc_dict = {}
 		self.__dead_procs = {}
+		self.__pidfds = {}
+		self.__capture_fds = {}
+		self.__proc_notify = {}
+		self.__reaping = set()
+		self.__completion_notify = []
 		self.__shutdown = False
 		self.__lock_db = threading.Lock()
+		self.__completion_cond = threading.Condition(self.__lock_db)
+		self.__use_pidfd = hasattr(os, 'pidfd_open')
+		self.__epoll = select.epoll()
+		# used to wake up the reaper on shutdown
+		self.__wakeup_r, self.__wakeup_w = os.pipe()
+		self.__epoll.register(self.__wakeup_r, select.EPOLLIN)
 		self.__monitor_thr = threading.Thread(target=self.monitor_thr)
 		self.__monitor_thr.daemon = True
-		self.__monitor_thr.start()
+		with unbound():
+			self.__monitor_thr.start()
+
+	def __track_locked(self, pid, proc, notify):
+		self.__proc_dict[pid] = proc
+		if notify:
+			self.__proc_notify[pid] = notify
+		# drain the output as it's produced so the process never blocks
+		# on a full pipe
+		for c in proc.get_captures():
+			self.__capture_fds[c.fd] = c
+			self.__epoll.register(c.fd, select.EPOLLIN)
+		if not self.__use_pidfd:
+			return
+		try:
+			pidfd = os.pidfd_open(pid)
+		except OSError as e:
+			# kernel doesn't support pidfds. Fallback to polling
+			logging.debug(f"pidfd_open failed ({e}). Polling processes instead")
+			self.__use_pidfd = False
+			return
+		self.__pidfds[pidfd] = pid
+		self.__epoll.register(pidfd, select.EPOLLIN)
+
+	def __untrack_locked(self, pid):
+		proc = self.__proc_dict.pop(pid, None)
+		self.__proc_notify.pop(pid, None)
+		if proc:
+			for c in proc.get_captures():
+				if c.fd in self.__capture_fds:
+					self.__epoll.unregister(c.fd)
+					del self.__capture_fds[c.fd]
+		for fd, p in self.__pidfds.items():
+			if p == pid:
+				self.__epoll.unregister(fd)
+				os.close(fd)
+				del self.__pidfds[fd]
+				break
+		return proc
 
 	def monitor_thr(self):
+		bind_thread('reaper')
+		# The reaper only wakes up when a child exits.
 		while not self.__shutdown:
+			if self.__use_pidfd:
+				timeout = -1
+			else:
+				timeout = Launcher.POLL_INTERVAL
+			try:
+				events = self.__epoll.poll(timeout)
+			except InterruptedError:
+				continue
+			exited = []
+			ready = []
+			with self.__lock_db:
+				for fd, ev in events:
+					if fd == self.__wakeup_r:
+						os.read(self.__wakeup_r, 4096)
+					elif fd in self.__capture_fds:
+						ready.append((fd, self.__capture_fds[fd]))
+					elif fd in self.__pidfds:
+						exited.append(self.__pidfds[fd])
+			# draining may write to the spill files, so don't hold up
+			# launches and status calls meanwhile
+			done = [(fd, c) for fd, c in ready if not c.drain()]
 			with self.__lock_db:
-				for pid, proc in self.__proc_dict.items():
-					exists = psutil.pid_exists(pid)
-					if proc.poll() is not None:
-						logging.debug(f"{pid} terminated with rc {proc.returncode()}")
-						stdout, stderr, rc = proc.get_result()
-						proc.kill()
-						self.__dead_procs[pid] = (stdout, stderr, rc)
-				for pid in self.__dead_procs.keys():
-					if pid in self.__proc_dict.keys():
-						del self.__proc_dict[pid]
-			sleep(0.0001)
+				for fd, c in done:
+					if self.__capture_fds.get(fd) is c:
+						self.__epoll.unregister(fd)
+						del self.__capture_fds[fd]
+				if not self.__use_pidfd:
+					for pid, proc in self.__proc_dict.items():
+						if proc.poll() is not None:
+							exited.append(pid)
+				procs = []
+				for pid in exited:
+					notify = self.__proc_notify.get(pid)
+					proc = self.__untrack_locked(pid)
+					if proc:
+						self.__reaping.add(pid)
+						procs.append((pid, proc, notify))
+			for pid, proc, notify in procs:
+				self.reap(pid, proc, notify)
+		with self.__lock_db:
+			for fd in self.__pidfds.keys():
+				os.close(fd)
+			self.__pidfds = {}
+			self.__epoll.close()
+			os.close(self.__wakeup_r)
+			os.close(self.__wakeup_w)
+		unbind_thread()
 		logging.debug("Monitor thread shutdown")
 
+	def reap(self, pid, proc, notify):
+		proc.finish_capture()
+		result = proc.get_result()
+		logging.debug(f"{pid} terminated with rc {result[2]}")
+		with self.__lock_db:
+			self.__dead_procs[pid] = result
+			self.__reaping.discard(pid)
+			self.__completion_cond.notify_all()
+			notify_list = list(self.__completion_notify)
+		if notify:
+			notify_list.append(notify)
+		for n in notify_list:
+			try:
+				if hasattr(n, 'put'):
+					n.put(pid)
+				else:
+					n(pid)
+			except Exception as e:
+				logging.critical(f"completion notification for {pid} failed: {e}")
+
+	def register_completion_cb(self, notify):
+		"""
+		Register a callable or a queue to be notified with the pid of
+		every process which completes. The result is still collected
+		through poll_completed() or status(). Only usable locally.
+		"""
+		with self.__lock_db:
+			self.__completion_notify.append(notify)
+
+	def unregister_completion_cb(self, notify):
+		with self.__lock_db:
+			if notify in self.__completion_notify:
+				self.__completion_notify.remove(notify)
+
 	def compose_remote_cmd(self, exe, env, use, modules, python_env):
 		cmd = ''
 		if env:
@@ -117,36 +499,47 @@ class Launcher:
 		defw_exec_remote_cmd(rcmd, target, deamonize=True)
 
 	def launch(self, cmd, env=None, path='', wait=False,
-			   target=None, muse='', modules='', python_env=''):
+			   target=None, muse='', modules='', python_env='',
+			   completion_cb=None, max_output=None, spill_dir=None,
+			   stdin_data=None):
+		"""
+		max_output: bytes of each of stdout/stderr to keep in memory
+		spill_dir: if provided the full stdout/stderr is written to
+				   <spill_dir>/<pid>.stdout and <spill_dir>/<pid>.stderr
+		stdin_data: bytes fed to the process' stdin. The process gets
+					/dev/null as stdin if not provided.
+		"""
 		logging.debug(f"Starting {cmd} on {target}")
+		# launched processes get all the CPUs even if the caller is bound
 		if target and target != socket.gethostname():
-			self.run_cmd_on_target(cmd, env, muse, modules, python_env, target)
+			with unbound():
+				self.run_cmd_on_target(cmd, env, muse, modules, python_env, target)
 			return 0
-		proc = Process(cmd, env, path)
-		# if we're going to wait for it keep it around until we get
-		# the result
-		proc.launch()
+		proc = Process(cmd, env, path, max_output=max_output, spill_dir=spill_dir,
+					   stdin_data=stdin_data)
+		with unbound():
+			proc.launch()
 		pid = proc.getpid()
-		with self.__lock_db:
-			self.__proc_dict[pid] = proc
+		# if we're going to wait for it, collect the result here instead
+		# of handing it to the reaper
 		if not wait:
+			with self.__lock_db:
+				self.__track_locked(pid, proc, completion_cb)
 			return pid
-		psutilproc = psutil.Process(pid)
 		output, error, rc = proc.get_result()
-		proc.kill()
 		return output, error, rc
 
 	def kill(self, pid):
 		with self.__lock_db:
-			if pid in self.__proc_dict.keys():
-				self.__proc_dict[pid].kill()
-				del self.__proc_dict[pid]
+			proc = self.__untrack_locked(pid)
+		if proc:
+			proc.kill()
 
 	def terminate(self, pid):
 		with self.__lock_db:
-			if pid in self.__proc_dict.keys():
-				self.__proc_dict[pid].kill()
-				del self.__proc_dict[pid]
+			proc = self.__untrack_locked(pid)
+		if proc:
+			proc.kill()
 
 	def status(self, pid):
 		with self.__lock_db:
@@ -156,37 +549,82 @@ class Launcher:
 				return rc
 		raise DEFwInProgress(f"{pid} is still running")
 
+	def poll_completed(self, pids=None):
+		"""
+		Non-raising alternative to status(). Returns a dictionary of
+		pid: (stdout, stderr, rc) for all the processes which have
+		completed. If pids is provided, only these pids are considered.
+		The returned processes are no longer tracked by the launcher.
+		"""
+		completed = {}
+		with self.__lock_db:
+			if pids is None:
+				completed = self.__dead_procs
+				self.__dead_procs = {}
+			else:
+				for pid in list(self.__dead_procs.keys()):
+					if pid in pids:
+						completed[pid] = self.__dead_procs.pop(pid)
+		return completed
+
+	def get_capture_stats(self):
+		"""
+		Number of stdout/stderr bytes captured so far by each of the
+		running processes
+		"""
+		stats = {}
+		with self.__lock_db:
+			for pid, proc in self.__proc_dict.items():
+				stdout_bytes, stderr_bytes = proc.captured_bytes()
+				stats[pid] = {'stdout_bytes': stdout_bytes,
+							  'stderr_bytes': stderr_bytes}
+		return stats
+
+	def wait_completed(self, pids=None, timeout=None):
+		"""
+		Block until at least one of pids (or any process if pids is None)
+		completes or the timeout expires. Returns the same dictionary as
+		poll_completed(), which is empty if the timeout expired.
+		"""
+		def ready():
+			if pids is None:
+				return len(self.__dead_procs) > 0 or self.__shutdown
+			for pid in self.__dead_procs.keys():
+				if pid in pids:
+					return True
+			return self.__shutdown
+
+		with self.__completion_cond:
+			self.__completion_cond.wait_for(ready, timeout=timeout)
+		return self.poll_completed(pids)
+
 	def shutdown(self, keep=False):
-		rm_pid = []
-		if not keep:
-			with self.__lock_db:
-				for pid, proc in self.__proc_dict.items():
-					proc.kill()
-					rm_pid.append(pid)
-				for pid in rm_pid:
-					del self.__proc_dict[pid]
+		procs = []
+		with self.__lock_db:
+			if self.__shutdown:
+				return
+			if not keep:
+				for pid in list(self.__proc_dict.keys()):
+					procs.append(self.__untrack_locked(pid))
+			self.__shutdown = True
+			self.__completion_cond.notify_all()
+			# The reaper closes the wakeup pipe under the lock once it
+			# sees the shutdown
+			os.write(self.__wakeup_w, b"x")
+		for proc in procs:
+			proc.kill()
 		logging.debug("Launcher Service shutdown requested")
-		self.__shutdown = True
 
 	def blocking_wait(self, pid=-1):
-		while True:
-			with self.__lock_db:
-				if pid == -1:
-					if len(self.__proc_dict) == 0:
-						break;
-					rm_pid = []
-					for pid, proc in self.__proc_dict.items():
-						if proc.poll():
-							rm_pid.append(pid)
-					for pid in rm_pid:
-						del self.__proc_dict[pid]
-				else:
-					if pid in self.__proc_dict.keys() and \
-					self.__proc_dict[pid].poll():
-						self.__proc_dict[pid].terminate()
-						del self.__proc_dict[pid]
-						break
-			sleep(0.0001)
+		def done():
+			if self.__shutdown:
+				return True
+			if pid == -1:
+				return len(self.__proc_dict) == 0 and len(self.__reaping) == 0
+			return pid not in self.__proc_dict and pid not in self.__reaping
+
+		with self.__completion_cond:
+			self.__completion_cond.wait_for(done)
 
 	def query(self):
 		from . import svc_info
@@ -199,7 +637,8 @@ class Launcher:
 	def test(self):
 		logging.debug("Testing Launcher")
 
-	def reserve(self, svc, client_ep, *args, **kwargs):
+	@classmethod
+	def reserve(cls, svc, client_ep, *args, **kwargs):
 		logging.debug(f"{client_ep} reserved the {svc}")
 
 	def release(self, services):
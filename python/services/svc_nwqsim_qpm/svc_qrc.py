@@ -7,6 +7,11 @@ from util.qpm.util_qrc import UTIL_QRC
 sys.path.append(os.path.split(os.path.abspath(__file__))[0])
 
 class QRC(UTIL_QRC):
+	# NWQSIM prints the result on stdout, so the QASM can also be fed
+	# through its stdin. That relies on it reading /dev/stdin, so the
+	# pipe is only used when asked for with QFW_QRC_HANDOFF=pipe.
+	HANDOFF_MODES = ['file', 'shm', 'pipe']
+
 	def __init__(self, start=True):
 		super().__init__(start=start)
 
@@ -1,48 +1,23 @@
-import sys, os, logging, yaml, requests, threading
-import svc_launcher, cdefw_global
-from time import sleep, time
+import sys, os, logging, yaml
+import cdefw_global
 from .svc_qrc import QRC
+from .svc_vqpu import VQPUManager
 from util.qpm.util_qpm import UTIL_QPM
 from util.qpm.util_circuit import set_max_qubits_pp
-from defw_exception import DEFwDumper, DEFwNotFound, DEFwOutOfResources
-from defw_cmd import defw_exec_remote_cmd
+from defw_exception import DEFwOutOfResources
 
-QB_START_TIMEOUT = 40
 MAX_VQPU_QUBITS = 15
 MAX_VQPU_PPN = 1
 
-def send_request(vqpu_url):
-	url = f'{vqpu_url}/get'  # This is a public testing endpoint
-	try:
-		response = requests.get(url)
-		return response.status_code
-	except:
-		return -1
-
-def wait_for_vqpu(url, host, config):
-	time = 0
-	while True:
-		rc = send_request(url)
-		if rc != -1:
-			break
-		if time >= QB_START_TIMEOUT:
-			break
-		logging.debug(f"wait_for_vqpu: {url}, {host}, {config}")
-		sleep(1)
-		time += 1
-		continue
-	if rc != -1:
-		config[host]['status'] = True
-	else:
-		config[host]['status'] = False
-
 class QPM(UTIL_QPM):
 	def __init__(self, start=True):
 		set_max_qubits_pp(MAX_VQPU_QUBITS)
 
-		super().__init__(QRC(), max_ppn=MAX_VQPU_PPN, start=start)
+		super().__init__(QRC(start=start), max_ppn=MAX_VQPU_PPN, start=start)
+		self.vqpus = None
 		# start the QB vQPUs
-		self.start_vqpus()
+		if start:
+			self.start_vqpus()
 
 	def query(self):
 		from . import SERVICE_NAME, SERVICE_DESC
@@ -63,53 +38,18 @@ class QPM(UTIL_QPM):
 		cfg_template = os.path.join(os.environ['QFW_BIN_PATH'], 'QB',
 									'cfg', 'remote_backends.yaml')
 		with open(cfg_template, 'r') as f:
-			self.qb_cfg = yaml.load(f, Loader=yaml.FullLoader)
-
-		tmp_dir = cdefw_global.get_defw_tmp_dir()
-
-		self.vqpu_hosts = []
-		self.vqpu_cfgs = {}
-		threads = []
-		for k, v in self.free_hosts.items():
-			vqpu_url = f'http://{k}:8081'
-			self.qb_cfg['loopback']['url'] = vqpu_url
-			host_fname = f'{k}_qb.yaml'
-			self.vqpu_cfgs[k] = {}
-			self.vqpu_cfgs[k]['cfg'] = os.path.join(tmp_dir, host_fname)
-			with open(self.vqpu_cfgs[k]['cfg'], 'w') as f:
-				f.write(yaml.dump(self.qb_cfg, Dumper=DEFwDumper,
-								  indent=2, sort_keys=True))
-			self.launcher = svc_launcher.Launcher()
-			self.vqpu_hosts.append(k)
-			vqpu_cmd = os.path.join(os.environ['QFW_BIN_PATH'], 'vqpu.sh')
-			#vqpu_cmd = 'VQPU_PORT=8081 ' + vqpu_cmd
-			#module_path = os.environ['MODULEPATH']
-			#env = {'VQPU_PORT': '8081', 'MODULEPATH': module_path}
-			env = {'VQPU_PORT': '8081'}
-			logging.debug(f"Starting vQPU on {k} with {self.vqpu_cfgs[k]['cfg']} with:\n\t{vqpu_cmd}\n\t{env}")
-			self.launcher.launch(f"{vqpu_cmd}",
-					env=env, target=k)
-			#self.launcher.launch(f"{vqpu_cmd}", target=k)
-			thread = threading.Thread(target=wait_for_vqpu, args=(vqpu_url, k, self.vqpu_cfgs,))
-			threads.append(thread)
-			thread.start()
-
-		for thread in threads:
-			logging.debug("Waiting on vqpu wait thread to finish")
-			thread.join()
-
-		for k, v in self.vqpu_cfgs.items():
-			if not v['status']:
-				self.launcher.shutdown()
-				raise DEFwNotFound(f"Failed to start vQPU on {k}")
+			qb_cfg = yaml.load(f, Loader=yaml.FullLoader)
 
+		self.vqpus = VQPUManager(list(self.free_hosts.keys()), qb_cfg,
+								 cdefw_global.get_defw_tmp_dir())
+		self.vqpus.start()
 
 	def qb_common_run(self, cid):
 		circuit = self.circuits[cid]
 		self.consume_resources(circuit)
-		logging.debug(f"Running {cid}\n{circuit.info}\n{self.vqpu_cfgs}")
+		logging.debug(f"Running {cid}\n{circuit.info}")
 		h = list(circuit.info['hosts'].keys())[0]
-		circuit.info['vqpu_url'] = self.vqpu_cfgs[h]['cfg']
+		circuit.info['vqpu_url'] = self.vqpus.get_cfg(h)
 		return circuit
 
 	def sync_run(self, cid):
@@ -118,16 +58,21 @@ class QPM(UTIL_QPM):
 	def async_run(self, cid):
 		return super().async_run(cid, common_run=self.qb_common_run)
 
+	def sync_run_batch(self, infos):
+		return super().sync_run_batch(infos, common_run=self.qb_common_run)
+
+	def async_run_batch(self, infos):
+		return super().async_run_batch(infos, common_run=self.qb_common_run)
+
+	def get_vqpu_stats(self):
+		if not self.vqpus:
+			return {}
+		return self.vqpus.get_stats()
+
 	def shutdown(self):
-		for host in self.vqpu_hosts:
-			os.remove(self.vqpu_cfgs[host]['cfg'])
-			logging.debug(f"Killing vqpu.sh on {host}")
-			defw_exec_remote_cmd("pkill -9 vqpu.sh", host=host)
-			#self.launcher.launch("pkill -9 vqpu.sh", target=host)
-			logging.debug(f"Killing qcstack on {host}")
-			defw_exec_remote_cmd("pkill -9 qcstack", host=host)
-			#self.launcher.launch("pkill -9 qcstack", target=host)
-			self.launcher.shutdown()
+		if self.vqpus:
+			logging.critical(f"vQPUs: {self.get_vqpu_stats()}")
+			self.vqpus.shutdown()
 		super().shutdown()
 
 	def test(self):
@@ -0,0 +1,193 @@
+import os, logging, threading, time, yaml, requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import svc_launcher
+from defw_exception import DEFwDumper, DEFwNotFound
+from defw_cmd import defw_exec_remote_cmd
+
+# Seconds a vQPU has to come up
+try:
+	QB_START_TIMEOUT = float(os.environ['QFW_QB_START_TIMEOUT'])
+except:
+	QB_START_TIMEOUT = 40
+
+try:
+	VQPU_PORT = int(os.environ['QFW_QB_VQPU_PORT'])
+except:
+	VQPU_PORT = 8081
+
+# Leave the vQPUs running at shutdown so the next QPM on the same hosts
+# picks them up instead of starting new ones
+try:
+	VQPU_KEEP = os.environ['QFW_QB_VQPU_KEEP'].upper() in ['1', 'YES', 'TRUE']
+except:
+	VQPU_KEEP = False
+
+# Seconds between health checks of the running vQPUs. 0 disables them.
+try:
+	HEALTH_INTERVAL = float(os.environ['QFW_QB_HEALTH_INTERVAL'])
+except:
+	HEALTH_INTERVAL = 15
+
+# Failed health checks in a row before a vQPU is replaced
+HEALTH_MAX_FAILURES = 3
+# Timeout of a single probe, and the bounds of the delay between probes
+# while waiting for a vQPU to come up
+PROBE_TIMEOUT = 2
+PROBE_MIN_DELAY = 0.05
+PROBE_MAX_DELAY = 2
+
+class VQPU:
+	def __init__(self, host, cfg):
+		self.host = host
+		self.url = f'http://{host}:{VQPU_PORT}'
+		self.cfg = cfg
+		self.status = 'starting'
+		self.reused = False
+		self.failures = 0
+		self.replacements = 0
+		self.startup_time = -1
+
+	def get(self):
+		return {'url': self.url, 'status': self.status,
+				'reused': self.reused, 'replacements': self.replacements,
+				'startup_time': self.startup_time}
+
+class VQPUManager:
+	"""
+	Brings up a vQPU on each host in parallel and keeps them healthy. A
+	healthy vQPU already listening on a host is used as is. Readiness is
+	probed with exponential backoff over a pooled HTTP session, and
+	vQPUs which fail HEALTH_MAX_FAILURES health checks in a row are
+	restarted.
+	"""
+	def __init__(self, hosts, qb_cfg, cfg_dir):
+		self.qb_cfg = qb_cfg
+		self.vqpus = {h: VQPU(h, os.path.join(cfg_dir, f'{h}_qb.yaml'))
+					  for h in hosts}
+		self.launcher = svc_launcher.Launcher()
+		self.session = requests.Session()
+		pool_size = max(len(self.vqpus), 1)
+		adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+		self.session.mount('http://', adapter)
+		self.stop = threading.Event()
+		self.health_thread = None
+		self.startup_time = -1
+
+	def write_cfg(self, vqpu):
+		cfg = dict(self.qb_cfg)
+		cfg['loopback'] = dict(cfg['loopback'], url=vqpu.url)
+		with open(vqpu.cfg, 'w') as f:
+			f.write(yaml.dump(cfg, Dumper=DEFwDumper, indent=2, sort_keys=True))
+
+	def probe(self, vqpu):
+		# any HTTP response means the vQPU is up
+		try:
+			self.session.get(f'{vqpu.url}/get', timeout=PROBE_TIMEOUT)
+			return True
+		except requests.RequestException:
+			return False
+
+	def wait_ready(self, vqpu, timeout=QB_START_TIMEOUT):
+		deadline = time.time() + timeout
+		delay = PROBE_MIN_DELAY
+		while True:
+			if self.probe(vqpu):
+				return True
+			remaining = deadline - time.time()
+			if remaining <= 0 or self.stop.is_set():
+				return False
+			logging.debug(f"waiting for vQPU {vqpu.url}")
+			self.stop.wait(min(delay, remaining))
+			delay = min(delay * 2, PROBE_MAX_DELAY)
+
+	def launch(self, vqpu):
+		vqpu_cmd = os.path.join(os.environ['QFW_BIN_PATH'], 'vqpu.sh')
+		env = {'VQPU_PORT': str(VQPU_PORT)}
+		logging.debug(f"Starting vQPU on {vqpu.host} with {vqpu.cfg} with:\n\t{vqpu_cmd}\n\t{env}")
+		self.launcher.launch(vqpu_cmd, env=env, target=vqpu.host)
+
+	def kill(self, vqpu):
+		logging.debug(f"Killing vqpu.sh and qcstack on {vqpu.host}")
+		defw_exec_remote_cmd("pkill -9 vqpu.sh", host=vqpu.host)
+		defw_exec_remote_cmd("pkill -9 qcstack", host=vqpu.host)
+
+	def bring_up(self, vqpu):
+		start = time.time()
+		self.write_cfg(vqpu)
+		if self.probe(vqpu):
+			logging.debug(f"Reusing the vQPU running on {vqpu.host}")
+			vqpu.reused = True
+			ready = True
+		else:
+			self.launch(vqpu)
+			ready = self.wait_ready(vqpu)
+		vqpu.status = 'ready' if ready else 'failed'
+		vqpu.failures = 0
+		vqpu.startup_time = time.time() - start
+		return ready
+
+	def start(self):
+		start = time.time()
+		with ThreadPoolExecutor(max_workers=max(len(self.vqpus), 1)) as pool:
+			ready = list(pool.map(self.bring_up, self.vqpus.values()))
+		self.startup_time = time.time() - start
+		logging.critical(f"vQPUs started in {self.startup_time:.2f}s: {self.get_stats()}")
+		if not all(ready):
+			failed = [v.host for v in self.vqpus.values() if v.status != 'ready']
+			self.shutdown(keep=False)
+			raise DEFwNotFound(f"Failed to start vQPU on {failed}")
+		if HEALTH_INTERVAL > 0:
+			self.health_thread = threading.Thread(target=self.health_thr,
+												  daemon=True)
+			self.health_thread.start()
+
+	def replace(self, vqpu):
+		if self.stop.is_set():
+			return
+		logging.critical(f"vQPU on {vqpu.host} is unhealthy. Restarting it")
+		vqpu.status = 'starting'
+		vqpu.reused = False
+		vqpu.replacements += 1
+		try:
+			self.kill(vqpu)
+		except Exception as e:
+			logging.critical(f"Failed to kill the vQPU on {vqpu.host}: {e}")
+		try:
+			self.bring_up(vqpu)
+		except Exception as e:
+			logging.critical(f"Failed to restart the vQPU on {vqpu.host}: {e}")
+			vqpu.status = 'failed'
+
+	def health_thr(self):
+		while not self.stop.wait(HEALTH_INTERVAL):
+			for vqpu in self.vqpus.values():
+				if self.stop.is_set():
+					return
+				if self.probe(vqpu):
+					vqpu.failures = 0
+					continue
+				vqpu.failures += 1
+				if vqpu.failures >= HEALTH_MAX_FAILURES:
+					self.replace(vqpu)
+
+	def get_cfg(self, host):
+		return self.vqpus[host].cfg
+
+	def get_stats(self):
+		return {'startup_time': self.startup_time,
+				'vqpus': {h: v.get() for h, v in self.vqpus.items()}}
+
+	def shutdown(self, keep=VQPU_KEEP):
+		self.stop.set()
+		if self.health_thread:
+			self.health_thread.join()
+		if not keep:
+			for vqpu in self.vqpus.values():
+				try:
+					os.remove(vqpu.cfg)
+				except OSError:
+					pass
+				self.kill(vqpu)
+		self.launcher.shutdown(keep=keep)
+		self.session.close()
@@ -0,0 +1,152 @@
+import threading, hashlib, collections, json, time, os
+from util.qpm.util_result_cache import normalize_qasm
+
+# Compiled circuits kept. 0 disables the cache.
+try:
+	COMPILE_CACHE_SIZE = int(os.environ['QFW_QHPC_COMPILE_CACHE_SIZE'])
+except:
+	COMPILE_CACHE_SIZE = 256
+
+class CircuitCompiler:
+	"""
+	What Qhpc needs to compile and run circuits. settings() is part of
+	the compile cache key, so it must cover everything which changes
+	the compiled circuit.
+	"""
+	def settings(self):
+		return {}
+
+	def accelerator(self):
+		raise NotImplementedError
+
+	def compile(self, qasm, qpu):
+		raise NotImplementedError
+
+	def program(self, compiled, qasm):
+		"""
+		What the accelerator executes for a compiled circuit. Compiled
+		circuits are shared by concurrent executions, so this must not
+		hand out anything executing can change.
+		"""
+		raise NotImplementedError
+
+	def qalloc(self, nbits):
+		raise NotImplementedError
+
+class XaccCompiler(CircuitCompiler):
+	"""
+	Compiles with an XACC compiler for an XACC accelerator. Every thread
+	reuses its own accelerator and compiler handles.
+	"""
+	def __init__(self, accelerator, params, compiler):
+		self.accelerator_name = accelerator
+		self.params = params
+		self.compiler_name = compiler
+		self.local = threading.local()
+
+	def settings(self):
+		return {'accelerator': self.accelerator_name, 'params': self.params,
+				'compiler': self.compiler_name}
+
+	def accelerator(self):
+		import xacc
+		if not hasattr(self.local, 'qpu'):
+			self.local.qpu = xacc.getAccelerator(self.accelerator_name,
+												 self.params)
+		return self.local.qpu
+
+	def compile(self, qasm, qpu):
+		import xacc
+		if not hasattr(self.local, 'compiler'):
+			self.local.compiler = xacc.getCompiler(self.compiler_name)
+		return self.local.compiler.compile(qasm, qpu)
+
+	def program(self, compiled, qasm):
+		# XACC composites aren't known to be safe to share between
+		# threads. Clone the cached one, or compile a private copy if
+		# the bindings can't clone.
+		composite = compiled.getComposites()[0]
+		if hasattr(composite, 'clone'):
+			return composite.clone()
+		return self.compile(qasm, self.accelerator()).getComposites()[0]
+
+	def qalloc(self, nbits):
+		import xacc
+		return xacc.qalloc(nbits)
+
+class CompileCache:
+	"""
+	LRU cache of compiled circuits keyed by the hash of the normalized
+	QASM and the compiler settings. Concurrent compiles of the same
+	circuit are done once.
+	"""
+	def __init__(self, compiler, max_entries=COMPILE_CACHE_SIZE):
+		self.compiler = compiler
+		self.max_entries = max_entries
+		self.lock = threading.Lock()
+		# key: compiled circuit
+		self.entries = collections.OrderedDict()
+		# key: event set when the compile in progress finishes
+		self.inflight = {}
+		self.settings = json.dumps(compiler.settings(), sort_keys=True,
+								   default=str)
+		self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'failures': 0,
+					  'compile_time': 0.0}
+
+	def key(self, qasm):
+		h = hashlib.sha256(normalize_qasm(qasm).encode('utf-8'))
+		h.update(self.settings.encode('utf-8'))
+		return h.hexdigest()
+
+	def compile(self, qasm):
+		"""
+		Return the compiled circuit, compiling it if it isn't cached
+		"""
+		if self.max_entries <= 0:
+			return self.__compile(qasm)
+		key = self.key(qasm)
+		while True:
+			with self.lock:
+				compiled = self.entries.get(key)
+				if compiled is not None:
+					self.entries.move_to_end(key)
+					self.stats['hits'] += 1
+					return compiled
+				event = self.inflight.get(key)
+				if not event:
+					self.stats['misses'] += 1
+					self.inflight[key] = threading.Event()
+					break
+			# compiled by another thread. Check again, it may have failed
+			event.wait()
+		try:
+			compiled = self.__compile(qasm)
+			with self.lock:
+				self.entries[key] = compiled
+				while len(self.entries) > self.max_entries:
+					self.entries.popitem(last=False)
+					self.stats['evictions'] += 1
+			return compiled
+		finally:
+			with self.lock:
+				self.inflight.pop(key).set()
+
+	def __compile(self, qasm):
+		start = time.time()
+		try:
+			compiled = self.compiler.compile(qasm, self.compiler.accelerator())
+		except Exception as e:
+			with self.lock:
+				self.stats['failures'] += 1
+			raise e
+		with self.lock:
+			self.stats['compile_time'] += time.time() - start
+		return compiled
+
+	def get_stats(self):
+		with self.lock:
+			stats = dict(self.stats)
+			stats['entries'] = len(self.entries)
+			lookups = stats['hits'] + stats['misses']
+			stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+			return stats
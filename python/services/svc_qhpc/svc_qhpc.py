@@ -1,24 +1,47 @@
 from defw_agent_info import *
 from defw_util import prformat, fg, bg
 from defw import me
-import logging, uuid, time, queue, threading, logging
-from defw_exception import DEFwError
+import logging, uuid, time, queue, threading, logging, os
+from defw_exception import DEFwError, DEFwNotFound, DEFwInProgress
+from util.qpm.util_cq import CompletionQueue
+from .svc_compile_cache import CompileCache, XaccCompiler
 
 CID_COUNTER = 0
 QCR_VERBOSE = 1
 
+# Threads executing circuits. Each has its own accelerator, and they
+# run concurrently since the execution releases the GIL.
+try:
+	NUM_EXECUTORS = int(os.environ['QFW_QHPC_EXECUTORS'])
+except:
+	NUM_EXECUTORS = 4
+
+# Threads compiling circuits ahead of their execution
+try:
+	NUM_COMPILERS = int(os.environ['QFW_QHPC_COMPILERS'])
+except:
+	NUM_COMPILERS = 1
+
+try:
+	ACCELERATOR = os.environ['QFW_QHPC_ACCELERATOR']
+except:
+	ACCELERATOR = 'tnqvm:exatn-mps'
+
+ACCELERATOR_PARAMS = {"shots": 2}
+COMPILER = 'staq'
+
 class CircuitStates:
 	UNDEF = 0
 	READY = 1
 	RUNNING = 2
 	DONE = 3
+	FAILED = 4
 
 class Circuit:
 	__state = 0    # Circuit state (enum of valid states)
 	__spec = None  # Circuit specification (qasm string)
 	__cid = -1     # Circuit id (uniq id)
 	qasm = None
-	qpu = None
 	qubitReg = None
 	compiler = None
 	compiled_circuit = None
@@ -27,11 +50,18 @@ class Circuit:
 	def __init__(self):
 		self.__state = CircuitStates.UNDEF
 		self.__spec  = None
-		self.qpu = None
 		self.qubitReg = None
 		self.compiler = None
 		self.compiled_circuit = None
 		self.nbits = 0
+		# set once compiled, or once compiling failed
+		self.compiled = threading.Event()
+		self.error = None
+		# run requested before the circuit was compiled
+		self.run_pending = False
+		# queued or running. A circuit runs once at a time.
+		self.inflight = False
+		self.lock = threading.Lock()
 
 	def getState(self):
 		return self.__state
@@ -52,6 +82,9 @@ class Circuit:
 	def set_done(self):
 		return self.setState(CircuitStates.DONE)
 
+	def set_failed(self):
+		return self.setState(CircuitStates.FAILED)
+
 	def getCirSpec(self):
 		return self.__circuit_spec
 
@@ -69,68 +102,137 @@ class Circuit:
 			return 'RUNNING'
 		if self.__state == CircuitStates.DONE:
 			return 'DONE'
+		if self.__state == CircuitStates.FAILED:
+			return 'FAILED'
+		if self.__state == CircuitStates.UNDEF:
+			return 'COMPILING'
 
 		return 'BUG'
 
 class Qhpc:
-	def __init__(self, start=True):
+	"""
+	Compiles and runs circuits with XACC. Circuits are compiled by a
+	pool of compiler threads as soon as they're created, and executed by
+	a pool of executor threads once compiled, so compiling a circuit
+	overlaps with running the ones before it.
+	"""
+	def __init__(self, start=True, num_executors=NUM_EXECUTORS,
+				 num_compilers=NUM_COMPILERS, compiler=None):
+		if not compiler:
+			compiler = XaccCompiler(ACCELERATOR, ACCELERATOR_PARAMS, COMPILER)
+		self.compiler = compiler
+		self.compile_cache = CompileCache(compiler)
 		self.circuits = {}
+		self.circuits_lock = threading.Lock()
+		self.compile_queue = queue.Queue()
 		self.runner_queue = queue.Queue()
-		self.circuit_results = []
-		if start:
-			self.runner = threading.Thread(target=self.runner, args=())
-			self.runner.start()
+		self.cq = CompletionQueue()
 		self.runner_shutdown = False
+		self.num_executors = num_executors
+		self.num_compilers = num_compilers
+		self.threads = []
+		if start:
+			for i in range(num_compilers):
+				self.start_thread(self.compiler_thr, i)
+			for i in range(num_executors):
+				self.start_thread(self.executor_thr, i)
 
 	def __del__(self):
+		self.shutdown()
+
+	def start_thread(self, target, i):
+		thr = threading.Thread(target=target, args=(i,), daemon=True)
+		thr.start()
+		self.threads.append(thr)
+
+	def shutdown(self):
 		self.runner_shutdown = True
-		self.runner_queue.put(-1)
+		for i in range(len(self.threads)):
+			self.compile_queue.put(None)
+			self.runner_queue.put(None)
+
+	def compiler_thr(self, i):
+		logging.debug(f"starting Qhpc compiler {i}")
+		while not self.runner_shutdown:
+			try:
+				cid = self.compile_queue.get(timeout=1)
+			except queue.Empty:
+				continue
+			if cid is None:
+				break
+			self.compile_circuit(cid)
 
-	def runner(self):
-		logging.debug("starting Qhpc main loop")
+	def executor_thr(self, i):
+		logging.debug(f"starting Qhpc executor {i}")
 		while not self.runner_shutdown:
 			try:
 				cid = self.runner_queue.get(timeout=1)
-				if cid == -1:
-					self.runner_shutdown = True
-					continue
 			except queue.Empty:
 				continue
-			result = self.run_circuit(cid)
-			r = {'cid': cid, 'result': result}
-			self.circuit_results.append(r)
+			if cid is None:
+				break
+			try:
+				r = {'cid': cid, 'result': self.run_circuit(cid), 'rc': 0}
+			except Exception as e:
+				logging.critical(f"circuit {cid} failed: {e}")
+				r = {'cid': cid, 'result': str(e), 'rc': -1}
+			circuit = self.__find_circuit(cid)
+			if not circuit:
+				self.cq.put(r)
+				continue
+			# the result is visible before the circuit can run again
+			with circuit.lock:
+				self.cq.put(r)
+				circuit.inflight = False
+
+	def compile_circuit(self, cid):
+		circuit = self.__find_circuit(cid)
+		if not circuit:
+			# deleted before it was compiled
+			return
+		logging.debug(f"Start circuit compile at: {time.monotonic_ns()}")
+		try:
+			# executed on the accelerator of the executor thread
+			circuit.compiled_circuit = self.compile_cache.compile(circuit.qasm)
+			circuit.set_ready()
+		except Exception as e:
+			logging.critical(f"circuit {cid} failed to compile: {e}")
+			circuit.error = e
+			circuit.set_failed()
+		logging.debug(f"Finished circuit compile at: {time.monotonic_ns()}")
+		with circuit.lock:
+			circuit.compiled.set()
+			pending = circuit.run_pending
+			circuit.run_pending = False
+		# a run requested while compiling can go now
+		if pending:
+			self.runner_queue.put(cid)
 
 	def read_cq(self, cid=None):
-		if cid:
-			i = 0
-			for e in self.circuit_results:
-				if cid == e['cid']:
-					r = self.circuit.pop(i)
-					return r
-				i += 1
-		else:
-			if len(self.circuit_results) > 0:
-				r = self.circuit_results.pop(0)
-				return r
-		return None
+		return self.cq.read(cid)
 
 	def peek_cq(self, cid=None):
-		if cid:
-			for e in self.circuit_results:
-				if cid == e['cid']:
-					return e
-		else:
-			if len(self.circuit_results) > 0:
-				return self.circuit_results[0]
-		return None
+		return self.cq.peek(cid)
+
+	def wait_cq(self, cid=None, timeout=None):
+		return self.cq.wait(cid, timeout=timeout)
 
 	def status(self):
 		logging.debug("Querying Status of Circuits")
 		r = {}
-		for k, v in self.circuits.items():
-			r[k] = v.status()
+		with self.circuits_lock:
+			for k, v in self.circuits.items():
+				r[k] = v.status()
 		return r
 
+	def get_stats(self):
+		return {'executors': self.num_executors,
+				'compilers': self.num_compilers,
+				'compiling': self.compile_queue.qsize(),
+				'queued': self.runner_queue.qsize(),
+				'completed': len(self.cq),
+				'compile_cache': self.compile_cache.get_stats()}
+
 	def query(self):
 		from . import svc_info
 		cap = Capability("QuantumSim", "Quantum HPC Simulator", 1)
@@ -139,40 +241,56 @@ class Qhpc:
 						  self.__class__.__module__, [svc])
 		return info
 
-	def reserve(self, svc, client_ep, *args, **kwargs):
+	@classmethod
+	def reserve(cls, svc, client_ep, *args, **kwargs):
 		logging.debug(f"{client_ep} reserved the {svc}")
 
 	def release(self, services):
-		self.runner_shutdown = True
+		self.shutdown()
 
 	def __find_circuit(self, cid):
-		if cid in self.circuits:
-			return self.circuits[cid]
-		return None
+		with self.circuits_lock:
+			return self.circuits.get(cid)
+
+	def __claim_run(self, cid, queue_run):
+		"""
+		Mark the circuit as running. A circuit which is queued, running
+		or whose result hasn't been read can't be run again. Returns the
+		circuit, and whether it can be queued now or is queued once
+		compiled.
+		"""
+		circuit = self.__find_circuit(cid)
+		if not circuit:
+			raise DEFwNotFound(f"Got circuit {cid} does not exist in database")
+		with circuit.lock:
+			if circuit.inflight or self.cq.peek(cid):
+				raise DEFwInProgress(f"Circuit {cid} is already running or its result wasn't read")
+			circuit.inflight = True
+			if queue_run and not circuit.compiled.is_set():
+				circuit.run_pending = True
+				return circuit, False
+		return circuit, True
 
 	def create_circuit(self, qasm, nbits=1, endpoint=None):
-		import xacc
+		"""
+		Create a circuit and queue it for compilation. Returns right
+		away, the circuit runs once it's compiled.
+		"""
 		cid = str(uuid.uuid4())
-		self.circuits[cid] = Circuit()
-		self.circuits[cid].qasm = qasm
-		circuit = self.circuits[cid]
-
-		logging.debug(f"Start circuit compile at: {time.monotonic_ns()}")
-		circuit.qpu = xacc.getAccelerator("tnqvm:exatn-mps", {"shots":2})
-		compiler = xacc.getCompiler('staq')
-		circuit.compiled_circuit = compiler.compile(circuit.qasm,
-													circuit.qpu)
+		circuit = Circuit()
+		circuit.qasm = qasm
 		circuit.nbits = nbits
-		logging.debug(f"Finished circuit compile at: {time.monotonic_ns()}")
-		circuit.set_ready()
-
+		with self.circuits_lock:
+			self.circuits[cid] = circuit
+		if self.threads:
+			self.compile_queue.put(cid)
+		else:
+			self.compile_circuit(cid)
 		return cid
 
 	def delete_circuit(self, cid):
-		try:
-			del self.circuits[cid]
-		except:
-			pass
+		with self.circuits_lock:
+			self.circuits.pop(cid, None)
 
 	def run_circuit(self, cid):
 		"""
@@ -181,25 +299,31 @@ class Qhpc:
 		 Description: Run a circuit synchronously. Return the event object.
 		"""
 		# sanity check
-		import xacc
 		circuit = self.__find_circuit(cid)
 		if not circuit:
-			raise DEFwError(f"Got circuit {cid} does not exist in database")
+			raise DEFwNotFound(f"Got circuit {cid} does not exist in database")
+
+		circuit.compiled.wait()
+		if circuit.error:
+			raise DEFwError(f"Circuit {cid} failed to compile: {circuit.error}")
 
 		circuit.set_running()
 
 		if QCR_VERBOSE:
 			logging.debug(f"  DBG: qalloc {circuit.nbits} nbits")
-		qubitReg = xacc.qalloc(circuit.nbits)
+		qubitReg = self.compiler.qalloc(circuit.nbits)
 
 		if QCR_VERBOSE:
 			logging.debug(f"  DBG: compiled circuit {circuit.compiled_circuit} here")
-		c = circuit.compiled_circuit
+		# compiled circuits are shared through the compile cache, so
+		# every execution gets its own copy
+		program = self.compiler.program(circuit.compiled_circuit, circuit.qasm)
 
 		if QCR_VERBOSE:
 			logging.debug(f"  DBG: execute circuit now")
 		logging.debug(f"Start circuit execution at: {time.monotonic_ns()}")
-		circuit.qpu.executeWithoutGIL(qubitReg, c.getComposites()[0])
+		# every thread executes on its own accelerator
+		self.compiler.accelerator().executeWithoutGIL(qubitReg, program)
 		logging.debug(f"Finish circuit execution at: {time.monotonic_ns()}")
 
 		if QCR_VERBOSE:
@@ -222,8 +346,16 @@ class Qhpc:
 		return results
 
 	def sync_run(self, cid):
-		return self.run_circuit(cid)
+		circuit, ready = self.__claim_run(cid, False)
+		try:
+			return self.run_circuit(cid)
+		finally:
+			with circuit.lock:
+				circuit.inflight = False
 
 	def async_run(self, cid):
-		return self.runner_queue.put(cid)
-
+		# circuits still compiling are queued when they're done, so the
+		# executors only pick up circuits they can run
+		circuit, ready = self.__claim_run(cid, True)
+		if ready:
+			self.runner_queue.put(cid)
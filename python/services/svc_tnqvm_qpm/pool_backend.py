@@ -0,0 +1,54 @@
+"""
+QRC runner pool backend for TNQVM. See util_runner_worker.py.
+
+Runs circuits through the XACC python bindings on the TNQVM
+accelerator, like circuit_runner.tnqvm does, but keeps XACC and the
+accelerators loaded between circuits. Only single process circuits are
+sent to the pool. The result is the buffer's document circuit_runner.tnqvm
+writes to <qasm>.result.r0, so both paths return the same structure.
+
+Like the worker, this runs outside of the DEFw process, so it only
+depends on the standard library and XACC.
+"""
+
+import os, json
+
+try:
+	ACCELERATOR = os.environ['QFW_TNQVM_POOL_ACCELERATOR']
+except:
+	ACCELERATOR = 'tnqvm:exatn-mps'
+
+DEFAULT_COMPILER = 'staq'
+
+xacc = None
+# (shots): accelerator
+accelerators = {}
+# name: compiler
+compilers = {}
+
+def setup():
+	global xacc
+	import xacc as xacc_module
+	xacc = xacc_module
+
+def get_accelerator(shots):
+	if shots not in accelerators:
+		accelerators[shots] = xacc.getAccelerator(ACCELERATOR, {'shots': shots})
+	return accelerators[shots]
+
+def get_compiler(name):
+	if name not in compilers:
+		compilers[name] = xacc.getCompiler(name)
+	return compilers[name]
+
+def run(qasm_file, info):
+	if qasm_file:
+		with open(qasm_file, 'r') as f:
+			qasm = f.read()
+	else:
+		qasm = info['qasm']
+	qpu = get_accelerator(int(info['num_shots']))
+	compiled = get_compiler(info.get('compiler', DEFAULT_COMPILER)).compile(qasm, qpu)
+	buf = xacc.qalloc(int(info['num_qubits']))
+	qpu.execute(buf, compiled.getComposites()[0])
+	return json.loads(str(buf))
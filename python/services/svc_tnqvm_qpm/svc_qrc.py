@@ -1,71 +1,28 @@
 from defw_agent_info import *
 from defw_util import prformat, fg, bg
 from defw import me
-import logging, uuid, time, queue, threading, sys, os, io, contextlib
-import importlib, yaml, copy, subprocess, traceback
-from defw_exception import DEFwExecutionError, DEFwInProgress
+import logging, uuid, queue, threading, sys, os, io, contextlib
+import importlib, copy, subprocess, traceback
+from defw_exception import DEFwExecutionError
 from util.qpm.util_qrc import UTIL_QRC
+from util.qpm.util_ingest import load_result
 
 sys.path.append(os.path.split(os.path.abspath(__file__))[0])
 
 class QRC(UTIL_QRC):
+	RESULT_SUFFIXES = ['.result.r0']
+	POOL_BACKEND = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+								'pool_backend.py')
+
 	def __init__(self, start=True):
 		super().__init__(start=start)
 
-	def check_active_tasks(self, wid):
-		complete = []
-		for task_info in self.worker_pool[wid]['active_tasks']:
-			try:
-				stdout, stderr, rc = task_info['launcher'].status(task_info['pid'])
-			except DEFwInProgress:
-				logging.debug(f"{task_info} still in progress")
-				continue
-			except Exception as e:
-				raise e
-			logging.debug(f"{task_info} completed")
-			complete.append(task_info)
-			circ = task_info['circ']
-			cid = circ.get_cid()
-			qasm_file = task_info['qasm_file']
-			if not rc:
-				logging.debug(f"Circuit {cid} successful")
-				try:
-					output_file = qasm_file+".result.r0"
-					with open(output_file, 'r') as f:
-						output = f.read()
-						output = yaml.safe_load(output)
-					os.remove(output_file)
-					circ.set_exec_done()
-				except Exception as e:
-					output = "{result: missing, exception: "+ f"{e}" + "}"
-					circ.set_fail()
-			else:
-				stdout = stdout.decode('utf-8')
-				stderr = stderr.decode('utf-8')
-				res = stdout + '\n' + stderr
-				output = "{result: "+ f"{res}" + "}"
-				circ.set_fail()
-
-			try:
-				os.remove(qasm_file)
-			except:
-				pass
-
-			r = {'cid': cid,
-				 'result': output,
-				 'rc': rc,
-				 'launch_time': circ.launch_time,
-				 'creation_time': circ.creation_time,
-				 'exec_time': circ.exec_time,
-				 'completion_time': circ.completion_time,
-				 'resources_consumed_time': circ.resources_consumed_time,
-				 'cq_enqueue_time': time.time(),
-				 'cq_dequeue_time': -1 }
-			with self.circuit_results_lock:
-				self.circuit_results.append(r)
-
-		for task_info in complete:
-			self.worker_pool[wid]['active_tasks'].remove(task_info)
+	def read_output(self, task_info, stdout):
+		output_file = task_info['qasm_file']+self.RESULT_SUFFIXES[0]
+		with open(output_file, 'r') as f:
+			output = load_result(f.read())
+		os.remove(output_file)
+		return output
 
 	def form_cmd(self, circ, qasm_file):
 		import shutil
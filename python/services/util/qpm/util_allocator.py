@@ -0,0 +1,236 @@
+from defw_util import expand_host_list
+from defw_exception import DEFwError, DEFwOutOfResources
+import logging, threading, os
+
+# Allocation policy used by the QPM. One of ALLOC_POLICIES.
+try:
+	ALLOC_POLICY = os.environ['QFW_QPM_ALLOC_POLICY']
+except:
+	ALLOC_POLICY = 'first_fit'
+
+# Hosts sharing a rack/switch. Allocations spanning hosts are kept
+# within a group when possible. The format is:
+#	group1=host[01-04];group2=host[05-08],other
+try:
+	HOST_GROUPS = os.environ['QFW_QPM_HOST_GROUPS']
+except:
+	HOST_GROUPS = ''
+
+def parse_host_groups(spec):
+	groups = {}
+	if not spec:
+		return groups
+	for entry in spec.split(';'):
+		if not entry.strip():
+			continue
+		name, sep, hosts = entry.partition('=')
+		if not sep:
+			raise DEFwError(f"Bad host group {entry}. Expected <group>=<hosts>")
+		groups[name.strip()] = expand_host_list(hosts.strip())
+	return groups
+
+class Allocator:
+	"""
+	Hands out slots from a host: free slots map. The map is updated in
+	place so the owner can keep on reading it.
+
+	Subclasses override plan(np, hosts) which returns host: slots
+	taken from the hosts given, or None if they don't fit. The default
+	plan is first fit.
+	"""
+	# Try the fullest groups first to keep the emptier ones available
+	# for larger requests
+	FULLEST_GROUP_FIRST = True
+
+	def __init__(self, free_hosts, max_ppn, groups=None):
+		self.free_hosts = free_hosts
+		self.capacity = dict(free_hosts)
+		self.max_ppn = max_ppn
+		self.lock = threading.Lock()
+		self.groups = []
+		grouped = set()
+		for name, hosts in (groups or {}).items():
+			members = [h for h in hosts if h in free_hosts]
+			if members:
+				self.groups.append(members)
+				grouped.update(members)
+		# hosts which aren't in any group are each a group of their own
+		for h in free_hosts.keys():
+			if h not in grouped:
+				self.groups.append([h])
+		self.stats = {'allocations': 0, 'failures': 0}
+
+	def plan(self, np, hosts):
+		# walk the hosts in order, taking whatever is free
+		return self.take_in_order(np, hosts)
+
+	def __plan_locked(self, np, plan):
+		# prefer fitting in a single group
+		if len(self.groups) > 1:
+			candidates = []
+			for g in self.groups:
+				free = sum(self.free_hosts[h] for h in g)
+				if free >= np:
+					candidates.append((free, g))
+			candidates.sort(key=lambda c: c[0],
+							reverse=not self.FULLEST_GROUP_FIRST)
+			for free, g in candidates:
+				alloc = plan(np, g)
+				if alloc:
+					return alloc
+		return plan(np, list(self.free_hosts.keys()))
+
+	def allocate(self, np, placement=None):
+		"""
+		placement names one of ALLOC_POLICIES to use for this allocation
+		instead of the configured policy.
+		"""
+		plan = self.plan
+		if placement in ALLOC_POLICIES:
+			plan = ALLOC_POLICIES[placement].plan.__get__(self)
+		with self.lock:
+			if np > sum(self.capacity.values()):
+				self.stats['failures'] += 1
+				raise DEFwOutOfResources(f"{np} slots requested. Only " \
+						f"{sum(self.capacity.values())} configured")
+			alloc = None
+			if np <= sum(self.free_hosts.values()):
+				alloc = self.__plan_locked(np, plan)
+			if not alloc:
+				self.stats['failures'] += 1
+				raise DEFwOutOfResources(f"Not enough slots to run simulation" \
+						f" Available resources = {np}:{self.free_hosts}")
+			for h, n in alloc.items():
+				self.free_hosts[h] -= n
+			self.stats['allocations'] += 1
+			return alloc
+
+	def release(self, alloc):
+		with self.lock:
+			for h, n in alloc.items():
+				if h not in self.free_hosts:
+					raise DEFwError(f"Circuit has untracked host: {h}")
+				if self.free_hosts[h] + n > self.capacity[h]:
+					raise DEFwError("Returning more resources than originally had")
+			for h, n in alloc.items():
+				self.free_hosts[h] += n
+
+	def fragmentation(self):
+		"""
+		Fraction of the free slots which sit on partially used hosts.
+		0 means all the free slots are on idle hosts.
+		"""
+		with self.lock:
+			free = sum(self.free_hosts.values())
+			if not free:
+				return 0.0
+			partial = sum(n for h, n in self.free_hosts.items()
+						  if 0 < n < self.capacity[h])
+			return partial / free
+
+	def free_slots(self):
+		with self.lock:
+			return sum(self.free_hosts.values())
+
+	def utilization(self):
+		with self.lock:
+			total = sum(self.capacity.values())
+			return 1 - sum(self.free_hosts.values()) / total if total else 0.0
+
+	def get_stats(self):
+		stats = dict(self.stats)
+		stats['fragmentation'] = self.fragmentation()
+		stats['utilization'] = self.utilization()
+		return stats
+
+	def take_in_order(self, np, hosts):
+		alloc = {}
+		for h in hosts:
+			if not np:
+				break
+			n = min(self.free_hosts[h], np)
+			if n:
+				alloc[h] = n
+				np -= n
+		if np:
+			return None
+		return alloc
+
+class FirstFitAllocator(Allocator):
+	# the default plan
+	pass
+
+class BestFitAllocator(Allocator):
+	"""
+	Whole idle hosts for the multiples of max_ppn, then the host whose
+	free slots fit the remainder most tightly.
+	"""
+	def plan(self, np, hosts):
+		alloc = {}
+		whole = np // self.max_ppn
+		if whole:
+			idle = [h for h in hosts
+					if self.free_hosts[h] == self.capacity[h] and
+					   self.free_hosts[h] >= self.max_ppn]
+			if len(idle) >= whole:
+				for h in idle[:whole]:
+					alloc[h] = self.max_ppn
+				np -= whole * self.max_ppn
+		if np:
+			fits = [h for h in hosts if h not in alloc and
+					self.free_hosts[h] >= np]
+			if fits:
+				h = min(fits, key=lambda h: self.free_hosts[h])
+				alloc[h] = np
+				np = 0
+		if np:
+			# doesn't align. Fill the fullest hosts first
+			rest = sorted([h for h in hosts if h not in alloc],
+						  key=lambda h: self.free_hosts[h])
+			more = self.take_in_order(np, rest)
+			if not more:
+				return None
+			alloc.update(more)
+		return alloc
+
+class PackAllocator(Allocator):
+	# fill up the most used hosts first
+	def plan(self, np, hosts):
+		hosts = sorted([h for h in hosts if self.free_hosts[h]],
+					   key=lambda h: self.free_hosts[h])
+		return self.take_in_order(np, hosts)
+
+class SpreadAllocator(Allocator):
+	# one slot at a time over the least used hosts
+	FULLEST_GROUP_FIRST = False
+
+	def plan(self, np, hosts):
+		free = {h: self.free_hosts[h] for h in hosts if self.free_hosts[h]}
+		if sum(free.values()) < np:
+			return None
+		alloc = {}
+		while np:
+			for h in sorted(free.keys(), key=lambda h: -free[h]):
+				if not np:
+					break
+				if not free[h]:
+					continue
+				alloc[h] = alloc.get(h, 0) + 1
+				free[h] -= 1
+				np -= 1
+		return alloc
+
+ALLOC_POLICIES = {'first_fit': FirstFitAllocator,
+				  'best_fit': BestFitAllocator,
+				  'pack': PackAllocator,
+				  'spread': SpreadAllocator}
+
+def make_allocator(free_hosts, max_ppn, policy=None, groups=None):
+	if policy is None:
+		policy = ALLOC_POLICY
+	if groups is None:
+		groups = parse_host_groups(HOST_GROUPS)
+	if policy not in ALLOC_POLICIES:
+		logging.critical(f"Unknown allocation policy {policy}. Using first_fit")
+		policy = 'first_fit'
+	return ALLOC_POLICIES[policy](free_hosts, max_ppn, groups=groups)
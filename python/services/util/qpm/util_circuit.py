@@ -1,16 +1,87 @@
 from defw_agent_info import *
 from defw_util import round_half_up, round_to_nearest_power_of_two
-import logging, os, time
+from .util_qasm import ANALYZE_QASM, CostModel, analyze_qasm
+import logging, os, time, threading, hashlib, collections, copy
 
 # Maximum number of processes per node
 MAX_PPN = 8
 # Maximum number of qubits per process
 MAX_QUBITS_PP = 10
+# Maximum number of processes a circuit can use. 0 is unlimited
+MAX_NP = 0
 
 def set_max_ppn(ppn):
 	global MAX_PPN
 	MAX_PPN = ppn
 
+def set_max_np(np):
+	global MAX_NP
+	MAX_NP = np
+
+# Number of QASM analyses kept, keyed by the hash of the QASM, so
+# circuits submitted again aren't analyzed on every create. 0 disables
+# the cache.
+try:
+	ANALYSIS_CACHE_SIZE = int(os.environ['QFW_QPM_ANALYSIS_CACHE_SIZE'])
+except:
+	ANALYSIS_CACHE_SIZE = 1024
+
+class AnalysisCache:
+	"""
+	LRU cache of circuit analyses keyed by the hash of the QASM and the
+	cost model limits
+	"""
+	def __init__(self, max_entries=ANALYSIS_CACHE_SIZE):
+		self.max_entries = max_entries
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.stats = {'hits': 0, 'misses': 0, 'analysis_time': 0.0}
+
+	def analyze(self, qasm, max_qubits, max_np):
+		if self.max_entries <= 0:
+			return self.__analyze(qasm, max_qubits, max_np)
+		key = (hashlib.sha256(qasm.encode('utf-8')).hexdigest(),
+			   max_qubits, max_np)
+		with self.lock:
+			analysis = self.entries.get(key)
+			if analysis is not None:
+				self.entries.move_to_end(key)
+				self.stats['hits'] += 1
+				return copy.deepcopy(analysis)
+			self.stats['misses'] += 1
+		analysis = self.__analyze(qasm, max_qubits, max_np)
+		with self.lock:
+			self.entries[key] = analysis
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+		return copy.deepcopy(analysis)
+
+	def __analyze(self, qasm, max_qubits, max_np):
+		start = time.time()
+		analyzer = analyze_qasm(qasm)
+		analysis = analyzer.features()
+		analysis.update(CostModel(max_qubits, max_np).plan(analyzer))
+		with self.lock:
+			self.stats['analysis_time'] += time.time() - start
+		return analysis
+
+	def get_stats(self):
+		with self.lock:
+			stats = dict(self.stats)
+			stats['entries'] = len(self.entries)
+			return stats
+
+analysis_cache = AnalysisCache()
+
+def analyze_circuit(qasm, max_qubits=None):
+	"""
+	Analyze the QASM of a circuit and plan its run. Returns the circuit
+	features together with the plan of the cost model.
+	"""
+	if max_qubits is None:
+		max_qubits = MAX_QUBITS_PP
+	return analysis_cache.analyze(qasm, max_qubits, MAX_NP)
+
 def set_max_qubits_pp(max_qubits):
 	global MAX_QUBITS_PP
 	logging.debug(f"set_max_qubits_pp({max_qubits})")
@@ -79,16 +150,39 @@ class Circuit:
 		self.info['qfw_dvm_uri_path'] = \
 				f"file:{os.environ['QFW_DVM_URI_PATH']}"
 
-		# each 10 qubits requires 1 node added to the simulation
-		np = round_half_up(self.info['num_qubits'] / max_qubits)
-		if np < 1:
-			np = 1
-		else:
-			np = round_to_nearest_power_of_two(np)
+		np = None
+		if ANALYZE_QASM and 'qasm' in self.info:
+			np = self.analyze(max_qubits)
+
+		if np is None:
+			# each 10 qubits requires 1 node added to the simulation
+			np = round_half_up(self.info['num_qubits'] / max_qubits)
+			if np < 1:
+				np = 1
+			else:
+				np = round_to_nearest_power_of_two(np)
 		self.info['np'] = np
 		logging.debug(f"Setting number of processes to: {self.info['np']} " \
 					  f"for num qubits: {self.info['num_qubits']}")
 
+	def analyze(self, max_qubits):
+		# shards of a circuit reuse its analysis
+		if 'parent_cid' in self.info and 'analysis' in self.info:
+			return self.info['analysis']['np']
+		try:
+			analysis = analyze_circuit(self.info['qasm'], max_qubits)
+		except Exception as e:
+			logging.debug(f"{self.__cid}: QASM analysis failed: {e}")
+			return None
+		if analysis['num_qubits'] != self.info.get('num_qubits'):
+			logging.debug(f"{self.__cid}: client specified " \
+				f"{self.info.get('num_qubits')} qubits. QASM uses {analysis['num_qubits']}")
+			self.info['num_qubits'] = analysis['num_qubits']
+		self.info['analysis'] = analysis
+		if analysis['placement'] and 'placement' not in self.info:
+			self.info['placement'] = analysis['placement']
+		return analysis['np']
+
 	def getState(self):
 		return self.__state
 
@@ -0,0 +1,92 @@
+import threading, time, collections
+
+class CompletionQueue:
+	"""
+	Completed circuit results indexed by cid. Anonymous reads return the
+	results in completion order. Readers can block until the result
+	they're interested in is available.
+	"""
+	def __init__(self):
+		self.__results = collections.OrderedDict()
+		self.__cond = threading.Condition()
+		self.__closed = False
+
+	def __len__(self):
+		with self.__cond:
+			return len(self.__results)
+
+	def __pop_locked(self, cid=None):
+		if cid:
+			r = self.__results.pop(cid, None)
+		elif self.__results:
+			cid, r = self.__results.popitem(last=False)
+		else:
+			r = None
+		if r:
+			r['cq_dequeue_time'] = time.time()
+		return r
+
+	def __ready_locked(self, cid=None):
+		if cid:
+			return cid in self.__results
+		return len(self.__results) > 0
+
+	def put(self, r):
+		with self.__cond:
+			self.__results[r['cid']] = r
+			self.__cond.notify_all()
+
+	def read(self, cid=None):
+		with self.__cond:
+			return self.__pop_locked(cid)
+
+	def peek(self, cid=None):
+		with self.__cond:
+			if cid:
+				return self.__results.get(cid, None)
+			if self.__results:
+				return next(iter(self.__results.values()))
+		return None
+
+	def wait(self, cid=None, timeout=None):
+		"""
+		Wait up to timeout seconds for the result of cid, or for any
+		result if cid is None. Returns None if the timeout expires.
+		"""
+		with self.__cond:
+			self.__cond.wait_for(lambda: self.__closed or
+								 self.__ready_locked(cid), timeout=timeout)
+			return self.__pop_locked(cid)
+
+	def read_many(self, max_n, timeout=0):
+		"""
+		Read up to max_n results in completion order. If none are
+		available wait up to timeout seconds for the first one.
+		"""
+		with self.__cond:
+			if timeout:
+				self.__cond.wait_for(lambda: self.__closed or
+									 self.__ready_locked(), timeout=timeout)
+			results = []
+			while self.__results and len(results) < max_n:
+				results.append(self.__pop_locked())
+			return results
+
+	def read_batch(self, cids, timeout=0):
+		"""
+		Read the results of cids which are available, in the order of
+		cids. Waits up to timeout seconds for all of them to complete.
+		"""
+		with self.__cond:
+			if timeout:
+				self.__cond.wait_for(lambda: self.__closed or
+						all(cid in self.__results for cid in cids),
+						timeout=timeout)
+			return [self.__pop_locked(cid) for cid in cids
+					if cid in self.__results]
+
+	def close(self):
+		# wake up all the waiters
+		with self.__cond:
+			self.__closed = True
+			self.__cond.notify_all()
@@ -0,0 +1,151 @@
+from defw_exception import DEFwRetryLater, DEFwOutOfResources
+import threading, time, os
+
+# Circuits each client can have outstanding. A credit is taken when a
+# circuit is submitted and returned when it completes. 0 disables the
+# flow control.
+try:
+	CREDIT_WINDOW = int(os.environ['QFW_QPM_CREDIT_WINDOW'])
+except:
+	CREDIT_WINDOW = 16384
+
+# Seconds a submission waits for credits before failing with
+# DEFwRetryLater. 0 fails right away. The wait blocks the RPC thread
+# handling the submission, and so the client making it.
+try:
+	CREDIT_WAIT = float(os.environ['QFW_QPM_CREDIT_WAIT'])
+except:
+	CREDIT_WAIT = 0
+
+# Weight of the latest interval in the average time between returned
+# credits, which the retry-after hint is based on
+RETURN_ALPHA = 0.2
+MIN_RETRY_AFTER = 0.01
+
+# Windows given to clients when they reserve the QPM, keyed by client
+# id (see client_id()). The reservation is served by a different
+# instance than the one running the circuits, so they are kept at
+# module level.
+client_windows = {}
+
+def client_id(ep):
+	"""
+	Credits are charged to the endpoint making the request. Calls which
+	don't come over RPC share the 'local' client.
+	"""
+	if ep is None:
+		return 'local'
+	return str(ep.get_id())
+
+def set_client_window(client, window=None, wait=None):
+	entry = client_windows.setdefault(client, {})
+	if window is not None:
+		entry['window'] = int(window)
+	if wait is not None:
+		entry['wait'] = float(wait)
+
+class ClientCredits:
+	def __init__(self):
+		self.outstanding = 0
+		self.rejected = 0
+		self.last_return = None
+		self.return_interval = None
+
+class CreditManager:
+	"""
+	Per client windows of outstanding circuits. acquire() takes credits
+	before circuits are created, and release() gives one back when a
+	circuit completes or is deleted.
+	"""
+	def __init__(self, window=CREDIT_WINDOW, wait=CREDIT_WAIT):
+		self.window = window
+		self.wait = wait
+		self.cond = threading.Condition()
+		self.clients = {}
+		# cid: client holding its credit
+		self.held = {}
+
+	def __client_locked(self, client):
+		if client not in self.clients:
+			self.clients[client] = ClientCredits()
+		return self.clients[client]
+
+	def client_window(self, client):
+		return client_windows.get(client, {}).get('window', self.window)
+
+	def client_wait(self, client):
+		return client_windows.get(client, {}).get('wait', self.wait)
+
+	def retry_after(self, client, n):
+		c = self.clients[client]
+		if c.return_interval is None:
+			return 1.0
+		return max(c.return_interval * n, MIN_RETRY_AFTER)
+
+	def acquire(self, client, n=1, max_wait=None):
+		"""
+		Take n credits for client, waiting up to the client's wait time
+		(capped to max_wait) for them. Raises DEFwRetryLater with a
+		retry-after hint in seconds if they don't come back in time,
+		and DEFwOutOfResources if n is more than the whole window.
+		Returns False if the client has no window.
+		"""
+		window = self.client_window(client)
+		if window <= 0:
+			return False
+		if n > window:
+			raise DEFwOutOfResources(f"{n} circuits exceed the window of {window} of {client}")
+		wait = self.client_wait(client)
+		if max_wait is not None:
+			wait = min(wait, max_wait)
+		deadline = time.time() + wait
+		with self.cond:
+			c = self.__client_locked(client)
+			while c.outstanding + n > window:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					c.rejected += 1
+					retry = self.retry_after(client, c.outstanding + n - window)
+					raise DEFwRetryLater(f"{client} has {c.outstanding} of {window} circuits outstanding",
+										 arg={'retry_after': retry})
+				self.cond.wait(remaining)
+			c.outstanding += n
+		return True
+
+	def track(self, client, cids):
+		# bind the credits taken by acquire() to the circuits created
+		with self.cond:
+			for cid in cids:
+				self.held[cid] = client
+
+	def cancel(self, client, n=1):
+		# return credits which weren't bound to circuits
+		with self.cond:
+			c = self.__client_locked(client)
+			c.outstanding = max(c.outstanding - n, 0)
+			self.cond.notify_all()
+
+	def release(self, cid):
+		# safe to call more than once for the same circuit
+		with self.cond:
+			client = self.held.pop(cid, None)
+			if client is None:
+				return
+			c = self.__client_locked(client)
+			c.outstanding = max(c.outstanding - 1, 0)
+			now = time.time()
+			if c.last_return is not None:
+				interval = now - c.last_return
+				if c.return_interval is None:
+					c.return_interval = interval
+				else:
+					c.return_interval += RETURN_ALPHA * (interval - c.return_interval)
+			c.last_return = now
+			self.cond.notify_all()
+
+	def get_stats(self):
+		with self.cond:
+			return {client: {'outstanding': c.outstanding,
+							 'window': self.client_window(client),
+							 'rejected': c.rejected}
+					for client, c in self.clients.items()}
@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging, threading, time, json, os, yaml
+from .util_stats import RunningStats
+from defw_topology import unbind_thread
+
+# Threads parsing circuit results. 0 parses them on the runner threads.
+try:
+	INGEST_THREADS = int(os.environ['QFW_QRC_INGEST_THREADS'])
+except:
+	INGEST_THREADS = 2
+
+# LibYAML's loader when PyYAML was built with it
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def load_result(text, loader=SafeLoader):
+	"""
+	Parse a circuit result. JSON, which is also valid YAML, is parsed
+	with the json module. Anything else goes through loader.
+	"""
+	stripped = text.lstrip()
+	if stripped[:1] in ('{', '['):
+		try:
+			return json.loads(stripped)
+		except ValueError:
+			pass
+	return yaml.load(text, Loader=loader)
+
+class ResultIngest:
+	"""
+	Reads and parses circuit results on a pool of threads, so the QRC
+	runners only launch circuits and reap them. Keeps track of how long
+	results take to parse.
+	"""
+	def __init__(self, num_threads=INGEST_THREADS):
+		self.num_threads = num_threads
+		self.executor = None
+		if num_threads > 0:
+			# the threads are created by the (bound) runners. Don't
+			# keep them on the runner's CPU
+			self.executor = ThreadPoolExecutor(max_workers=num_threads,
+											   thread_name_prefix='qrc-ingest',
+											   initializer=unbind_thread)
+		self.lock = threading.Lock()
+		self.parse_stats = RunningStats()
+		self.pending = 0
+
+	def submit(self, fn, *args):
+		"""
+		Call fn(*args) on an ingest thread, or right away if there are
+		none.
+		"""
+		if not self.executor:
+			fn(*args)
+			return
+		with self.lock:
+			self.pending += 1
+		self.executor.submit(self.__run, fn, *args)
+
+	def __run(self, fn, *args):
+		try:
+			fn(*args)
+		except Exception as e:
+			logging.critical(f"Result ingest failed: {e}")
+		finally:
+			with self.lock:
+				self.pending -= 1
+
+	def timed(self, fn, *args):
+		start = time.perf_counter()
+		try:
+			return fn(*args)
+		finally:
+			elapsed = time.perf_counter() - start
+			with self.lock:
+				self.parse_stats.add(elapsed)
+
+	def get_metrics(self):
+		with self.lock:
+			metrics = {'threads': self.num_threads,
+					   'pending': self.pending,
+					   'libyaml': SafeLoader is not yaml.SafeLoader}
+			metrics['parse_time'] = self.parse_stats.summary()
+			return metrics
+
+	def shutdown(self):
+		# finishes the results already submitted
+		if self.executor:
+			self.executor.shutdown(wait=True)
@@ -0,0 +1,130 @@
+import logging, threading, time, os
+
+# Flush the buffered completions once that many are pending
+try:
+	PUSH_BATCH_SIZE = int(os.environ['QFW_QRC_PUSH_BATCH_SIZE'])
+except:
+	PUSH_BATCH_SIZE = 64
+
+# or once the oldest buffered completion has waited that many seconds
+try:
+	PUSH_WINDOW = float(os.environ['QFW_QRC_PUSH_WINDOW'])
+except:
+	PUSH_WINDOW = 0.005
+
+# Times a failed push is retried, and the delay before the first retry,
+# doubled on every retry. Events which still can't be pushed are handed
+# to the publisher's fallback.
+try:
+	PUSH_RETRIES = int(os.environ['QFW_QRC_PUSH_RETRIES'])
+except:
+	PUSH_RETRIES = 3
+
+PUSH_RETRY_DELAY = 0.05
+
+class CompletionPublisher:
+	"""
+	Pushes events to a client's BaseEventAPI from a dedicated sender
+	thread. Events are buffered and sent as a single put_batch() RPC
+	when batch_size of them are pending or the oldest one has been
+	waiting for window seconds, whichever comes first. Failed pushes are
+	retried with backoff, then the events are passed to fallback(events)
+	so they aren't lost.
+	"""
+	def __init__(self, event_api, batch_size=PUSH_BATCH_SIZE, window=PUSH_WINDOW,
+				 retries=PUSH_RETRIES, fallback=None):
+		self.event_api = event_api
+		self.batch_size = max(batch_size, 1)
+		self.window = window
+		self.retries = retries
+		self.fallback = fallback
+		self.__cond = threading.Condition()
+		self.__events = []
+		self.__oldest = None
+		self.__shutdown = False
+		self.__stats = {'events': 0, 'rpcs': 0, 'retries': 0, 'failures': 0,
+						'requeued': 0}
+		self.__sender = threading.Thread(target=self.sender_thr, args=())
+		self.__sender.daemon = True
+		self.__sender.start()
+
+	def put(self, event):
+		with self.__cond:
+			if not self.__events:
+				self.__oldest = time.monotonic()
+			self.__events.append(event)
+			if len(self.__events) >= self.batch_size or len(self.__events) == 1:
+				self.__cond.notify()
+
+	def __ready_locked(self):
+		if self.__shutdown or len(self.__events) >= self.batch_size:
+			return True
+		return self.__events and \
+			   time.monotonic() - self.__oldest >= self.window
+
+	def push(self, events):
+		if len(events) == 1:
+			self.event_api.put(events[0])
+		else:
+			self.event_api.put_batch(events)
+
+	def send(self, events):
+		delay = PUSH_RETRY_DELAY
+		for attempt in range(self.retries + 1):
+			try:
+				self.push(events)
+				with self.__cond:
+					self.__stats['events'] += len(events)
+					self.__stats['rpcs'] += 1
+				return
+			except Exception as e:
+				error = e
+			if attempt < self.retries:
+				with self.__cond:
+					self.__stats['retries'] += 1
+				time.sleep(delay)
+				delay *= 2
+		logging.critical(f"Failed to push {len(events)} events to client. " \
+						 f"Exception encountered {error}")
+		with self.__cond:
+			self.__stats['failures'] += 1
+		if not self.fallback:
+			return
+		try:
+			self.fallback(events)
+			with self.__cond:
+				self.__stats['requeued'] += len(events)
+		except Exception as e:
+			logging.critical(f"Failed to requeue {len(events)} events: {e}")
+
+	def sender_thr(self):
+		while True:
+			with self.__cond:
+				while not self.__ready_locked():
+					if self.__events:
+						timeout = self.window - (time.monotonic() - self.__oldest)
+					else:
+						timeout = None
+					self.__cond.wait(timeout=timeout)
+				# the remaining events are at least as old as the ones
+				# sent, so they go out on the next pass
+				events = self.__events[:self.batch_size]
+				del self.__events[:self.batch_size]
+				shutdown = self.__shutdown and not self.__events
+			if events:
+				self.send(events)
+			if shutdown:
+				break
+
+	def get_stats(self):
+		with self.__cond:
+			return dict(self.__stats)
+
+	def close(self):
+		# flushes whatever is still buffered
+		with self.__cond:
+			if self.__shutdown:
+				return
+			self.__shutdown = True
+			self.__cond.notify()
+		self.__sender.join()
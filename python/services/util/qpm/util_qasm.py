@@ -0,0 +1,386 @@
+from defw_exception import DEFwError
+from defw_util import round_half_up, round_to_nearest_power_of_two
+import math, os, re
+
+# Analyze the QASM of submitted circuits to size them. When disabled the
+# client provided num_qubits is trusted.
+try:
+	ANALYZE_QASM = int(os.environ['QFW_QPM_ANALYZE_QASM'])
+except:
+	ANALYZE_QASM = 1
+
+# QASM is consumed in chunks of this many characters
+CHUNK_SIZE = 1 << 20
+
+# gates on one or two indexed qubits, the bulk of most circuits
+FAST_RE = re.compile(r'\s*([A-Za-z_]\w*)\s*(?:\([^)]*\))?\s*([A-Za-z_]\w*)\s*\[\s*(\d+)\s*\]'
+					 r'\s*(?:,\s*([A-Za-z_]\w*)\s*\[\s*(\d+)\s*\]\s*)?$')
+COMMENT_RE = re.compile(r'//[^\n]*')
+KEYWORDS = {'OPENQASM', 'include', 'opaque', 'qreg', 'creg', 'barrier',
+			'measure', 'if', 'gate'}
+CALL_RE = re.compile(r'([A-Za-z_]\w*)\s*(?:\(([^)]*)\))?\s*(.*)', re.S)
+IF_RE = re.compile(r'if\s*\([^)]*\)\s*(.*)', re.S)
+DECL_RE = re.compile(r'([A-Za-z_]\w*)\s*\[\s*(\d+)\s*\]')
+
+class QasmAnalyzer:
+	"""
+	Streaming OpenQASM 2.0 analyzer. Statements are handled as they are
+	read and only per qubit counters are kept, so memory doesn't grow
+	with the length of the circuit.
+
+	Gate definitions are not expanded. A call to a defined gate counts
+	as a single operation on its qubits.
+	"""
+	def __init__(self):
+		self.version = None
+		# name: (offset, size)
+		self.qregs = {}
+		self.num_qubits = 0
+		self.num_clbits = 0
+		self.gate_counts = {}
+		self.num_1q = 0
+		self.num_2q = 0
+		self.num_multi = 0
+		self.num_measure = 0
+		self.max_distance = 0
+		self.bytes = 0
+		# per qubit: depth reached, operations whose highest qubit it is
+		# and the difference array of the gates spanning each cut
+		self.depth = []
+		self.ops = []
+		self.cross = []
+		self.pairs = set()
+		self.__line = ''
+		self.__pending = ''
+		self.__in_gate = False
+
+	def feed(self, chunk):
+		self.bytes += len(chunk)
+		data = self.__line + chunk
+		# only whole lines are parsed so comments are never split
+		end = data.rfind('\n') + 1
+		self.__line = data[end:]
+		if end:
+			self.__parse(data[:end])
+
+	def finish(self):
+		if self.__line:
+			self.__parse(self.__line)
+			self.__line = ''
+		if self.__in_gate:
+			raise DEFwError("Unterminated gate definition")
+		rest = self.__pending.strip()
+		self.__pending = ''
+		if rest:
+			self.__statement(rest)
+		return self
+
+	def __parse(self, text):
+		if '//' in text:
+			text = COMMENT_RE.sub('', text)
+		text = self.__pending + text
+		pos = 0
+		while True:
+			if self.__in_gate:
+				# gate bodies are skipped
+				b = text.find('}', pos)
+				if b < 0:
+					self.__pending = ''
+					return
+				self.__in_gate = False
+				pos = b + 1
+			brace = text.find('{', pos)
+			stmts = text[pos:brace if brace >= 0 else len(text)].split(';')
+			# the last piece is either incomplete or a gate header
+			for stmt in stmts[:-1]:
+				self.__statement(stmt)
+			if brace < 0:
+				self.__pending = stmts[-1]
+				return
+			self.__gate_def(stmts[-1])
+			self.__in_gate = True
+			pos = brace + 1
+
+	def __gate_def(self, header):
+		m = CALL_RE.match(header.strip())
+		if not m or m.group(1) != 'gate':
+			raise DEFwError(f"Unexpected block: {header.strip()}")
+
+	def __declare(self, args, quantum):
+		m = DECL_RE.match(args)
+		if not m:
+			raise DEFwError(f"Bad register declaration: {args}")
+		size = int(m.group(2))
+		if not quantum:
+			self.num_clbits += size
+			return
+		self.qregs[m.group(1)] = (self.num_qubits, size)
+		self.num_qubits += size
+		self.depth.extend([0] * size)
+		self.ops.extend([0] * size)
+		self.cross.extend([0] * size)
+
+	def __index(self, reg, idx):
+		try:
+			offset, size = self.qregs[reg]
+		except KeyError:
+			raise DEFwError(f"Unknown register: {reg}")
+		idx = int(idx)
+		if idx >= size:
+			raise DEFwError(f"Qubit index out of range: {reg}[{idx}]")
+		return offset + idx
+
+	def __operand(self, arg):
+		b = arg.find('[')
+		try:
+			if b < 0:
+				offset, size = self.qregs[arg.strip()]
+				return range(offset, offset + size)
+			offset, size = self.qregs[arg[:b].strip()]
+			idx = int(arg[b+1:arg.index(']', b)])
+		except (KeyError, ValueError):
+			raise DEFwError(f"Bad qubit operand: {arg}")
+		if idx >= size:
+			raise DEFwError(f"Qubit index out of range: {arg}")
+		return offset + idx
+
+	def __operands(self, args):
+		"""
+		List of qubit tuples the operation applies to. Whole register
+		operands broadcast the operation over the register.
+		"""
+		ops = [self.__operand(a) for a in args.split(',')]
+		width = 0
+		for o in ops:
+			if type(o) is range:
+				if width and len(o) != width:
+					raise DEFwError(f"Register size mismatch: {args}")
+				width = len(o)
+		if not width:
+			return [ops]
+		return [[o if type(o) is int else o[i] for o in ops]
+				for i in range(width)]
+
+	def __apply(self, qubits):
+		depth = self.depth
+		if len(qubits) == 1:
+			q = qubits[0]
+			depth[q] += 1
+			self.ops[q] += 1
+			self.num_1q += 1
+			return
+		d = max(depth[q] for q in qubits) + 1
+		for q in qubits:
+			depth[q] = d
+		lo = min(qubits)
+		hi = max(qubits)
+		if lo == hi:
+			raise DEFwError(f"Repeated qubit operand: {qubits}")
+		self.ops[hi] += 1
+		self.cross[lo] += 1
+		self.cross[hi] -= 1
+		if hi - lo > self.max_distance:
+			self.max_distance = hi - lo
+		if len(qubits) == 2:
+			self.num_2q += 1
+			self.pairs.add((lo, hi))
+		else:
+			self.num_multi += 1
+			for i, a in enumerate(qubits):
+				for b in qubits[i+1:]:
+					self.pairs.add((min(a, b), max(a, b)))
+
+	def __statement(self, stmt):
+		m = FAST_RE.match(stmt)
+		if m and m.group(1) not in KEYWORDS:
+			name, r1, i1, r2, i2 = m.groups()
+			q = self.__index(r1, i1)
+			if r2 is None:
+				self.depth[q] += 1
+				self.ops[q] += 1
+				self.num_1q += 1
+			else:
+				self.__apply((q, self.__index(r2, i2)))
+			self.gate_counts[name] = self.gate_counts.get(name, 0) + 1
+			return
+		stmt = stmt.strip()
+		if not stmt:
+			return
+		if stmt.startswith('if'):
+			m = IF_RE.match(stmt)
+			if m:
+				stmt = m.group(1)
+		m = CALL_RE.match(stmt)
+		if not m:
+			raise DEFwError(f"Can't parse QASM statement: {stmt}")
+		name, params, args = m.groups()
+		if name == 'OPENQASM':
+			self.version = args.strip()
+		elif name == 'include' or name == 'opaque':
+			pass
+		elif name == 'qreg':
+			self.__declare(args, True)
+		elif name == 'creg':
+			self.__declare(args, False)
+		elif name == 'barrier':
+			qubits = []
+			for a in args.split(','):
+				o = self.__operand(a)
+				if type(o) is range:
+					qubits.extend(o)
+				else:
+					qubits.append(o)
+			d = max(self.depth[q] for q in qubits)
+			for q in qubits:
+				self.depth[q] = d
+		elif name == 'measure':
+			for qubits in self.__operands(args.split('->')[0]):
+				self.depth[qubits[0]] += 1
+				self.num_measure += 1
+		else:
+			applied = 0
+			for qubits in self.__operands(args):
+				self.__apply(qubits)
+				applied += 1
+			self.gate_counts[name] = self.gate_counts.get(name, 0) + applied
+
+	def num_gates(self):
+		return self.num_1q + self.num_2q + self.num_multi
+
+	def nonlocal_ops(self, k):
+		"""
+		Operations touching one of the k highest qubits. When the state
+		vector is split over 2^k processes, these need communication.
+		"""
+		if k <= 0:
+			return 0
+		return sum(self.ops[max(self.num_qubits - k, 0):])
+
+	def max_bond_log2(self):
+		"""
+		Upper bound on log2 of the MPS bond dimension: every gate
+		spanning a cut can at most double the bond across it.
+		"""
+		bond = 0
+		spanning = 0
+		n = self.num_qubits
+		for c in range(n - 1):
+			spanning += self.cross[c]
+			bond = max(bond, min(spanning, c + 1, n - c - 1))
+		return bond
+
+	def features(self):
+		return {'num_qubits': self.num_qubits,
+				'num_clbits': self.num_clbits,
+				'depth': max(self.depth) if self.depth else 0,
+				'num_gates': self.num_gates(),
+				'num_1q': self.num_1q,
+				'num_2q': self.num_2q,
+				'num_multi': self.num_multi,
+				'num_measure': self.num_measure,
+				'gate_counts': dict(self.gate_counts),
+				'num_interactions': len(self.pairs),
+				'max_interaction_distance': self.max_distance,
+				'max_bond_log2': self.max_bond_log2()}
+
+def analyze_qasm(qasm):
+	analyzer = QasmAnalyzer()
+	for i in range(0, len(qasm), CHUNK_SIZE):
+		analyzer.feed(qasm[i:i+CHUNK_SIZE])
+	return analyzer.finish()
+
+def analyze_qasm_file(path):
+	analyzer = QasmAnalyzer()
+	with open(path, 'r') as f:
+		while True:
+			chunk = f.read(CHUNK_SIZE)
+			if not chunk:
+				break
+			analyzer.feed(chunk)
+	return analyzer.finish()
+
+class CostModel:
+	"""
+	Picks the number of processes, the backend and the placement of a
+	circuit from its analyzed features. The costs are rough estimates in
+	seconds; they are used to compare the options, not to predict the
+	runtime.
+	"""
+	# applying a gate to one amplitude
+	AMP_TIME = 1e-9
+	# exchanging one amplitude between processes
+	COMM_TIME = 1e-8
+	# launching one process
+	PROC_TIME = 0.05
+	# an MPS gate costs bond^3 operations
+	MPS_GATE_TIME = 1e-9
+	# largest state vector worth considering
+	SV_MAX_QUBITS = 60
+	# circuits the QB vQPUs run without an MPI launch
+	QB_MAX_QUBITS = 15
+	# pack the processes on as few hosts as possible when more than
+	# this fraction of the operations needs communication
+	PACK_THRESHOLD = 0.1
+	# doubling the processes must speed the circuit up by at least this
+	# much, so a single circuit doesn't take over the cluster for a
+	# marginal gain
+	MIN_SPEEDUP = 1.5
+
+	def __init__(self, max_qubits_pp, max_np=0):
+		self.max_qubits_pp = max_qubits_pp
+		self.max_np = max_np
+
+	def min_np(self, num_qubits):
+		# each max_qubits_pp qubits require a process
+		np = round_half_up(num_qubits / self.max_qubits_pp)
+		if np < 1:
+			return 1
+		return round_to_nearest_power_of_two(np)
+
+	def sv_cost(self, analyzer, np):
+		n = analyzer.num_qubits
+		if n > self.SV_MAX_QUBITS:
+			return math.inf
+		amps = float(2 ** n)
+		k = int(math.log2(np))
+		return analyzer.num_gates() * amps * self.AMP_TIME / np + \
+			   analyzer.nonlocal_ops(k) * amps / np * self.COMM_TIME + \
+			   np * self.PROC_TIME
+
+	def mps_cost(self, analyzer):
+		bond = analyzer.max_bond_log2()
+		if 3 * bond > 1000:
+			return math.inf
+		return analyzer.num_gates() * analyzer.num_qubits * \
+			   float(2 ** (3 * bond)) * self.MPS_GATE_TIME + self.PROC_TIME
+
+	def choose_np(self, analyzer):
+		np = self.min_np(analyzer.num_qubits)
+		best = (self.sv_cost(analyzer, np), np)
+		while self.max_np and np * 2 <= self.max_np:
+			np *= 2
+			cost = self.sv_cost(analyzer, np)
+			if cost * self.MIN_SPEEDUP > best[0]:
+				break
+			best = (cost, np)
+		return best
+
+	def plan(self, analyzer):
+		cost, np = self.choose_np(analyzer)
+		mps = self.mps_cost(analyzer)
+		if mps < cost:
+			# the MPS simulation doesn't benefit from splitting the state
+			return {'np': self.min_np(analyzer.num_qubits),
+					'recommended_backend': 'tnqvm',
+					'placement': None, 'estimated_cost': mps}
+		if np == 1 and analyzer.num_qubits <= self.QB_MAX_QUBITS:
+			backend = 'qb'
+		else:
+			backend = 'nwqsim'
+		placement = None
+		if np > 1 and analyzer.num_gates():
+			comm = analyzer.nonlocal_ops(int(math.log2(np))) / analyzer.num_gates()
+			if comm > self.PACK_THRESHOLD:
+				placement = 'pack'
+		return {'np': np, 'recommended_backend': backend,
+				'placement': placement, 'estimated_cost': cost}
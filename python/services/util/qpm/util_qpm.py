@@ -2,27 +2,57 @@ from defw_agent_info import *
 from api_events import BaseEventAPI
 from defw_util import expand_host_list, round_half_up, round_to_nearest_power_of_two
 from defw import me
-import logging, uuid, time, queue, threading, logging, yaml
-from defw_exception import DEFwError, DEFwNotReady, DEFwInProgress
+import logging, uuid, time, threading, logging, yaml
+from defw_exception import DEFwNotReady, DEFwInProgress, \
+						   DEFwOutOfResources
 import os
-from .util_circuit import Circuit, MAX_PPN
-from statistics import mean, median, stdev
+import defw_common_def as common
+from .util_circuit import Circuit, MAX_PPN, set_max_np, analyze_circuit, \
+						  analysis_cache
+from .util_allocator import make_allocator
+from .util_scheduler import Scheduler, can_set_priority
+from .util_result_cache import ResultCache, cache_key
+from .util_runtime_model import RuntimeModel, default_model_path
+from .util_stats import LifecycleStats
+from .util_shots import plan_shards, split_shots, shard_seed, merge_counts
+from .util_credits import CreditManager, set_client_window, client_id
+from api_qpm import PackedCounts
+from defw_topology import get_bindings
 
 qpm_initialized = False
 qpm_shutdown = False
 
+# Longest a client can block in wait_cq()/read_cq_many(). Needs to stay
+# below the RPC timeout.
+try:
+	CQ_MAX_WAIT = float(os.environ['QFW_QPM_CQ_MAX_WAIT'])
+except:
+	CQ_MAX_WAIT = 60
+
 class UTIL_QPM:
 	def __init__(self, qrc, max_ppn=MAX_PPN, start=True):
 		self.circuits = {}
 		#self.runner_queue = queue.Queue()
-		self.oor_queue = queue.Queue()
 		self.circuit_results = []
 		self.qrc = qrc
 		self.free_hosts = {}
 		self.max_ppn = max_ppn
 		self.setup_host_resources(max_ppn)
-		self.all_results = []
+		self.allocator = make_allocator(self.free_hosts, max_ppn)
+		set_max_np(sum(self.free_hosts.values()))
+		self.runtime_model = RuntimeModel(
+				default_model_path(type(self).__module__.split('.')[0]))
+		# circuits waiting for resources
+		self.scheduler = Scheduler(sum(self.free_hosts.values()),
+								   estimator=self.estimate_runtime)
+		self.lifecycle_stats = LifecycleStats()
+		# parent cid: shards of the circuits split by shots
+		self.split_circuits = {}
+		self.split_lock = threading.Lock()
 		self.push_info = {}
+		self.result_cache = ResultCache()
+		self.credits = CreditManager()
+		self.qrc.register_completion_cb(self.circuit_completed)
 
 	def setup_host_resources(self, max_ppn):
 		hl = expand_host_list(os.environ['QFW_QPM_ASSIGNED_HOSTS'])
@@ -37,6 +67,8 @@ class UTIL_QPM:
 		start = time.time()
 
 		cid = str(uuid.uuid4())
+		if self.result_cache.enabled() and not info.get('no_cache', False):
+			info['cache_key'] = cache_key(info)
 		self.circuits[cid] = Circuit(cid, info, self.free_resources_and_oor)
 		self.circuits[cid].set_ready()
 		logging.debug(f"{cid} added to circuit database in {time.time() - start}")
@@ -52,73 +84,57 @@ class UTIL_QPM:
 			return
 		circ = self.circuits[cid]
 		if circ.can_delete():
+			self.scheduler.remove(cid)
 			del self.circuits[cid]
+			self.credits.release(cid)
 		else:
 			circ.set_deletion()
 
 	def consume_resources(self, circ):
-		info = circ.info
-		np = info['np']
-		num_hosts = int(np / self.max_ppn)
-		if not num_hosts:
-			num_hosts = 1
-
-		# determine if we have enough hosts to run this circuit
-		# If the number of hosts required is more than the total number
-		# of hosts then we can't run the circuit.
-		if num_hosts > len(self.free_hosts.keys()):
-			raise DEFwOutOfResources(f"hosts requested is more than available" \
-									 f" Available resources = {np}:{num_hosts}:{self.free_hosts}")
-
-		tmp_resources = {}
-		consumed_res = {}
-		itrnp = 0
-		for host in self.free_hosts.keys():
-			if np == 0:
-				break;
-			tmp_resources[host] = self.free_hosts[host]
-			if self.free_hosts[host] >= np:
-				self.free_hosts[host] = self.free_hosts[host] - np
-				consumed_res[host] = np
-				itrnp += np
-				np = 0
-			elif self.free_hosts[host] < np and self.free_hosts[host] != 0:
-				np -= self.free_hosts[host]
-				itrnp += self.free_hosts[host]
-				consumed_res[host] = self.free_hosts[host]
-				self.free_hosts[host] = 0
-		if np != 0:
-			# restore whatever was consumed
-			for k, v in tmp_resources.items():
-				self.free_hosts[k] = v
-			raise DEFwOutOfResources(f"Not enough slots to run simulation" \
-									 f" Available resources = {np}:{num_hosts}:{self.free_hosts}")
-
-		circ.info['hosts'] = consumed_res
-		logging.debug(f"Circuit consumed: {consumed_res}")
+		circ.info['hosts'] = self.allocator.allocate(circ.info['np'],
+									circ.info.get('placement'))
+		logging.debug(f"Circuit consumed: {circ.info['hosts']}")
+
+	def estimate_runtime(self, info):
+		return self.runtime_model.estimate(info)['runtime']
+
+	def estimate(self, info):
+		"""
+		Estimated runtime of a circuit, learned from the completed ones.
+		Returns a dictionary with the estimate in seconds ('runtime'), its
+		90th percentile ('p90'), and what it is based on ('source').
+		"""
+		info = dict(info)
+		if 'qasm' in info and 'analysis' not in info:
+			try:
+				info['analysis'] = analyze_circuit(info['qasm'])
+				info['num_qubits'] = info['analysis']['num_qubits']
+				info.setdefault('np', info['analysis']['np'])
+			except Exception as e:
+				logging.debug(f"QASM analysis failed: {e}")
+		return self.runtime_model.estimate(info)
+
+	def start_queued(self, cid):
+		self.async_run_oor(cid, self.common_run)
 
 	def process_oor_queue(self):
-		while True:
-			if self.oor_queue.empty():
-				break
-			try:
-				# now that we have the resources for the circuit secured
-				# pop that entry off the queue.
-				cid = self.oor_queue.get(block=False)
-				self.async_run_oor(cid, self.common_run)
-			except DEFwOutOfResources:
-				break
+		failed = self.scheduler.schedule(self.start_queued,
+										 self.allocator.free_slots)
+		for cid, e in failed:
+			if cid in self.circuits and 'parent_cid' in self.circuits[cid].info:
+				self.shard_failed(cid, e)
+			else:
+				self.delete_circuit(cid)
+
+	def return_resources(self, circ):
+		self.allocator.release(circ.info['hosts'])
+		circ.info['hosts'] = {}
 
 	def free_resources(self, circ):
-		res = circ.info['hosts']
-		for host in res.keys():
-			if host not in self.free_hosts:
-				raise DEFwError(f"Circuit has untracked host: {host}")
-			if res[host] + self.free_hosts[host] > self.max_ppn:
-				raise DEFwError("Returning more resources than originally had")
-			self.free_hosts[host] += res[host]
+		self.return_resources(circ)
 		circ.set_done()
 		cid = circ.get_cid()
+		self.scheduler.finished(cid)
 		self.delete_circuit(cid)
 
 	def free_resources_and_oor(self, circ):
@@ -128,6 +144,263 @@ class UTIL_QPM:
 		# resources again.
 		self.process_oor_queue()
 
+	def complete_from_cache(self, cid, post=True):
+		"""
+		If the result of cid is cached, complete the circuit with it and
+		return the result. Otherwise return None.
+		"""
+		circuit = self.circuits[cid]
+		key = circuit.info.get('cache_key')
+		if not key:
+			return None
+		result = self.result_cache.get(key)
+		if result is None:
+			return None
+		now = time.time()
+		circuit.launch_time = circuit.exec_time = now
+		circuit.set_exec_done()
+		circuit.set_done()
+		del self.circuits[cid]
+		self.credits.release(cid)
+		r = {'cid': cid,
+			 'result': result,
+			 'rc': 0,
+			 'cached': True,
+			 'launch_time': circuit.launch_time,
+			 'creation_time': circuit.creation_time,
+			 'exec_time': circuit.exec_time,
+			 'completion_time': circuit.completion_time,
+			 'resources_consumed_time': circuit.resources_consumed_time,
+			 'cq_enqueue_time': now,
+			 'cq_dequeue_time': -1 }
+		logging.debug(f"{cid} completed from the result cache")
+		self.format_result(circuit.info, r)
+		if post:
+			self.qrc.post_result(r)
+		return r
+
+	def circuit_completed(self, circ, r):
+		stats = self.lifecycle_stats
+		stats.record('create->launch', r['creation_time'], r['launch_time'])
+		stats.record('launch->running', r['launch_time'], r['exec_time'])
+		stats.record('exec->completion', r['exec_time'], r['completion_time'])
+		if r['rc'] == 0:
+			key = circ.info.get('cache_key')
+			if key:
+				self.result_cache.put(key, r['result'])
+			if r['exec_time'] > 0 and r['completion_time'] > r['exec_time']:
+				self.runtime_model.observe(circ.info,
+						r['completion_time'] - r['exec_time'])
+		if 'parent_cid' in circ.info:
+			self.shard_completed(circ.info['parent_cid'], r)
+			return True
+		self.credits.release(circ.get_cid())
+		self.format_result(circ.info, r)
+		return False
+
+	def identify_client(self, infos):
+		"""
+		Stamp the client making the request on infos, replacing whatever
+		the client put there. Only local requests and clients allowed to
+		set priorities keep info['priority']. Returns the client.
+		"""
+		ep = common.get_rpc_source()
+		client = client_id(ep)
+		name = ep.name if ep is not None else client
+		trusted = can_set_priority(client, name)
+		for info in infos:
+			info['client'] = client
+			info['client_name'] = name
+			if not trusted and info.pop('priority', 0):
+				logging.debug(f"{name} isn't allowed to set circuit priorities")
+		return client
+
+	def take_credits(self, infos):
+		"""
+		Take a credit for each of infos from the window of the client
+		making the request. Returns the client, or None if it has no
+		window. Raises DEFwRetryLater if its window is full.
+		"""
+		client = self.identify_client(infos)
+		if self.credits.acquire(client, len(infos), max_wait=CQ_MAX_WAIT):
+			return client
+		return None
+
+	def return_credits(self, client, n):
+		# give back the credits of circuits which weren't created
+		if client is not None:
+			self.credits.cancel(client, n)
+
+	def bind_credits(self, client, cids):
+		if client is not None:
+			self.credits.track(client, cids)
+
+	def format_result(self, info, r):
+		"""
+		Convert the result to the format the client asked for in
+		info['result_format']. 'packed' returns the counts as
+		PackedCounts. Results which aren't counts are left as they are.
+		"""
+		if r['rc'] != 0 or info.get('result_format') != 'packed' or \
+		   not isinstance(r['result'], dict):
+			return
+		try:
+			r['result'] = PackedCounts.from_dict(r['result'])
+		except (ValueError, TypeError, AttributeError) as e:
+			logging.debug(f"{r['cid']}: result left unpacked: {e}")
+
+	def plan_split(self, circuit):
+		info = circuit.info
+		if info.get('shot_split') is False or 'num_shots' not in info or \
+		   not self.qrc.SEED_SUPPORT:
+			return 1
+		# don't add to the queue when circuits are already waiting
+		if len(self.scheduler):
+			return 1
+		return plan_shards(info['num_shots'],
+						   self.allocator.free_slots() // info['np'])
+
+	def run_split(self, cid, shards, common_run):
+		"""
+		Run cid as shards copies, each with a share of the shots and its
+		own seed. The shards' results are merged into a single result
+		for cid once they all complete.
+		"""
+		parent = self.circuits[cid]
+		children = []
+		try:
+			for i, shots in enumerate(split_shots(parent.info['num_shots'], shards)):
+				info = {k: v for k, v in parent.info.items()
+						if k not in ['cache_key', 'hosts']}
+				info.update({'num_shots': shots, 'seed': shard_seed(parent.info, i),
+							 'parent_cid': cid, 'shard': i, 'no_cache': True})
+				children.append(self.create_circuit(info))
+		except Exception as e:
+			for child in children:
+				self.delete_circuit(child)
+			raise e
+
+		parent.set_running()
+		with self.split_lock:
+			self.split_circuits[cid] = {'shards': shards, 'results': {}}
+		logging.debug(f"{cid} split into {shards} shards: {children}")
+		for child in children:
+			try:
+				self.start_circuit(child, common_run)
+			except Exception as e:
+				self.shard_failed(child, e)
+
+	def shard_failed(self, cid, e):
+		# fail the shard so its parent still completes
+		circuit = self.circuits.pop(cid, None)
+		if not circuit:
+			return
+		now = time.time()
+		self.shard_completed(circuit.info['parent_cid'],
+			{'cid': cid, 'result': str(e), 'rc': -1, 'launch_time': now,
+			 'creation_time': circuit.creation_time, 'exec_time': now,
+			 'completion_time': now})
+
+	def shard_completed(self, cid, r):
+		with self.split_lock:
+			split = self.split_circuits.get(cid)
+			if split is None:
+				logging.critical(f"Shard {r['cid']} of unknown circuit {cid}")
+				return
+			split['results'][r['cid']] = r
+			if len(split['results']) < split['shards']:
+				self.circuits.pop(r['cid'], None)
+				return
+			del self.split_circuits[cid]
+		self.circuits.pop(r['cid'], None)
+
+		results = list(split['results'].values())
+		failed = [x for x in results if x['rc'] != 0]
+		if failed:
+			output = failed[0]['result']
+			rc = failed[0]['rc']
+		else:
+			try:
+				output = merge_counts([x['result'] for x in results])
+				rc = 0
+			except ValueError as e:
+				output = f"Failed to merge shard results: {e}"
+				rc = -1
+
+		parent = self.circuits.get(cid)
+		now = time.time()
+		r = {'cid': cid,
+			 'result': output,
+			 'rc': rc,
+			 'shards': split['shards'],
+			 'launch_time': min(x['launch_time'] for x in results),
+			 'creation_time': parent.creation_time if parent else -1,
+			 'exec_time': min(x['exec_time'] for x in results),
+			 'completion_time': max(x['completion_time'] for x in results),
+			 'resources_consumed_time': -1,
+			 'cq_enqueue_time': now,
+			 'cq_dequeue_time': -1 }
+		if parent:
+			if rc == 0:
+				parent.set_exec_done()
+				key = parent.info.get('cache_key')
+				if key:
+					self.result_cache.put(key, output)
+			else:
+				parent.set_fail()
+			self.format_result(parent.info, r)
+		self.credits.release(cid)
+		self.qrc.post_result(r)
+
+	def analyze_circuit(self, info):
+		"""
+		Features of the circuit's QASM and the plan the cost model makes
+		for it: number of processes, recommended backend and placement.
+		"""
+		return analyze_circuit(info['qasm'])
+
+	def get_load(self):
+		"""
+		Queue depth, backlog and free slots of this QPM. Used by clients
+		to spread circuits across several QPMs.
+		"""
+		global qpm_initialized
+
+		if not qpm_initialized:
+			raise DEFwNotReady("QPM has not initialized properly")
+
+		load = self.scheduler.get_load()
+		load['free_slots'] = self.allocator.free_slots()
+		load['total_slots'] = self.scheduler.total_slots
+		return load
+
+	def get_cache_stats(self):
+		return self.result_cache.get_stats()
+
+	def get_credit_stats(self):
+		return self.credits.get_stats()
+
+	def get_cpu_bindings(self):
+		return get_bindings()
+
+	def get_analysis_cache_stats(self):
+		return analysis_cache.get_stats()
+
+	def get_ingest_stats(self):
+		if not self.qrc:
+			return {}
+		return self.qrc.get_ingest_metrics()
+
+	def get_runner_pool_stats(self):
+		if not self.qrc:
+			return {}
+		return self.qrc.get_pool_stats()
+
+	def get_publisher_stats(self):
+		if not self.qrc:
+			return {}
+		return self.qrc.get_publisher_stats()
+
 	def common_run(self, cid):
 		circuit = self.circuits[cid]
 		self.consume_resources(circuit)
@@ -146,13 +419,25 @@ class UTIL_QPM:
 		if not qpm_initialized:
 			raise DEFwNotReady("QPM has not initialized properly")
 
+		client = self.take_credits([info])
 		try:
 			cid = self.create_circuit(info)
+		except Exception as e:
+			self.return_credits(client, 1)
+			raise e
+		self.bind_credits(client, [cid])
+		try:
+			result = self.complete_from_cache(cid, post=False)
+			if result:
+				return result
 			circuit = common_run(cid)
+			self.scheduler.started(cid, circuit.info)
 			result = self.qrc.sync_run(circuit)
 		except Exception as e:
+			self.credits.release(cid)
 			raise e
 		self.free_resources(circuit)
+		self.circuit_completed(circuit, result)
 		logging.debug(f"circuit {circuit.get_cid()} completed with output {result}")
 		return result
 
@@ -167,16 +452,14 @@ class UTIL_QPM:
 		if not qpm_initialized:
 			raise DEFwNotReady("QPM has not initialized properly")
 
+		# The circuit stays queued in the scheduler until this succeeds
+		circuit = common_run(cid)
 		try:
-			circuit = common_run(cid)
 			self.qrc.async_run(circuit)
-		except DEFwOutOfResources as e:
-			# queue circuit on a local out of resources queue
-			self.oor_queue.put(cid)
-			raise e
 		except Exception as e:
-			self.process_oor_queue()
+			self.return_resources(circuit)
 			raise e
+		return circuit
 
 	def async_run(self, info, common_run=None):
 		global qpm_initialized
@@ -189,18 +472,172 @@ class UTIL_QPM:
 		if not qpm_initialized:
 			raise DEFwNotReady("QPM has not initialized properly")
 
+		client = self.take_credits([info])
 		try:
 			cid = self.create_circuit(info)
-			circuit = common_run(cid)
-			self.qrc.async_run(circuit)
+		except Exception as e:
+			self.return_credits(client, 1)
+			raise e
+		self.bind_credits(client, [cid])
+
+		try:
+			if self.complete_from_cache(cid):
+				return cid
+
+			shards = self.plan_split(self.circuits[cid])
+			if shards > 1:
+				self.run_split(cid, shards, common_run)
+			else:
+				self.start_circuit(cid, common_run)
+		except Exception as e:
+			self.credits.release(cid)
+			raise e
+
+		return cid
+
+	def start_circuit(self, cid, common_run):
+		info = self.circuits[cid].info
+
+		# circuits already waiting for resources get to go first, in
+		# scheduler order
+		if len(self.scheduler):
+			self.scheduler.put(cid, info)
+			self.process_oor_queue()
+			return
+
+		try:
+			circuit = self.async_run_oor(cid, common_run)
+			self.scheduler.started(cid, circuit.info)
 		except DEFwOutOfResources:
-			# queue circuit on a local out of resources queue
-			self.oor_queue.put(cid)
+			# queue circuit until resources free up
+			self.scheduler.put(cid, info)
 		except Exception as e:
 			self.process_oor_queue()
 			raise e
 
-		return cid
+	def create_circuits(self, infos):
+		cids = []
+		try:
+			for info in infos:
+				cids.append(self.create_circuit(info))
+		except Exception as e:
+			for cid in cids:
+				self.delete_circuit(cid)
+			raise e
+		return cids
+
+	def async_run_batch(self, infos, common_run=None):
+		"""
+		Create and queue all the circuits described by infos in one go.
+		Returns the cids in the same order as infos. Circuits which
+		don't fit in the available resources are queued until resources
+		free up, same as async_run().
+		"""
+		global qpm_initialized
+
+		if not common_run:
+			common_run = self.common_run
+		else:
+			self.common_run = common_run
+
+		if not qpm_initialized:
+			raise DEFwNotReady("QPM has not initialized properly")
+
+		client = self.take_credits(infos)
+		try:
+			all_cids = self.create_circuits(infos)
+		except Exception as e:
+			self.return_credits(client, len(infos))
+			raise e
+		self.bind_credits(client, all_cids)
+		cids = [cid for cid in all_cids if not self.complete_from_cache(cid)]
+
+		if len(self.scheduler):
+			for cid in cids:
+				self.scheduler.put(cid, self.circuits[cid].info)
+			self.process_oor_queue()
+			return all_cids
+
+		runnable = []
+		try:
+			for cid in cids:
+				try:
+					runnable.append(common_run(cid))
+				except DEFwOutOfResources:
+					break
+			queued = self.qrc.async_run_batch(runnable)
+		except Exception as e:
+			for circuit in runnable:
+				self.return_resources(circuit)
+			for cid in cids:
+				self.credits.release(cid)
+			self.process_oor_queue()
+			raise e
+
+		for circuit in runnable[:queued]:
+			self.scheduler.started(circuit.get_cid(), circuit.info)
+		# whatever the runners couldn't take waits for resources to free
+		# up
+		for circuit in runnable[queued:]:
+			self.return_resources(circuit)
+		for cid in cids[queued:]:
+			self.scheduler.put(cid, self.circuits[cid].info)
+
+		return all_cids
+
+	def sync_run_batch(self, infos, common_run=None):
+		"""
+		Run all the circuits described by infos concurrently and return
+		their results in the same order as infos.
+		"""
+		if self.push_info:
+			# results are pushed to the client as they complete, so they
+			# can't be collected here
+			return [self.sync_run(info, common_run=common_run)
+					for info in infos]
+
+		global qpm_shutdown
+
+		cids = self.async_run_batch(infos, common_run=common_run)
+		results = {}
+		while len(results) < len(cids):
+			pending = [cid for cid in cids if cid not in results]
+			for r in self.qrc.read_cq_batch(pending, timeout=CQ_MAX_WAIT):
+				results[r['cid']] = r
+			if qpm_shutdown:
+				raise DEFwNotReady("QPM shut down before the batch completed")
+		return [results[cid] for cid in cids]
+
+	def read_cq_batch(self, cids, timeout=0):
+		"""
+		Return the results of the cids which completed, in the order of
+		cids. Waits up to timeout seconds (capped to CQ_MAX_WAIT) for
+		all of them to complete.
+		"""
+		global qpm_initialized
+
+		if not qpm_initialized:
+			raise DEFwNotReady("QPM has not initialized properly")
+
+		if timeout is None or timeout > CQ_MAX_WAIT:
+			timeout = CQ_MAX_WAIT
+
+		results = self.qrc.read_cq_batch(cids, timeout=timeout)
+		self.record_dequeued(results)
+		return results
+
+	def get_queue_info(self, cid=None):
+		"""
+		Queue position and estimated start time of cid, or a list of
+		them for all the circuits waiting for resources if cid is None.
+		Raises DEFwNotFound if cid is neither queued nor running.
+		"""
+		global qpm_initialized
+
+		if not qpm_initialized:
+			raise DEFwNotReady("QPM has not initialized properly")
+
+		return self.scheduler.get_queue_info(cid)
 
 	def read_cq(self, cid=None):
 		global qpm_initialized
@@ -216,16 +653,59 @@ class UTIL_QPM:
 			else:
 				raise DEFwInProgress("No ready QTs")
 
-		self.all_results.append(r)
+		self.record_dequeued([r])
+		return r
+
+	def wait_cq(self, cid=None, timeout=None):
+		"""
+		Block until the result of cid, or of any circuit if cid is None,
+		is available and return it. Raises DEFwInProgress if nothing
+		completes within timeout seconds (capped to CQ_MAX_WAIT).
+		"""
+		global qpm_initialized
+
+		if not qpm_initialized:
+			raise DEFwNotReady("QPM has not initialized properly")
+
+		if timeout is None or timeout > CQ_MAX_WAIT:
+			timeout = CQ_MAX_WAIT
+
+		r = self.qrc.wait_cq(cid, timeout=timeout)
+
+		if not r:
+			if cid:
+				raise DEFwInProgress(f"{cid} still in progress")
+			else:
+				raise DEFwInProgress("No ready QTs")
+
+		self.record_dequeued([r])
 		return r
 
+	def read_cq_many(self, max_n=64, timeout=0):
+		"""
+		Return up to max_n results in completion order. If none are
+		available wait up to timeout seconds (capped to CQ_MAX_WAIT) for
+		the first one. Returns an empty list if nothing completed.
+		"""
+		global qpm_initialized
+
+		if not qpm_initialized:
+			raise DEFwNotReady("QPM has not initialized properly")
+
+		if timeout is None or timeout > CQ_MAX_WAIT:
+			timeout = CQ_MAX_WAIT
+
+		results = self.qrc.read_cq_many(max_n, timeout=timeout)
+		self.record_dequeued(results)
+		return results
+
 	def peek_cq(self, cid=None):
 		global qpm_initialized
 
 		if not qpm_initialized:
 			raise DEFwNotReady("QPM has not initialized properly")
 
-		r = self.qrc.peak_cq()
+		r = self.qrc.peak_cq(cid)
 
 		if not r:
 			if cid:
@@ -264,8 +744,18 @@ class UTIL_QPM:
 							   cap, -1)
 		return info
 
-	def reserve(self, svc, client_ep, *args, **kwargs):
+	@classmethod
+	def reserve(cls, svc, client_ep, *args, **kwargs):
+		"""
+		kwargs can set the window of outstanding circuits of the client,
+		credit_window, and how long its submissions wait for credits,
+		credit_wait. The window applies to the circuits submitted from
+		client_ep.
+		"""
 		logging.debug(f"{client_ep} reserved the {svc}")
+		if 'credit_window' in kwargs or 'credit_wait' in kwargs:
+			set_client_window(client_id(client_ep), kwargs.get('credit_window'),
+							  kwargs.get('credit_wait'))
 
 	def release(self, services=None):
 		global qpm_shutdown
@@ -281,33 +771,43 @@ class UTIL_QPM:
 		time.sleep(timeout)
 		me.exit()
 
-	def compute_stats(self, data, label):
-		logging.critical(f"Statistical Analysis for {label}:")
-		logging.critical(f"Count: {len(data)}")
-		logging.critical(f"Mean: {mean(data):.6f} seconds")
-		logging.critical(f"Median: {median(data):.6f} seconds")
-		logging.critical(f"Standard Deviation: {stdev(data):.6f} seconds" if len(data) > 1 else "N/A")
-		logging.critical(f"Min: {min(data):.6f} seconds")
-		logging.critical(f"Max: {max(data):.6f} seconds")
+	def record_dequeued(self, results):
+		for r in results:
+			self.lifecycle_stats.record('cq_enqueue->dequeue',
+						r['cq_enqueue_time'], r['cq_dequeue_time'])
+
+	def stats(self):
+		"""
+		Count, mean, stdev, min, max and p50/p90/p99 in seconds of each
+		phase of the circuits' lifecycle since the last reset_stats().
+		"""
+		return self.lifecycle_stats.snapshot()
+
+	def reset_stats(self):
+		"""
+		Start a new set of lifecycle stats, for example at the start of
+		a campaign. Returns the stats collected until now.
+		"""
+		return self.lifecycle_stats.reset()
 
 	def shutdown(self):
 		logging.debug("Scheduling QPM Shutdown")
-		create_launch = []
-		launch_running = []
-		exec_completion = []
-		for r in self.all_results:
-			create_launch.append(r['launch_time'] - r['creation_time'])
-			launch_running.append(r['exec_time'] - r['launch_time'])
-			exec_completion.append(r['completion_time'] - r['exec_time'])
-
-		try:
-			self.compute_stats(create_launch, 'create->launch')
-			self.compute_stats(launch_running, 'launch->running')
-			self.compute_stats(exec_completion, 'exec->completion')
-		except:
-			pass
-
+		for phase, stats in self.stats()['phases'].items():
+			logging.critical(f"Statistical Analysis for {phase}: {stats}")
+
+		logging.critical(f"Allocator: {self.allocator.get_stats()}")
+		logging.critical(f"Scheduler: {self.scheduler.get_stats()}")
+		logging.critical(f"Result cache: {self.result_cache.get_stats()}")
+		logging.critical(f"QASM analysis cache: {self.get_analysis_cache_stats()}")
+		logging.critical(f"Credits: {self.get_credit_stats()}")
+		logging.critical(f"CPU bindings: {self.get_cpu_bindings()}")
+		logging.critical(f"Runtime model: {self.runtime_model.get_stats()}")
+		self.runtime_model.save()
 		if self.qrc:
+			logging.critical(f"QASM hand-off: {self.qrc.get_handoff_metrics()}")
+			logging.critical(f"Result ingest: {self.get_ingest_stats()}")
+			logging.critical(f"Runner pool: {self.get_runner_pool_stats()}")
+			logging.critical(f"Completion publisher: {self.get_publisher_stats()}")
 			self.qrc.shutdown()
 			self.qrc = None
 		#ss = threading.Thread(target=self.schedule_shutdown, args=())
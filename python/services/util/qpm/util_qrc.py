@@ -3,45 +3,132 @@ from defw_agent_info import *
 from defw_util import prformat, fg, bg
 from defw import me
 import logging, uuid, time, queue, threading, sys, os, io, contextlib
-import importlib, yaml, psutil
-from defw_exception import DEFwError, DEFwExists, DEFwExecutionError, DEFwInProgress, DEFwOutOfResources
-import svc_launcher, cdefw_global
+import importlib, yaml
+from defw_exception import DEFwError, DEFwExists, DEFwExecutionError, DEFwOutOfResources
+import svc_launcher, cdefw_global, socket
 from defw_util import print_thread_stack_trace_to_logger
+from defw_topology import bind_thread, get_topology
+from .util_runner_pool import RunnerPool
+from .util_cq import CompletionQueue
+from .util_publisher import CompletionPublisher
+from .util_ingest import ResultIngest
 
 sys.path.append(os.path.split(os.path.abspath(__file__))[0])
 
+# Run single process circuits on the warm runner pool, using the QRC's
+# pool backend (UTIL_QRC.POOL_BACKEND). Off by default.
+try:
+	POOL_ENABLED = os.environ['QFW_QRC_POOL'].upper() in ['1', 'YES', 'TRUE']
+except:
+	POOL_ENABLED = False
+
+# Backend module run by the warm runner pool instead of the QRC's. See
+# util_runner_worker.py for the interface it needs to implement. Setting
+# it enables the pool.
+try:
+	POOL_BACKEND = os.environ['QFW_QRC_POOL_BACKEND']
+	POOL_ENABLED = True
+except:
+	POOL_BACKEND = None
+
+# Number of pool workers. Defaults to the number of QRC runner threads.
+try:
+	POOL_SIZE = int(os.environ['QFW_QRC_POOL_SIZE'])
+except:
+	POOL_SIZE = None
+
+# How the QASM is handed to the circuit runner and the result back:
+#	file: through files in the DEFw tmp directory
+#	shm:  through files in QFW_QRC_SHM_DIR. Only used when all the hosts
+#		  of the circuit are local.
+#	pipe: QASM on the runner's stdin and result on its stdout
+#	auto: the first of the QRC's HANDOFF_MODES usable for the circuit
+try:
+	HANDOFF_MODE = os.environ['QFW_QRC_HANDOFF']
+except:
+	HANDOFF_MODE = 'auto'
+
+try:
+	SHM_DIR = os.environ['QFW_QRC_SHM_DIR']
+except:
+	SHM_DIR = os.path.join('/dev/shm', f'defw-{os.getuid()}')
+
 class UTIL_QRC:
 	# max work queue size
 	THREAD_STATE_FREE = 0
 	THREAD_STATE_BUSY = 1
+	# Queued on a worker's queue by the launcher's reaper when one of the
+	# worker's tasks completes.
+	TASK_COMPLETE = 'TASK_COMPLETE'
+	# The runners block on their queue. This is only a safety net.
+	RUNNER_WAKEUP = 1
+	# Hand-off modes supported by the circuit runner in order of
+	# preference. 'file' is always the fallback.
+	HANDOFF_MODES = ['shm', 'file']
+	# Suffixes of the result files the circuit runner writes next to the
+	# QASM file
+	RESULT_SUFFIXES = []
+	# Python backend the runner pool runs this QRC's circuits with, or
+	# None if its circuit runner has none
+	POOL_BACKEND = None
+	# Whether the circuit runner samples with info['seed']. Circuits are
+	# only split by shots on QRCs whose runners do, otherwise the shards
+	# could draw the same samples.
+	SEED_SUPPORT = False
 
 	def __init__(self, num_workers=8, num_worker_tasks=256, start=True):
 		print_thread_stack_trace_to_logger(level='debug')
 		self.shutdown_workers = False
-		self.circuit_results_lock = threading.Lock()
 		self.worker_pool_lock = threading.Lock()
-		self.circuit_results = []
+		self.cq = CompletionQueue()
 		self.push_info = {}
+		self.publisher = None
+		self.completion_cb = None
+		self.ingest = ResultIngest()
 		self.module_util = None
 		self.worker_pool = []
 		self.worker_pool_rr = 0
 		self.num_workers = num_workers
 		self.num_worker_tasks = num_worker_tasks
-		self.num_cores = psutil.cpu_count(logical=False)
-		logging.debug(f'num_cores = {self.num_cores} start = {start}')
+		logging.debug(f'topology = {get_topology().get()} start = {start}')
+		self.runner_pool = None
+		self.handoff_lock = threading.Lock()
+		self.handoff_metrics = {'file': 0, 'shm': 0, 'pipe': 0, 'pool': 0,
+								'files_avoided': 0, 'bytes_in_memory': 0}
 		if start:
 			self.launcher = svc_launcher.Launcher()
+			if POOL_ENABLED:
+				self.start_runner_pool()
 			for x in range(0, self.num_workers):
 				with self.worker_pool_lock:
 					runner = threading.Thread(target=self.runner, args=(x,))
 					logging.debug(f"inserting {x} in the worker pool")
 					self.worker_pool.append({'thread': runner,
-											 'active_tasks': [],
+											 'active_tasks': {},
 											 'queue': queue.Queue(),
 											 'state': UTIL_QRC.THREAD_STATE_FREE})
 					runner.daemon = True
 					runner.start()
 
+	def start_runner_pool(self):
+		backend = POOL_BACKEND if POOL_BACKEND else self.POOL_BACKEND
+		if not backend:
+			logging.critical(f"{type(self).__name__} has no runner pool backend. " \
+							 "Running circuits with one shot launches")
+			return
+		pool_size = POOL_SIZE if POOL_SIZE else self.num_workers
+		try:
+			self.runner_pool = RunnerPool(backend, pool_size)
+		except Exception as e:
+			logging.critical(f"Failed to start the runner pool: {e}. " \
+							 "Falling back to one shot launches")
+
+	def get_pool_stats(self):
+		if not self.runner_pool:
+			return {'enabled': False}
+		return dict(self.runner_pool.get_stats(), enabled=True,
+					available=self.runner_pool.available())
+
 	def __del__(self):
 		print_thread_stack_trace_to_logger(level='debug')
 		self.shutdown_workers = True
@@ -50,104 +137,127 @@ class UTIL_QRC:
 				v['queue'].put(None)
 
 	def check_active_tasks(self, wid):
-		complete = []
-		for task_info in self.worker_pool[wid]['active_tasks']:
-			try:
-				#stdout, stderr, rc = task_info['launcher'].status(task_info['pid'])
-				stdout, stderr, rc = self.launcher.status(task_info['pid'])
-			except DEFwInProgress:
-				continue
-			except Exception as e:
-				raise e
-
-			# at this point, it already has a return code!
-			complete.append(task_info)
+		active_tasks = self.worker_pool[wid]['active_tasks']
+		if not active_tasks:
+			return
+
+		completed = self.launcher.poll_completed(active_tasks)
+		if self.runner_pool:
+			completed.update(self.runner_pool.poll_completed(active_tasks))
+		for pid, res in completed.items():
+			task_info = active_tasks.pop(pid)
+			stdout, stderr, rc = res
+			self.complete_task(task_info, stdout, stderr, rc)
+
+	def read_output(self, task_info, stdout):
+		return self.parse_result(stdout)
+
+	def complete_task(self, task_info, stdout, stderr, rc):
+		# reading and parsing the result is left to the ingest threads so
+		# the runner can go back to launching and reaping
+		if rc == 0 and not task_info.get('pooled'):
+			self.ingest.submit(self.ingest_task, task_info, stdout, stderr, rc)
+		else:
+			self.ingest_task(task_info, stdout, stderr, rc)
 
-			circ = task_info['circ']
-			cid = circ.get_cid()
-			qasm_file = task_info['qasm_file']
+	def get_ingest_metrics(self):
+		return self.ingest.get_metrics()
 
-			if rc == 0:
-				try:
-					output = self.parse_result(stdout)
-					circ.set_exec_done()
-				except Exception as e:
-					logging.critical(f"parse result failure = {e}")
-					output = "{result: missing, exception: "+ f"{e}" + "}"
-					circ.set_fail()
-			else:
-				stdout = stdout.decode('utf-8')
-				stderr = stderr.decode('utf-8')
-				res = stdout + '\n' + stderr
-				output = "{result: "+ f"{res}" + "}"
-				circ.set_fail()
+	def ingest_task(self, task_info, stdout, stderr, rc):
+		# at this point, it already has a return code!
+		circ = task_info['circ']
 
+		if rc == 0:
 			try:
-				os.remove(qasm_file)
-			except:
-				pass
-
-			r = {'cid': cid,
-				 'result': output,
-				 'rc': rc,
-				 'launch_time': circ.launch_time,
-				 'creation_time': circ.creation_time,
-				 'exec_time': circ.exec_time,
-				 'completion_time': circ.completion_time,
-				 'resources_consumed_time': circ.resources_consumed_time,
-				 'cq_enqueue_time': time.time(),
-				 'cq_dequeue_time': -1 }
-
-			circ.free_resources(circ)
-
-			# push the result if push info were registered:
-			if self.push_info:
-				event = Event(self.push_info['evtype'], r)
-				try:
-					self.push_info['class'].put(event)
-				except Exception as e:
-					logging.critical(f"Failed to push event to client. Exception encountered {e}")
-					raise e
-			else:
-				with self.circuit_results_lock:
-					self.circuit_results.append(r)
-
-		for task_info in complete:
-			self.worker_pool[wid]['active_tasks'].remove(task_info)
+				# pooled runners hand back the parsed result
+				if task_info.get('pooled'):
+					output = stdout
+				else:
+					output = self.ingest.timed(self.read_output, task_info, stdout)
+				circ.set_exec_done()
+			except Exception as e:
+				logging.critical(f"parse result failure = {e}")
+				output = "{result: missing, exception: "+ f"{e}" + "}"
+				circ.set_fail()
+		else:
+			stdout = stdout.decode('utf-8') if stdout else ''
+			stderr = stderr.decode('utf-8')
+			res = stdout + '\n' + stderr
+			output = "{result: "+ f"{res}" + "}"
+			circ.set_fail()
+
+		self.release_input(task_info)
+
+		self.complete_circuit(circ, output, rc)
+
+	def complete_circuit(self, circ, output, rc):
+		r = {'cid': circ.get_cid(),
+			 'result': output,
+			 'rc': rc,
+			 'launch_time': circ.launch_time,
+			 'creation_time': circ.creation_time,
+			 'exec_time': circ.exec_time,
+			 'completion_time': circ.completion_time,
+			 'resources_consumed_time': circ.resources_consumed_time,
+			 'cq_enqueue_time': time.time(),
+			 'cq_dequeue_time': -1 }
+
+		circ.free_resources(circ)
+
+		# the completion callback can take over the result
+		if self.completion_cb and self.completion_cb(circ, r):
+			return
+
+		self.post_result(r)
+
+	def post_result(self, r):
+		# push the result if push info were registered. The publisher
+		# sends it from its own thread, coalesced with other completions
+		if self.push_info:
+			self.publisher.put(Event(self.push_info['evtype'], r))
+		else:
+			self.cq.put(r)
+
+	def requeue_events(self, events):
+		# results which couldn't be pushed can still be read from the CQ
+		for ev in events:
+			self.cq.put(ev.get_event())
+
+	def get_publisher_stats(self):
+		publisher = self.publisher
+		if not publisher:
+			return {}
+		return publisher.get_stats()
+
+	def register_completion_cb(self, cb):
+		"""
+		cb(circ, r) is called for every completed circuit before its
+		result r is posted. If it returns True the result isn't posted.
+		"""
+		self.completion_cb = cb
 
 	def runner(self, my_id):
 		# get the next available entry on the queue
 		# if one is available run it
 		# check on currently running tasks to see if any of them complete
 		# Add completed tasks to the results dictionary
-		super_affinity = os.sched_getaffinity(0)
 		with self.worker_pool_lock:
 			my_queue = self.worker_pool[my_id]['queue']
-			# bind to core
-			# We can enhance this more to avoid core 0 in every l3 cache
-			bound_core = (my_id + 1) % self.num_cores
-			if not bound_core in super_affinity:
-				tmp = bound_core + 1
-				while tmp != bound_core:
-					if tmp in super_affinity:
-						bound_core = tmp
-						break
-					tmp  = (tmp + 1) % len(super_affinity)
-			try:
-				logging.debug(f'binding {threading.get_ident()} to ' \
-							  f'{bound_core} from  {os.sched_getaffinity(0)}')
-				os.sched_setaffinity(0, {bound_core})
-			except Exception as e:
-				logging.critical(f'Failed to bind {threading.get_ident()} to {bound_core}')
-				raise e
+		# placed according to DEFW_CPU_BIND_POLICY
+		bind_thread('runner', my_id)
+
+		def notify_complete(pid):
+			my_queue.put(UTIL_QRC.TASK_COMPLETE)
 
 		while not self.shutdown_workers:
 			empty = False
 			try:
-				circ = my_queue.get(timeout = 0.001) # sleep
+				circ = my_queue.get(timeout = UTIL_QRC.RUNNER_WAKEUP)
 				if circ == None:
 					self.shutdown_workers = True
 					continue
+				if circ is UTIL_QRC.TASK_COMPLETE:
+					empty = True
 			except queue.Empty:
 				empty = True
 
@@ -157,7 +267,7 @@ class UTIL_QRC:
 				result = None
 				pid = -1
 				try:
-					task_info = self.run_circuit_async(circ)
+					task_info = self.run_circuit_async(circ, completion_cb=notify_complete)
 				except Exception as e:
 					result = e
 					rc = -1
@@ -168,110 +278,176 @@ class UTIL_QRC:
 						self.worker_pool[my_id]['state'] = UTIL_QRC.THREAD_STATE_FREE
 
 				if result:
-					r = {'cid': circ.get_cid(),
-						'result': result,
-						'rc': rc,
-						'launch_time': circ.launch_time,
-						'creation_time': circ.creation_time,
-						'exec_time': circ.exec_time,
-						'completion_time': circ.completion_time,
-						'resources_consumed_time': circ.resources_consumed_time,
-						'cq_enqueue_time': time.time(),
-						'cq_dequeue_time': -1}
-					with self.circuit_results_lock:
-						self.circuit_results.append(r)
-						circ.free_resources(circ)
+					self.complete_circuit(circ, result, rc)
 				else:
-					self.worker_pool[my_id]['active_tasks'].append(task_info)
+					self.worker_pool[my_id]['active_tasks'][task_info['pid']] = task_info
 
 	def read_cq(self, cid=None):
-		if cid:
-			with self.circuit_results_lock:
-				i = 0
-				for e in self.circuit_results:
-					if cid == e['cid']:
-						r = self.circuit_results.pop(i)
-						r['cq_dequeue_time'] = time.time()
-						return r
-					i += 1
-		else:
-			with self.circuit_results_lock:
-				if len(self.circuit_results) > 0:
-					r = self.circuit_results.pop(0)
-					r['cq_dequeue_time'] = time.time()
-					return r
-		return None
+		return self.cq.read(cid)
 
 	def peak_cq(self, cid=None):
-		if cid:
-			with self.circuit_results_lock:
-				i = 0
-				for e in self.circuit_results:
-					if cid == e['cid']:
-						return e
-					i += 1
+		return self.cq.peek(cid)
+
+	def wait_cq(self, cid=None, timeout=None):
+		return self.cq.wait(cid, timeout=timeout)
+
+	def read_cq_many(self, max_n, timeout=0):
+		return self.cq.read_many(max_n, timeout=timeout)
+
+	def read_cq_batch(self, cids, timeout=0):
+		return self.cq.read_batch(cids, timeout=timeout)
+
+	def is_local_circuit(self, circ):
+		local = [socket.gethostname(), socket.gethostname().split('.')[0],
+				 'localhost']
+		for host in circ.info.get('hosts', {}).keys():
+			if host not in local:
+				return False
+		return True
+
+	def select_handoff(self, circ):
+		def usable(mode):
+			if mode == 'pipe':
+				# only rank 0 gets the launcher's stdin
+				return circ.info.get('np', 1) == 1
+			if mode == 'shm':
+				return os.path.isdir(os.path.dirname(SHM_DIR)) and \
+					   self.is_local_circuit(circ)
+			return mode == 'file'
+
+		if HANDOFF_MODE != 'auto':
+			if HANDOFF_MODE in self.HANDOFF_MODES and usable(HANDOFF_MODE):
+				return HANDOFF_MODE
+			return 'file'
+		for mode in self.HANDOFF_MODES:
+			if usable(mode):
+				return mode
+		return 'file'
+
+	def count_handoff(self, mode, nbytes):
+		with self.handoff_lock:
+			self.handoff_metrics[mode] += 1
+			if mode != 'file':
+				# the QASM file and whatever the runner writes next to it
+				self.handoff_metrics['files_avoided'] += 1 + len(self.RESULT_SUFFIXES)
+				if mode != 'shm':
+					self.handoff_metrics['bytes_in_memory'] += nbytes
+
+	def get_handoff_metrics(self):
+		with self.handoff_lock:
+			return dict(self.handoff_metrics)
+
+	def prepare_input(self, circ):
+		"""
+		Hand the circuit's QASM to the runner. Returns the task_info
+		describing the hand-off. task_info['qasm_file'] is the path to
+		give the runner.
+		"""
+		cid = circ.get_cid()
+		qasm_c = circ.info["qasm"]
+		mode = self.select_handoff(circ)
+		task_info = {'circ': circ, 'handoff': mode}
+
+		if mode == 'pipe':
+			task_info['qasm_file'] = '/dev/stdin'
+			task_info['stdin_data'] = qasm_c.encode('utf-8')
 		else:
-			with self.circuit_results_lock:
-				if len(self.circuit_results) > 0:
-					return self.circuit_results[0]
-		return None
+			if mode == 'shm':
+				os.makedirs(SHM_DIR, mode=0o700, exist_ok=True)
+				tmp_dir = SHM_DIR
+			else:
+				tmp_dir = cdefw_global.get_defw_tmp_dir()
+			qasm_file = os.path.join(tmp_dir, str(cid)+".qasm")
+			with open(qasm_file, 'w') as f:
+				f.write(qasm_c)
+			task_info['qasm_file'] = qasm_file
 
-	def run_circuit_async(self, circ):
-		cid = circ.get_cid()
+		self.count_handoff(mode, len(qasm_c))
+		return task_info
+
+	def release_input(self, task_info):
+		"""
+		Remove the QASM file and whatever result files the runner left
+		next to it, whether the circuit succeeded or not.
+		"""
+		if task_info.get('handoff') not in ['file', 'shm']:
+			return
+		qasm_file = task_info['qasm_file']
+		for path in [qasm_file] + [qasm_file + s for s in self.RESULT_SUFFIXES]:
+			try:
+				os.remove(path)
+			except:
+				pass
 
-		tmp_dir = cdefw_global.get_defw_tmp_dir()
+	def run_circuit_async(self, circ, completion_cb=None):
+		cid = circ.get_cid()
 
-		qasm_c = circ.info["qasm"]
-		qasm_file = os.path.join(tmp_dir, str(cid)+".qasm")
-		with open(qasm_file, 'w') as f:
-			f.write(qasm_c)
+		if self.can_use_pool(circ):
+			circ.set_launching()
+			try:
+				# The pool workers get the QASM as part of the circuit info
+				tid = self.runner_pool.submit(None, circ.info,
+											  completion_cb=completion_cb)
+				logging.debug(f"Running {cid} on the runner pool as {tid}")
+				circ.set_running()
+				self.count_handoff('pool', len(circ.info['qasm']))
+				return {'circ': circ, 'qasm_file': None, 'handoff': 'pool',
+						'pid': tid, 'pooled': True}
+			except DEFwError as e:
+				logging.debug(f"Runner pool can't take {cid}: {e}")
+
+		task_info = self.prepare_input(circ)
 
 		circ.set_launching()
-		cmd = self.form_cmd(circ, qasm_file)
 		try:
-			task_info = {}
-			pid = self.launcher.launch(cmd)
+			cmd = self.form_cmd(circ, task_info['qasm_file'])
+			pid = self.launcher.launch(cmd, completion_cb=completion_cb,
+									   stdin_data=task_info.pop('stdin_data', None))
 			logging.debug(f"Running -- {cmd} -- with pid {pid}")
 			circ.set_running()
 		except Exception as e:
-			os.remove(qasm_file)
-			logging.critical(f"Failed to launch {cmd}")
+			self.release_input(task_info)
+			logging.critical(f"Failed to launch {cid}")
 			raise e
 
-		task_info['circ'] = circ
-		task_info['qasm_file'] = qasm_file
 		task_info['pid'] = pid
 
 		return task_info
 
+	def can_use_pool(self, circ):
+		# The pool workers run locally, so only single process circuits
+		# which were given slots on this node can use them.
+		if not self.runner_pool or not self.runner_pool.available():
+			return False
+		if circ.info.get('np', 1) != 1:
+			return False
+		return self.is_local_circuit(circ)
+
 	def run_circuit(self, circ):
 		cid = circ.get_cid()
 
-		tmp_dir = cdefw_global.get_defw_tmp_dir()
-
-		qasm_c = circ.info["qasm"]
-		qasm_file = os.path.join(tmp_dir, str(cid)+".qasm")
-		with open(qasm_file, 'w') as f:
-			f.write(qasm_c)
+		task_info = self.prepare_input(circ)
 
 		circ.set_launching()
 		launcher = svc_launcher.Launcher()
 
-		cmd = self.form_cmd(circ, qasm_file)
 		try:
+			cmd = self.form_cmd(circ, task_info['qasm_file'])
 			logging.debug(f"Running -- {cmd}")
 			circ.set_running()
-			output, error, rc = launcher.launch(cmd, wait=True)
-			output = self.parse_result(output)
+			output, error, rc = launcher.launch(cmd, wait=True,
+									stdin_data=task_info.pop('stdin_data', None))
+			if rc == 0:
+				output = self.ingest.timed(self.read_output, task_info, output)
 			launcher.shutdown()
 			logging.debug(f"Completed -- {cmd} -- returned {rc} -- {output} -- {error}")
 		except Exception as e:
 			launcher.shutdown()
-			os.remove(qasm_file)
-			logging.critical(f"Failed to launch {cmd}")
+			self.release_input(task_info)
+			logging.critical(f"Failed to launch {cid}")
 			raise e
 
-		os.remove(qasm_file)
+		self.release_input(task_info)
 
 		if rc == 0:
 			circ.set_exec_done()
@@ -298,34 +474,63 @@ class UTIL_QRC:
 		return self.run_circuit(circ)
 
 	# Round robin over the workers so that they are all busy
-	def async_run(self, circ):
-		cid = circ.get_cid()
+	def queue_circuit_locked(self, circ):
 		rr = self.worker_pool_rr
 		self.worker_pool_rr += 1
 		idx = rr % self.num_workers
 		i = idx
+		while True:
+			worker = self.worker_pool[i]
+			if worker['state'] == UTIL_QRC.THREAD_STATE_FREE and \
+			   worker['queue'].qsize() < self.num_worker_tasks:
+					worker['queue'].put(circ)
+					if worker['queue'].qsize() >= self.num_worker_tasks:
+						worker['state'] = UTIL_QRC.THREAD_STATE_BUSY
+					return True
+			else:
+				i = (i + 1) % self.num_workers
+				if i == idx:
+					break
+		return False
+
+	def async_run(self, circ):
+		cid = circ.get_cid()
 		with self.worker_pool_lock:
-			while True:
-				worker = self.worker_pool[i]
-				if worker['state'] == UTIL_QRC.THREAD_STATE_FREE and \
-				   worker['queue'].qsize() < self.num_worker_tasks:
-						worker['queue'].put(circ)
-						if worker['queue'].qsize() >= self.num_worker_tasks:
-							worker['state'] = UTIL_QRC.THREAD_STATE_BUSY
-						return cid
-				else:
-					i = (i + 1) % self.num_workers
-					if i == idx:
-						break
+			if self.queue_circuit_locked(circ):
+				return cid
 		# if we get here then there is no more threads to handle this
 		# request. Raise an exception and the circuit will be queued
 		raise DEFwOutOfResources(f"No more resource to run {cid}")
 
+	def async_run_batch(self, circs):
+		"""
+		Queue circs on the runners in order. Returns the number of
+		circuits queued. The ones past that didn't fit.
+		"""
+		queued = 0
+		with self.worker_pool_lock:
+			for circ in circs:
+				if not self.queue_circuit_locked(circ):
+					break
+				queued += 1
+		return queued
+
 	def register_event_notification(self, info):
+		publisher = self.publisher
+		self.publisher = CompletionPublisher(info['class'],
+											 fallback=self.requeue_events)
 		self.push_info = info
+		if publisher:
+			publisher.close()
 
 	def shutdown(self):
 		logging.critical("shutdown called")
+		self.cq.close()
 		self.launcher.shutdown()
+		self.ingest.shutdown()
+		if self.runner_pool:
+			self.runner_pool.shutdown()
+		if self.publisher:
+			self.publisher.close()
 		self.shutdown_workers = True
 
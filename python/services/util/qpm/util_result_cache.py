@@ -0,0 +1,133 @@
+import logging, threading, hashlib, collections, json, os, re
+
+# Maximum number of cached results. 0 disables the cache. Cached results
+# are returned as is, so only enable it if re-using a previous sample
+# of the same circuit is acceptable.
+try:
+	CACHE_MAX_ENTRIES = int(os.environ['QFW_QPM_CACHE_MAX_ENTRIES'])
+except:
+	CACHE_MAX_ENTRIES = 0
+
+# Maximum size of the cached results in bytes
+try:
+	CACHE_MAX_BYTES = int(os.environ['QFW_QPM_CACHE_MAX_BYTES'])
+except:
+	CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# If set, the cache is persisted in that directory and reloaded on
+# startup
+try:
+	CACHE_DIR = os.environ['QFW_QPM_CACHE_DIR']
+except:
+	CACHE_DIR = None
+
+# Circuit info fields which change the result of the circuit
+CACHE_KEY_FIELDS = ['num_qubits', 'num_shots', 'qfw_backend', 'backend',
+					'method', 'compiler', 'seed']
+
+COMMENT_RE = re.compile(r'//[^\n]*')
+SPACE_RE = re.compile(r'[ \t\r]+')
+
+def normalize_qasm(qasm):
+	lines = []
+	for line in COMMENT_RE.sub('', qasm).split('\n'):
+		line = SPACE_RE.sub(' ', line).strip()
+		if line:
+			lines.append(line)
+	return '\n'.join(lines)
+
+def cache_key(info):
+	h = hashlib.sha256(normalize_qasm(info['qasm']).encode('utf-8'))
+	params = {k: info[k] for k in CACHE_KEY_FIELDS if k in info}
+	h.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+	return h.hexdigest()
+
+class ResultCache:
+	"""
+	LRU cache of circuit results keyed by cache_key(). Bounded both in
+	number of entries and in bytes.
+	"""
+	def __init__(self, max_entries=CACHE_MAX_ENTRIES,
+				 max_bytes=CACHE_MAX_BYTES, cache_dir=CACHE_DIR):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.cache_dir = cache_dir
+		self.lock = threading.Lock()
+		# key: (result, size)
+		self.entries = collections.OrderedDict()
+		self.bytes = 0
+		self.stats = {'hits': 0, 'misses': 0, 'insertions': 0, 'evictions': 0}
+		if self.enabled() and self.cache_dir:
+			os.makedirs(self.cache_dir, exist_ok=True)
+			self.load()
+
+	def enabled(self):
+		return self.max_entries > 0 and self.max_bytes > 0
+
+	def __path(self, key):
+		return os.path.join(self.cache_dir, key + '.json')
+
+	def load(self):
+		files = [f for f in os.listdir(self.cache_dir) if f.endswith('.json')]
+		files.sort(key=lambda f: os.path.getmtime(os.path.join(self.cache_dir, f)))
+		with self.lock:
+			for f in files:
+				try:
+					with open(os.path.join(self.cache_dir, f), 'r') as fh:
+						data = fh.read()
+					self.__insert_locked(f[:-len('.json')], json.loads(data),
+										 len(data), persist=False)
+				except Exception as e:
+					logging.critical(f"Failed to load cached result {f}: {e}")
+		logging.debug(f"Loaded {len(self.entries)} cached results")
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.stats['misses'] += 1
+				return None
+			self.entries.move_to_end(key)
+			self.stats['hits'] += 1
+			return entry[0]
+
+	def __evict_locked(self):
+		while self.entries and (len(self.entries) > self.max_entries or
+								self.bytes > self.max_bytes):
+			key, (result, size) = self.entries.popitem(last=False)
+			self.bytes -= size
+			self.stats['evictions'] += 1
+			if self.cache_dir:
+				try:
+					os.remove(self.__path(key))
+				except:
+					pass
+
+	def __insert_locked(self, key, result, size, persist=True, data=None):
+		if key in self.entries:
+			self.bytes -= self.entries.pop(key)[1]
+		self.entries[key] = (result, size)
+		self.bytes += size
+		self.stats['insertions'] += 1
+		if persist and self.cache_dir:
+			with open(self.__path(key), 'w') as f:
+				f.write(data)
+		self.__evict_locked()
+
+	def put(self, key, result):
+		try:
+			data = json.dumps(result, default=str)
+		except Exception as e:
+			logging.debug(f"Result can't be cached: {e}")
+			return
+		if len(data) > self.max_bytes:
+			return
+		with self.lock:
+			self.__insert_locked(key, result, len(data), data=data)
+
+	def get_stats(self):
+		with self.lock:
+			stats = dict(self.stats)
+			stats['entries'] = len(self.entries)
+			stats['bytes'] = self.bytes
+			return stats
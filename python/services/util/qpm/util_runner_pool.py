@@ -0,0 +1,380 @@
+from defw_exception import DEFwError, DEFwOutOfResources
+import logging, threading, subprocess, selectors, collections, time, os, sys
+import shutil, signal
+from .util_runner_worker import encode_frame, decode_frames, \
+								OP_RUN, OP_PING, OP_EXIT
+
+WORKER_SCRIPT = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+							 'util_runner_worker.py')
+
+# Recycle a worker after it ran that many circuits
+try:
+	POOL_MAX_JOBS = int(os.environ['QFW_QRC_POOL_MAX_JOBS'])
+except:
+	POOL_MAX_JOBS = 1000
+
+# Recycle a worker once its resident memory goes over that many MB
+try:
+	POOL_MAX_RSS_MB = int(os.environ['QFW_QRC_POOL_MAX_RSS_MB'])
+except:
+	POOL_MAX_RSS_MB = 4096
+
+# Idle workers are pinged every interval. A worker which doesn't answer
+# within the same interval is killed and replaced.
+try:
+	POOL_HEALTH_INTERVAL = float(os.environ['QFW_QRC_POOL_HEALTH_INTERVAL'])
+except:
+	POOL_HEALTH_INTERVAL = 5.0
+
+# Seconds a circuit can run on a worker. A worker which goes over is
+# killed and replaced, and the circuit fails. 0 disables the timeout.
+try:
+	POOL_TASK_TIMEOUT = float(os.environ['QFW_QRC_POOL_TASK_TIMEOUT'])
+except:
+	POOL_TASK_TIMEOUT = 3600
+
+def get_pool_python():
+	try:
+		return os.environ['QFW_QRC_POOL_PYTHON']
+	except:
+		pass
+	# the daemon embeds python, in which case sys.executable isn't a
+	# python interpreter
+	if sys.executable and \
+	   os.path.basename(sys.executable).startswith('python'):
+		return sys.executable
+	return shutil.which('python3')
+
+class WorkerStates:
+	STARTING = 0
+	IDLE = 1
+	BUSY = 2
+	DEAD = 3
+
+class PoolWorker:
+	def __init__(self, wid, python, backend):
+		self.wid = wid
+		self.proc = subprocess.Popen([python, WORKER_SCRIPT, backend],
+									 stdin=subprocess.PIPE,
+									 stdout=subprocess.PIPE,
+									 start_new_session=True)
+		self.fd_in = self.proc.stdin.fileno()
+		self.fd_out = self.proc.stdout.fileno()
+		os.set_blocking(self.fd_out, False)
+		self.buf = bytearray()
+		self.state = WorkerStates.STARTING
+		self.task = None
+		self.task_start = None
+		self.jobs = 0
+		self.rss = -1
+		self.last_seen = time.monotonic()
+		self.ping_sent = None
+
+	def send(self, msg):
+		data = encode_frame(msg)
+		while data:
+			n = os.write(self.fd_in, data)
+			data = data[n:]
+
+	def close(self, kill=False):
+		self.state = WorkerStates.DEAD
+		if kill:
+			try:
+				os.killpg(self.proc.pid, signal.SIGKILL)
+			except:
+				pass
+		for f in [self.proc.stdin, self.proc.stdout]:
+			try:
+				f.close()
+			except:
+				pass
+
+class RunnerPool:
+	"""
+	Pool of long lived circuit runners. Each worker loads the backend
+	once and then runs circuits it receives over a pipe, which avoids
+	paying the process startup and simulator loading cost for every
+	circuit.
+
+	The interface mirrors the launcher: submit() returns a task id and
+	calls completion_cb(task_id) once the task completes, and
+	poll_completed() returns task_id: (result, error, rc) for the
+	completed tasks.
+	"""
+	def __init__(self, backend, size, max_jobs=POOL_MAX_JOBS,
+				 max_rss_mb=POOL_MAX_RSS_MB,
+				 health_interval=POOL_HEALTH_INTERVAL,
+				 task_timeout=POOL_TASK_TIMEOUT):
+		self.backend = backend
+		self.size = size
+		self.max_jobs = max_jobs
+		self.max_rss = max_rss_mb * 1024 * 1024
+		self.health_interval = health_interval
+		self.task_timeout = task_timeout
+		self.python = get_pool_python()
+		if not self.python:
+			raise DEFwError("Couldn't find a python interpreter for the runner pool")
+		self.__lock = threading.Lock()
+		self.__workers = {}
+		self.__next_wid = 0
+		self.__next_task = 0
+		self.__pending = collections.deque()
+		self.__completed = {}
+		self.__shutdown = False
+		self.__failed = False
+		self.__stats = {'jobs': 0, 'recycled': 0, 'restarts': 0, 'failed_starts': 0,
+						'timeouts': 0}
+		self.__selector = selectors.DefaultSelector()
+		self.__wakeup_r, self.__wakeup_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+		self.__selector.register(self.__wakeup_r, selectors.EVENT_READ, None)
+		with self.__lock:
+			for i in range(size):
+				self.__spawn_locked()
+		self.__io_thread = threading.Thread(target=self.io_thr, args=())
+		self.__io_thread.daemon = True
+		self.__io_thread.start()
+
+	def __spawn_locked(self):
+		wid = self.__next_wid
+		self.__next_wid += 1
+		worker = PoolWorker(wid, self.python, self.backend)
+		self.__workers[wid] = worker
+		self.__selector.register(worker.fd_out, selectors.EVENT_READ, worker)
+		logging.debug("runner pool started worker %d (pid %d)", wid, worker.proc.pid)
+		return worker
+
+	def __retire_locked(self, worker, kill=False):
+		try:
+			self.__selector.unregister(worker.fd_out)
+		except:
+			pass
+		del self.__workers[worker.wid]
+		if not kill:
+			try:
+				worker.send({'op': OP_EXIT})
+			except OSError:
+				kill = True
+		worker.close(kill=kill)
+		# the process exits on its own once it reads the exit request
+		# or its stdin is closed. Reap it in the background.
+		threading.Thread(target=worker.proc.wait, daemon=True).start()
+
+	def __dispatch_locked(self, worker, task):
+		worker.task = task
+		worker.task_start = time.monotonic()
+		worker.state = WorkerStates.BUSY
+		try:
+			worker.send({'op': OP_RUN, 'id': task['id'],
+						 'qasm_file': task['qasm_file'],
+						 'info': task['info']})
+		except OSError:
+			# The worker died under us. The io thread will see the EOF
+			# and fail the task
+			pass
+
+	def __schedule_locked(self):
+		for worker in self.__workers.values():
+			if not self.__pending:
+				break
+			if worker.state == WorkerStates.IDLE:
+				self.__dispatch_locked(worker, self.__pending.popleft())
+
+	def __complete_locked(self, task, result, error, rc, done):
+		self.__completed[task['id']] = (result, error, rc)
+		self.__stats['jobs'] += 1
+		if task['cb']:
+			done.append((task['cb'], task['id']))
+
+	def __fail_pending_locked(self, error, done):
+		while self.__pending:
+			self.__complete_locked(self.__pending.popleft(), None,
+								   error.encode('utf-8'), -1, done)
+
+	def __worker_died_locked(self, worker, done,
+							 error="runner worker died while running the circuit"):
+		logging.critical("runner pool worker %d (pid %d) died",
+						 worker.wid, worker.proc.pid)
+		started = worker.state != WorkerStates.STARTING
+		task = worker.task
+		self.__retire_locked(worker, kill=True)
+		if task:
+			self.__complete_locked(task, None, error.encode('utf-8'), -1, done)
+		if self.__shutdown:
+			return
+		if started:
+			self.__stats['restarts'] += 1
+			self.__spawn_locked()
+		elif not self.__workers:
+			# none of the workers could start. Don't keep on trying
+			self.__failed = True
+			self.__fail_pending_locked("runner pool failed to start", done)
+
+	def __handle_msg_locked(self, worker, msg, done):
+		op = msg.get('op')
+		worker.last_seen = time.monotonic()
+		worker.rss = msg.get('rss', worker.rss)
+		if op == 'ready':
+			if msg.get('rc', -1) != 0:
+				logging.critical("runner pool worker failed to start: %s",
+								 msg.get('error'))
+				self.__stats['failed_starts'] += 1
+				# The EOF which follows takes care of the cleanup
+				return
+			worker.state = WorkerStates.IDLE
+		elif op == OP_PING:
+			worker.ping_sent = None
+		elif op == OP_RUN:
+			task = worker.task
+			worker.task = None
+			worker.task_start = None
+			worker.jobs += 1
+			worker.state = WorkerStates.IDLE
+			if task and task['id'] == msg.get('id'):
+				error = msg.get('error', '').encode('utf-8')
+				self.__complete_locked(task, msg.get('result'), error,
+									   msg.get('rc', -1), done)
+			if worker.jobs >= self.max_jobs or \
+			   (self.max_rss > 0 and worker.rss > self.max_rss):
+				logging.debug("recycling runner pool worker %d after %d jobs, rss %d",
+							  worker.wid, worker.jobs, worker.rss)
+				self.__stats['recycled'] += 1
+				self.__retire_locked(worker)
+				if not self.__shutdown:
+					self.__spawn_locked()
+
+	def __check_health_locked(self, done):
+		now = time.monotonic()
+		for worker in list(self.__workers.values()):
+			if worker.state == WorkerStates.BUSY and self.task_timeout > 0 and \
+			   now - worker.task_start > self.task_timeout:
+				logging.critical("runner pool worker %d timed out running %s",
+								 worker.wid, worker.task['id'])
+				self.__stats['timeouts'] += 1
+				self.__worker_died_locked(worker, done,
+					f"circuit timed out after {self.task_timeout}s on the runner pool")
+				continue
+			if worker.state != WorkerStates.IDLE:
+				continue
+			if worker.ping_sent is not None:
+				if now - worker.ping_sent > self.health_interval:
+					logging.critical("runner pool worker %d is not responding",
+									 worker.wid)
+					self.__worker_died_locked(worker, done)
+			elif now - worker.last_seen > self.health_interval:
+				worker.ping_sent = now
+				try:
+					worker.send({'op': OP_PING})
+				except OSError:
+					self.__worker_died_locked(worker, done)
+
+	def io_thr(self):
+		while True:
+			interval = self.health_interval
+			if self.task_timeout > 0:
+				interval = min(interval, self.task_timeout)
+			events = self.__selector.select(timeout=interval / 2)
+			done = []
+			with self.__lock:
+				if self.__shutdown:
+					break
+				for key, mask in events:
+					worker = key.data
+					if worker is None:
+						try:
+							os.read(self.__wakeup_r, 4096)
+						except BlockingIOError:
+							pass
+						continue
+					if worker.state == WorkerStates.DEAD:
+						continue
+					try:
+						data = os.read(worker.fd_out, 65536)
+					except BlockingIOError:
+						continue
+					except OSError:
+						data = b''
+					if not data:
+						self.__worker_died_locked(worker, done)
+						continue
+					worker.buf += data
+					try:
+						msgs, used = decode_frames(worker.buf)
+					except Exception as e:
+						logging.critical("runner pool worker %d sent a bad frame: %s",
+										 worker.wid, e)
+						self.__worker_died_locked(worker, done)
+						continue
+					del worker.buf[:used]
+					for msg in msgs:
+						self.__handle_msg_locked(worker, msg, done)
+				self.__check_health_locked(done)
+				self.__schedule_locked()
+			for cb, tid in done:
+				try:
+					cb(tid)
+				except Exception as e:
+					logging.critical("runner pool completion callback failed: %s", e)
+
+		with self.__lock:
+			for worker in list(self.__workers.values()):
+				self.__retire_locked(worker)
+			self.__selector.close()
+			os.close(self.__wakeup_r)
+			os.close(self.__wakeup_w)
+
+	def available(self):
+		with self.__lock:
+			return not self.__shutdown and not self.__failed
+
+	def submit(self, qasm_file, info, completion_cb=None):
+		with self.__lock:
+			if self.__shutdown or self.__failed:
+				raise DEFwError("runner pool is not available")
+			idle = [w for w in self.__workers.values()
+					if w.state == WorkerStates.IDLE]
+			starting = [w for w in self.__workers.values()
+						if w.state == WorkerStates.STARTING]
+			# allow one queued circuit per slot on top of the workers
+			# still starting up. Past that the one shot launch is likely
+			# to start the circuit earlier.
+			if not idle and \
+			   len(self.__pending) >= self.size + len(starting):
+				raise DEFwOutOfResources("runner pool is full")
+			tid = f"pool:{self.__next_task}"
+			self.__next_task += 1
+			task = {'id': tid, 'qasm_file': qasm_file, 'info': info,
+					'cb': completion_cb}
+			if idle:
+				self.__dispatch_locked(idle[0], task)
+			else:
+				self.__pending.append(task)
+		return tid
+
+	def poll_completed(self, tids=None):
+		completed = {}
+		with self.__lock:
+			if tids is None:
+				completed = self.__completed
+				self.__completed = {}
+			else:
+				for tid in list(self.__completed.keys()):
+					if tid in tids:
+						completed[tid] = self.__completed.pop(tid)
+		return completed
+
+	def get_stats(self):
+		with self.__lock:
+			stats = dict(self.__stats)
+			stats['workers'] = {w.wid: {'pid': w.proc.pid, 'jobs': w.jobs,
+										'rss': w.rss, 'state': w.state}
+								for w in self.__workers.values()}
+			stats['pending'] = len(self.__pending)
+		return stats
+
+	def shutdown(self):
+		with self.__lock:
+			if self.__shutdown:
+				return
+			self.__shutdown = True
+			os.write(self.__wakeup_w, b"x")
+		self.__io_thread.join()
@@ -0,0 +1,140 @@
+"""
+Long lived circuit runner used by the QRC runner pool.
+
+The worker is started once per pool slot as:
+
+	python util_runner_worker.py <backend>
+
+where <backend> is either an importable module name or the path to a
+python file. The backend is loaded once and is expected to provide:
+
+	run(qasm_file, info)	run the circuit and return its result. The
+							result must be JSON serializable. qasm_file
+							is None when the QASM is handed over in
+							memory, in info['qasm'].
+	setup()					optional. Called once after loading.
+
+Requests and responses are exchanged over stdin/stdout as frames made of
+a 4 byte big endian length followed by a JSON document. Anything the
+backend prints to stdout is redirected to stderr so it can't corrupt
+the framing.
+
+This file is intentionally standalone (standard library only) since it
+runs outside of the DEFw process.
+"""
+
+import sys, os, json, struct, importlib, importlib.util, traceback
+
+FRAME_HEADER = struct.Struct('!I')
+
+OP_RUN = 'run'
+OP_PING = 'ping'
+OP_EXIT = 'exit'
+
+def encode_frame(msg):
+	data = json.dumps(msg, default=str).encode('utf-8')
+	return FRAME_HEADER.pack(len(data)) + data
+
+def decode_frames(buf):
+	"""
+	Decode all the complete frames at the start of buf. Returns the list
+	of decoded messages and the number of bytes consumed.
+	"""
+	msgs = []
+	off = 0
+	while len(buf) - off >= FRAME_HEADER.size:
+		size, = FRAME_HEADER.unpack_from(buf, off)
+		if len(buf) - off - FRAME_HEADER.size < size:
+			break
+		start = off + FRAME_HEADER.size
+		msgs.append(json.loads(bytes(buf[start:start+size]).decode('utf-8')))
+		off = start + size
+	return msgs, off
+
+def read_exact(f, size):
+	data = b''
+	while len(data) < size:
+		chunk = f.read(size - len(data))
+		if not chunk:
+			return None
+		data += chunk
+	return data
+
+def read_frame(f):
+	hdr = read_exact(f, FRAME_HEADER.size)
+	if not hdr:
+		return None
+	size, = FRAME_HEADER.unpack(hdr)
+	data = read_exact(f, size)
+	if data is None:
+		return None
+	return json.loads(data.decode('utf-8'))
+
+def get_rss():
+	try:
+		with open('/proc/self/statm', 'r') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except:
+		return -1
+
+def load_backend(name):
+	if name.endswith('.py'):
+		mod_name = os.path.splitext(os.path.basename(name))[0]
+		spec = importlib.util.spec_from_file_location(mod_name, name)
+		backend = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(backend)
+	else:
+		backend = importlib.import_module(name)
+	if hasattr(backend, 'setup'):
+		backend.setup()
+	return backend
+
+def handle(backend, req):
+	op = req.get('op')
+	rsp = {'id': req.get('id'), 'op': op}
+	if op == OP_RUN:
+		try:
+			rsp['result'] = backend.run(req['qasm_file'], req['info'])
+			rsp['rc'] = 0
+		except Exception as e:
+			rsp['rc'] = -1
+			rsp['error'] = f"{e}\n{traceback.format_exc()}"
+	rsp['rss'] = get_rss()
+	return rsp
+
+def main():
+	if len(sys.argv) != 2:
+		sys.stderr.write(f"usage: {sys.argv[0]} <backend>\n")
+		return 1
+
+	# keep the real stdout for the protocol and send everything else to
+	# stderr
+	proto_in = os.fdopen(os.dup(0), 'rb', buffering=0)
+	proto_out = os.fdopen(os.dup(1), 'wb', buffering=0)
+	os.dup2(2, 1)
+	devnull = os.open(os.devnull, os.O_RDONLY)
+	os.dup2(devnull, 0)
+	os.close(devnull)
+
+	try:
+		try:
+			backend = load_backend(sys.argv[1])
+		except Exception as e:
+			proto_out.write(encode_frame({'op': 'ready', 'rc': -1,
+				'error': f"failed to load {sys.argv[1]}: {e}"}))
+			return 1
+		proto_out.write(encode_frame({'op': 'ready', 'rc': 0,
+									  'pid': os.getpid(), 'rss': get_rss()}))
+
+		while True:
+			req = read_frame(proto_in)
+			if req is None or req.get('op') == OP_EXIT:
+				break
+			proto_out.write(encode_frame(handle(backend, req)))
+	except BrokenPipeError:
+		# the pool went away
+		pass
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
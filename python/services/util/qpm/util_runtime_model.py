@@ -0,0 +1,187 @@
+import logging, threading, math, os, yaml
+import cdefw_global
+from .util_scheduler import DEFAULT_RUNTIME
+
+# Where the runtime model is persisted. Defaults to a per QPM file in
+# the DEFw tmp directory. Set to 'none' to keep the model in memory only.
+try:
+	RUNTIME_MODEL_FILE = os.environ['QFW_QPM_RUNTIME_MODEL']
+except:
+	RUNTIME_MODEL_FILE = None
+
+# Completions a model needs before its predictions are used
+try:
+	RUNTIME_MODEL_MIN_SAMPLES = int(os.environ['QFW_QPM_RUNTIME_MODEL_MIN_SAMPLES'])
+except:
+	RUNTIME_MODEL_MIN_SAMPLES = 8
+
+# Weight kept by past samples on every update. Lower adapts faster.
+try:
+	RUNTIME_MODEL_FORGET = float(os.environ['QFW_QPM_RUNTIME_MODEL_FORGET'])
+except:
+	RUNTIME_MODEL_FORGET = 0.995
+
+# save the model every that many completions
+SAVE_EVERY = 32
+# initial covariance of the weights
+INITIAL_P = 100.0
+# z value of the 90th percentile
+P90_Z = 1.2816
+
+FEATURES = ['bias', 'num_qubits', 'log_depth', 'log_gates', 'log_shots', 'log_np']
+
+def circuit_features(info):
+	analysis = info.get('analysis', {})
+	return [1.0,
+			float(info.get('num_qubits', analysis.get('num_qubits', 0))),
+			math.log2(analysis.get('depth', 0) + 1),
+			math.log2(analysis.get('num_gates', 0) + 1),
+			math.log2(info.get('num_shots', 0) + 1),
+			math.log2(max(info.get('np', 1), 1))]
+
+def model_key(info):
+	# simulator options which change the runtime of the same circuit
+	key = f"{info.get('backend', '')}/{info.get('method', '')}"
+	return 'default' if key == '/' else key
+
+class LinearModel:
+	"""
+	Recursive least squares fit of log2(runtime) over the circuit
+	features, with exponential forgetting so it follows changes in the
+	system.
+	"""
+	def __init__(self, state=None):
+		n = len(FEATURES)
+		self.w = [0.0] * n
+		self.P = [[INITIAL_P if i == j else 0.0 for j in range(n)]
+				  for i in range(n)]
+		self.samples = 0
+		# running mean of log2(runtime) and of the squared residual
+		self.mean = 0.0
+		self.var = 1.0
+		self.lo = math.inf
+		self.hi = -math.inf
+		if state:
+			self.__dict__.update(state)
+
+	def predict(self, x):
+		y = sum(wi * xi for wi, xi in zip(self.w, x))
+		# don't extrapolate far from what has been seen
+		return min(max(y, self.lo - 2), self.hi + 2)
+
+	def update(self, x, y, forget):
+		if self.samples:
+			err = y - self.predict(x)
+			self.var = forget * self.var + (1 - forget) * err * err
+		n = len(x)
+		Px = [sum(self.P[i][j] * x[j] for j in range(n)) for i in range(n)]
+		denom = forget + sum(x[i] * Px[i] for i in range(n))
+		k = [p / denom for p in Px]
+		err = y - sum(wi * xi for wi, xi in zip(self.w, x))
+		self.w = [wi + ki * err for wi, ki in zip(self.w, k)]
+		self.P = [[(self.P[i][j] - k[i] * Px[j]) / forget for j in range(n)]
+				  for i in range(n)]
+		self.samples += 1
+		self.mean += (y - self.mean) / self.samples
+		self.lo = min(self.lo, y)
+		self.hi = max(self.hi, y)
+
+	def state(self):
+		return {'w': self.w, 'P': self.P, 'samples': self.samples,
+				'mean': self.mean, 'var': self.var,
+				'lo': self.lo, 'hi': self.hi}
+
+class RuntimeModel:
+	"""
+	Learns circuit runtimes from completions, one LinearModel per
+	simulator configuration, and predicts the runtime of new circuits.
+	"""
+	def __init__(self, path=None, min_samples=RUNTIME_MODEL_MIN_SAMPLES,
+				 forget=RUNTIME_MODEL_FORGET):
+		self.path = path
+		self.min_samples = min_samples
+		self.forget = forget
+		self.lock = threading.Lock()
+		self.models = {}
+		self.unsaved = 0
+		if self.path:
+			self.load()
+
+	def load(self):
+		if not os.path.exists(self.path):
+			return
+		try:
+			with open(self.path, 'r') as f:
+				state = yaml.safe_load(f) or {}
+			with self.lock:
+				for key, s in state.items():
+					self.models[key] = LinearModel(s)
+			logging.debug(f"Loaded runtime models {list(self.models.keys())} from {self.path}")
+		except Exception as e:
+			logging.critical(f"Failed to load the runtime model {self.path}: {e}")
+
+	def save(self):
+		if not self.path:
+			return
+		with self.lock:
+			state = {k: m.state() for k, m in self.models.items()}
+			self.unsaved = 0
+		tmp = self.path + '.tmp'
+		try:
+			with open(tmp, 'w') as f:
+				f.write(yaml.safe_dump(state))
+			os.replace(tmp, self.path)
+		except Exception as e:
+			logging.critical(f"Failed to save the runtime model {self.path}: {e}")
+
+	def observe(self, info, runtime):
+		if runtime <= 0:
+			return
+		key = model_key(info)
+		with self.lock:
+			if key not in self.models:
+				self.models[key] = LinearModel()
+			self.models[key].update(circuit_features(info), math.log2(runtime),
+									self.forget)
+			self.unsaved += 1
+			save = self.unsaved >= SAVE_EVERY
+		if save:
+			self.save()
+
+	def estimate(self, info):
+		"""
+		Estimated runtime of the circuit described by info in seconds,
+		with its 90th percentile and where the estimate comes from.
+		"""
+		if 'estimated_runtime' in info:
+			return {'runtime': info['estimated_runtime'], 'p90': info['estimated_runtime'],
+					'source': 'client', 'samples': 0}
+		with self.lock:
+			model = self.models.get(model_key(info))
+			if not model or not model.samples:
+				return {'runtime': DEFAULT_RUNTIME, 'p90': DEFAULT_RUNTIME,
+						'source': 'default', 'samples': 0}
+			if model.samples < self.min_samples:
+				y = model.mean
+				source = 'mean'
+			else:
+				y = model.predict(circuit_features(info))
+				source = 'model'
+			sigma = math.sqrt(model.var)
+			return {'runtime': 2 ** y, 'p90': 2 ** (y + P90_Z * sigma),
+					'source': source, 'samples': model.samples}
+
+	def get_stats(self):
+		with self.lock:
+			return {k: {'samples': m.samples,
+						'rms_log2_error': math.sqrt(m.var),
+						'weights': dict(zip(FEATURES, m.w))}
+					for k, m in self.models.items()}
+
+def default_model_path(name):
+	if RUNTIME_MODEL_FILE:
+		if RUNTIME_MODEL_FILE.lower() == 'none':
+			return None
+		return RUNTIME_MODEL_FILE
+	return os.path.join(cdefw_global.get_defw_tmp_dir(),
+						f'qpm_runtime_model_{name}.yaml')
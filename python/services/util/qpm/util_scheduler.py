@@ -0,0 +1,293 @@
+from defw_exception import DEFwOutOfResources, DEFwNotFound
+import logging, threading, time, os, math
+
+# Runtime assumed for circuits when no better estimate is available
+try:
+	DEFAULT_RUNTIME = float(os.environ['QFW_QPM_DEFAULT_RUNTIME'])
+except:
+	DEFAULT_RUNTIME = 60.0
+
+# Relative share of the resources each client is entitled to. Clients
+# are named by their endpoint name or id, and 'local' for requests which
+# don't come over RPC. Clients not listed get a share of 1. The format
+# is:
+#	client1=2,client2=1
+try:
+	CLIENT_SHARES = os.environ['QFW_QPM_CLIENT_SHARES']
+except:
+	CLIENT_SHARES = ''
+
+# Comma separated clients, named as in QFW_QPM_CLIENT_SHARES, allowed to
+# set the priority of their circuits. Local requests always can.
+try:
+	PRIORITY_CLIENTS = [c.strip() for c in
+						os.environ['QFW_QPM_PRIORITY_CLIENTS'].split(',') if c.strip()]
+except:
+	PRIORITY_CLIENTS = []
+
+# Half-life in seconds of the usage accounted to each client
+try:
+	FAIRSHARE_HALFLIFE = float(os.environ['QFW_QPM_FAIRSHARE_HALFLIFE'])
+except:
+	FAIRSHARE_HALFLIFE = 3600.0
+
+def parse_client_shares(spec):
+	shares = {}
+	for entry in spec.split(','):
+		if not entry.strip():
+			continue
+		client, sep, share = entry.partition('=')
+		shares[client.strip()] = float(share) if sep else 1.0
+	return shares
+
+def can_set_priority(client, name):
+	return client == 'local' or client in PRIORITY_CLIENTS or \
+		   name in PRIORITY_CLIENTS
+
+def default_estimator(info):
+	return info.get('estimated_runtime', DEFAULT_RUNTIME)
+
+class QueuedJob:
+	def __init__(self, cid, info, estimate, seq):
+		self.cid = cid
+		self.np = info['np']
+		self.priority = info.get('priority', 0)
+		# set by the QPM from the endpoint making the request
+		self.client = info.get('client', 'local')
+		self.client_name = info.get('client_name', self.client)
+		self.estimate = estimate
+		self.submit_time = time.time()
+		self.seq = seq
+		self.start_time = -1
+
+class Scheduler:
+	"""
+	Orders the circuits waiting for resources. Circuits are ordered by
+	priority, then by the fair-share usage of their client, then in
+	submission order.
+
+	If the first circuit doesn't fit, it gets a reservation at the
+	earliest time the running circuits are estimated to free enough
+	slots, and circuits behind it are started (backfilled) only if they
+	don't delay that reservation (EASY backfilling).
+	"""
+	def __init__(self, total_slots, estimator=default_estimator,
+				 shares=None, halflife=FAIRSHARE_HALFLIFE):
+		self.total_slots = total_slots
+		self.estimator = estimator
+		if shares is None:
+			shares = parse_client_shares(CLIENT_SHARES)
+		self.shares = shares
+		self.halflife = halflife
+		self.lock = threading.RLock()
+		self.queued = {}
+		# picked by schedule() and being started
+		self.starting = {}
+		self.running = {}
+		self.usage = {}
+		self.usage_time = time.time()
+		self.seq = 0
+		self.stats = {'started': 0, 'backfilled': 0}
+
+	def __len__(self):
+		with self.lock:
+			return len(self.queued) + len(self.starting)
+
+	def __decay_usage_locked(self, now):
+		elapsed = now - self.usage_time
+		if elapsed <= 0 or not self.halflife:
+			return
+		factor = math.pow(0.5, elapsed / self.halflife)
+		for client in self.usage:
+			self.usage[client] *= factor
+		self.usage_time = now
+
+	def __share_usage_locked(self, job):
+		share = self.shares.get(job.client, self.shares.get(job.client_name, 1.0))
+		return self.usage.get(job.client, 0) / share
+
+	def __ordered_locked(self):
+		return sorted(self.queued.values(),
+					  key=lambda j: (-j.priority,
+									 self.__share_usage_locked(j),
+									 j.seq))
+
+	def __make_job_locked(self, cid, info):
+		self.seq += 1
+		try:
+			estimate = self.estimator(info)
+		except Exception as e:
+			logging.debug(f"runtime estimate failed for {cid}: {e}")
+			estimate = DEFAULT_RUNTIME
+		return QueuedJob(cid, info, estimate, self.seq)
+
+	def put(self, cid, info):
+		with self.lock:
+			self.queued[cid] = self.__make_job_locked(cid, info)
+
+	def remove(self, cid):
+		with self.lock:
+			self.queued.pop(cid, None)
+			self.starting.pop(cid, None)
+
+	def started(self, cid, info):
+		with self.lock:
+			job = self.starting.pop(cid, None)
+			if not job:
+				job = self.queued.pop(cid, None)
+			if not job:
+				job = self.__make_job_locked(cid, info)
+			job.start_time = time.time()
+			self.running[cid] = job
+			self.stats['started'] += 1
+
+	def finished(self, cid):
+		with self.lock:
+			job = self.running.pop(cid, None)
+			if not job:
+				return
+			now = time.time()
+			self.__decay_usage_locked(now)
+			self.usage[job.client] = self.usage.get(job.client, 0) + \
+									 job.np * (now - job.start_time)
+
+	def __release_profile_locked(self, now):
+		# (estimated end time, slots) of the running circuits
+		ends = []
+		for job in self.running.values():
+			ends.append((max(job.start_time + job.estimate, now), job.np))
+		ends.sort(key=lambda e: e[0])
+		return ends
+
+	def __shadow_locked(self, job, free, now):
+		"""
+		Earliest estimated time job can start and the slots left over at
+		that time.
+		"""
+		if free >= job.np:
+			return now, free - job.np
+		for end, np in self.__release_profile_locked(now):
+			free += np
+			if free >= job.np:
+				return end, free - job.np
+		# the estimates are off. Assume it's imminent
+		return now, 0
+
+	def schedule(self, start, free_slots):
+		"""
+		Start as many of the queued circuits as the policy allows.
+		start(cid) starts the circuit and raises DEFwOutOfResources if
+		it doesn't fit. free_slots() returns the number of free slots.
+		Circuits which fail to start for any other reason are dropped
+		from the queue and returned with their exception.
+
+		The circuits are picked under the lock and started once it's
+		released, so completions don't wait for the launches.
+		"""
+		picked = []
+		with self.lock:
+			now = time.time()
+			self.__decay_usage_locked(now)
+			free = free_slots()
+			shadow = None
+			extra = 0
+			for job in self.__ordered_locked():
+				if job.np > free:
+					if shadow is None:
+						shadow, extra = self.__shadow_locked(job, free, now)
+					continue
+				backfill = shadow is not None
+				if backfill and now + job.estimate > shadow:
+					# backfill only what doesn't delay the reservation
+					if job.np > extra:
+						continue
+					extra -= job.np
+				free -= job.np
+				del self.queued[job.cid]
+				self.starting[job.cid] = job
+				picked.append((job, backfill))
+
+		failed = []
+		for job, backfill in picked:
+			try:
+				start(job.cid)
+			except DEFwOutOfResources:
+				# the free slots are fragmented or were taken meanwhile.
+				# Back in the queue for the next pass.
+				with self.lock:
+					if self.starting.pop(job.cid, None):
+						self.queued[job.cid] = job
+				continue
+			except Exception as e:
+				logging.critical(f"Failed to start {job.cid}: {e}")
+				with self.lock:
+					self.starting.pop(job.cid, None)
+				failed.append((job.cid, e))
+				continue
+			if backfill:
+				with self.lock:
+					self.stats['backfilled'] += 1
+			self.started(job.cid, None)
+		return failed
+
+	def get_queue_info(self, cid=None):
+		"""
+		Position in the queue and estimated start time of cid, or of all
+		the queued circuits if cid is None. The estimate ignores
+		backfilling and assumes circuits start in queue order.
+		"""
+		with self.lock:
+			now = time.time()
+			if cid and cid in self.running:
+				job = self.running[cid]
+				return {'cid': cid, 'state': 'RUNNING',
+						'start_time': job.start_time,
+						'estimated_end': job.start_time + job.estimate}
+			if cid and cid not in self.queued:
+				raise DEFwNotFound(f"{cid} is not queued")
+
+			busy = sum(j.np for j in self.running.values())
+			events = self.__release_profile_locked(now)
+			infos = []
+			t = now
+			free = self.total_slots - busy
+			for pos, job in enumerate(self.__ordered_locked()):
+				# advance time until the job fits
+				while free < job.np and events:
+					end, np = events.pop(0)
+					t = max(t, end)
+					free += np
+				start = t
+				free -= job.np
+				events.append((start + job.estimate, job.np))
+				events.sort(key=lambda e: e[0])
+				info = {'cid': job.cid, 'state': 'QUEUED', 'position': pos,
+						'priority': job.priority, 'client': job.client,
+						'np': job.np, 'submit_time': job.submit_time,
+						'estimated_start': start}
+				if cid == job.cid:
+					return info
+				infos.append(info)
+			return infos
+
+	def get_load(self):
+		"""
+		Number of circuits queued and running, and the backlog: the
+		estimated seconds of work left per slot.
+		"""
+		with self.lock:
+			now = time.time()
+			work = sum(j.np * j.estimate for j in self.queued.values())
+			work += sum(j.np * max(j.start_time + j.estimate - now, 0)
+						for j in self.running.values())
+			return {'queued': len(self.queued),
+					'running': len(self.running),
+					'backlog': work / self.total_slots if self.total_slots else 0.0}
+
+	def get_stats(self):
+		with self.lock:
+			stats = dict(self.stats)
+			stats['queued'] = len(self.queued)
+			stats['running'] = len(self.running)
+			stats['usage'] = dict(self.usage)
+			return stats
@@ -0,0 +1,85 @@
+import hashlib, os
+
+# Smallest number of shots worth running as a separate shard. 0 disables
+# shot splitting.
+try:
+	SHOT_SPLIT_MIN = int(os.environ['QFW_QPM_SHOT_SPLIT_MIN'])
+except:
+	SHOT_SPLIT_MIN = 0
+
+# Most shards a circuit is split into
+try:
+	SHOT_SPLIT_MAX = int(os.environ['QFW_QPM_SHOT_SPLIT_MAX'])
+except:
+	SHOT_SPLIT_MAX = 8
+
+def plan_shards(num_shots, free_shards, min_shots=None, max_shards=None):
+	"""
+	Number of shards to split num_shots into when free_shards copies of
+	the circuit can run right now. 1 means don't split.
+	"""
+	if min_shots is None:
+		min_shots = SHOT_SPLIT_MIN
+	if max_shards is None:
+		max_shards = SHOT_SPLIT_MAX
+	if min_shots <= 0 or num_shots < 2 * min_shots:
+		return 1
+	return max(min(max_shards, num_shots // min_shots, free_shards), 1)
+
+def split_shots(num_shots, shards):
+	base, extra = divmod(num_shots, shards)
+	return [base + 1 if i < extra else base for i in range(shards)]
+
+def shard_seed(info, shard):
+	"""
+	Seed of a shard. Derived from the client's seed, or from the QASM
+	if there is none, so the same circuit always shards the same way.
+	"""
+	base = info.get('seed')
+	if base is None:
+		base = hashlib.sha256(info['qasm'].encode('utf-8')).hexdigest()
+	h = hashlib.sha256(f"{base}:{shard}".encode('utf-8'))
+	return int(h.hexdigest()[:8], 16)
+
+def is_histogram(r):
+	"""
+	A measurement histogram: a dictionary of counts.
+	"""
+	return isinstance(r, dict) and len(r) > 0 and \
+		   all(type(v) is int for v in r.values())
+
+def merge_histograms(results, shards):
+	"""
+	Merge the fields of the shard results. Histograms are added up and
+	other fields are taken from the first shard. Returns the merged
+	result and whether any histogram was merged.
+	"""
+	first = results[0]
+	if is_histogram(first):
+		if len(results) != shards or not all(is_histogram(r) for r in results):
+			raise ValueError("Measurement counts missing from a shard")
+		merged = {}
+		for r in results:
+			for k, v in r.items():
+				merged[k] = merged.get(k, 0) + v
+		return merged, True
+	if not isinstance(first, dict):
+		return first, False
+	merged = {}
+	found = False
+	for k in first.keys():
+		merged[k], f = merge_histograms(
+			[r[k] for r in results if isinstance(r, dict) and k in r], shards)
+		found = found or f
+	return merged, found
+
+def merge_counts(results):
+	"""
+	Merge the results of the shards. The measurement histograms are
+	added up and everything else, like timings, is taken from the first
+	shard. Raises ValueError if there are no counts to merge.
+	"""
+	merged, found = merge_histograms(results, len(results))
+	if not found:
+		raise ValueError("No measurement counts in the shard results")
+	return merged
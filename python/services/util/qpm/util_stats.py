@@ -0,0 +1,115 @@
+import threading, math, time
+
+# Relative accuracy of the quantiles reported
+QUANTILE_ACCURACY = 0.01
+# Most buckets a sketch keeps. The lowest ones are merged beyond that.
+MAX_BUCKETS = 2048
+QUANTILES = [0.5, 0.9, 0.99]
+
+class QuantileSketch:
+	"""
+	Log bucketed histogram. Each bucket covers values within a factor of
+	gamma of each other, so any quantile is reported within
+	QUANTILE_ACCURACY of its true value using bounded memory.
+	"""
+	def __init__(self, accuracy=QUANTILE_ACCURACY, max_buckets=MAX_BUCKETS):
+		self.gamma = (1 + accuracy) / (1 - accuracy)
+		self.log_gamma = math.log(self.gamma)
+		self.max_buckets = max_buckets
+		self.buckets = {}
+		self.zeros = 0
+		self.count = 0
+
+	def add(self, x):
+		self.count += 1
+		if x <= 0:
+			self.zeros += 1
+			return
+		i = math.ceil(math.log(x) / self.log_gamma)
+		self.buckets[i] = self.buckets.get(i, 0) + 1
+		if len(self.buckets) > self.max_buckets:
+			keys = sorted(self.buckets.keys())
+			self.buckets[keys[1]] += self.buckets.pop(keys[0])
+
+	def quantile(self, q):
+		if not self.count:
+			return None
+		rank = q * (self.count - 1)
+		seen = self.zeros
+		if rank < seen:
+			return 0.0
+		for i in sorted(self.buckets.keys()):
+			seen += self.buckets[i]
+			if rank < seen:
+				return 2 * self.gamma ** i / (self.gamma + 1)
+		return 2 * self.gamma ** max(self.buckets.keys()) / (self.gamma + 1)
+
+class RunningStats:
+	"""
+	Count, mean and variance (Welford), min, max and quantiles of a
+	stream of values.
+	"""
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.min = math.inf
+		self.max = -math.inf
+		self.sketch = QuantileSketch()
+
+	def add(self, x):
+		self.count += 1
+		delta = x - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (x - self.mean)
+		if x < self.min:
+			self.min = x
+		if x > self.max:
+			self.max = x
+		self.sketch.add(x)
+
+	def summary(self):
+		if not self.count:
+			return {'count': 0}
+		s = {'count': self.count,
+			 'mean': self.mean,
+			 'stdev': math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0,
+			 'min': self.min,
+			 'max': self.max}
+		for q in QUANTILES:
+			s[f'p{int(q * 100)}'] = self.sketch.quantile(q)
+		return s
+
+class LifecycleStats:
+	"""
+	RunningStats of the time circuits spend in each phase of their
+	lifecycle. Phases are created as values are recorded for them.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.phases = {}
+		self.start_time = time.time()
+
+	def record(self, phase, start, end):
+		# times which were never set are -1
+		if start <= 0 or end <= 0:
+			return
+		with self.lock:
+			if phase not in self.phases:
+				self.phases[phase] = RunningStats()
+			self.phases[phase].add(end - start)
+
+	def snapshot(self):
+		with self.lock:
+			stats = {'since': self.start_time,
+					 'phases': {p: s.summary() for p, s in self.phases.items()}}
+			return stats
+
+	def reset(self):
+		# returns the stats up to the reset
+		with self.lock:
+			stats = {'since': self.start_time,
+					 'phases': {p: s.summary() for p, s in self.phases.items()}}
+			self.phases = {}
+			self.start_time = time.time()
+			return stats
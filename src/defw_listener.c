@@ -1,3 +1,4 @@
+#define _GNU_SOURCE
 #include <assert.h>
 #include <stdio.h>
 #include <stdlib.h>
@@ -465,8 +466,10 @@ static defw_rc_t init_comm(struct sockaddr_in *listen_addr)
 
 	signal(SIGPIPE, SIG_IGN);
 
-	/*  Create a socket to listen to.  */
-	g_iListenFd = socket(AF_INET, SOCK_STREAM, 0);
+	/*  Create a socket to listen to. Processes launched by the
+	 *  services mustn't inherit it.
+	 */
+	g_iListenFd = socket(AF_INET, SOCK_STREAM | SOCK_CLOEXEC, 0);
 	if (g_iListenFd < 0) {
 		/*  Cannot create a listening socket.  */
 		return EN_DEFW_RC_SOCKET_FAIL;
@@ -667,9 +670,9 @@ static void *defw_listener_main(void *usr_data)
 		if (FD_ISSET(g_iListenFd, &tReadSet)) {
 			/* A new incoming connection */
 			tCliLen = sizeof(sCliAddr);
-			iConnFd = accept(g_iListenFd,
-					 (struct sockaddr *) &sCliAddr,
-					 &tCliLen);
+			iConnFd = accept4(g_iListenFd,
+					  (struct sockaddr *) &sCliAddr,
+					  &tCliLen, SOCK_CLOEXEC);
 			if (iConnFd < 0) {
 				/*  Cannot accept new connection... just ignore.
 				 */
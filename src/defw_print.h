@@ -46,7 +46,7 @@ static inline void defw_log_print(int loglevel, bool error, char *color1,
 	print = g_defw_cfg.out;
 	stat(g_defw_cfg.outlog, &st);
 	if (st.st_size > LARGE_LOG_FILE)
-		g_defw_cfg.out = freopen(g_defw_cfg.outlog, "w", g_defw_cfg.out);
+		g_defw_cfg.out = freopen(g_defw_cfg.outlog, "we", g_defw_cfg.out);
 
 print_err:
 	time(&debugnow);
@@ -252,7 +252,7 @@ defw_rc_t python_run_cmd_line(int argc, char *argv[], char *module, char *cmd)
 	} else if (cmd) {
 		RUN_PYTHON_CMD(cmd);
 	} else if (argc >= 1) {
-		f = fopen(argv[0], "r");
+		f = fopen(argv[0], "re");
 		if (!f)
 			return EN_DEFW_RC_PY_SCRIPT_FAIL;
 
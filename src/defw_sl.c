@@ -231,7 +231,7 @@ run_pure_python:
 		return EN_DEFW_RC_LOG_CREATION_FAILURE;
 	}
 	sprintf(g_defw_cfg.outlog, "%s/%s", g_defw_cfg.tmp_dir, OUT_LOG_NAME);
-	g_defw_cfg.out = fopen(g_defw_cfg.outlog, "w");
+	g_defw_cfg.out = fopen(g_defw_cfg.outlog, "we");
 	if (!g_defw_cfg.out) {
 		PERROR("Failed to open log files: %s\n",
 			g_defw_cfg.outlog);
@@ -86,7 +86,7 @@ int establishTCPConnection(unsigned long uiAddress,
 	defw_rc_t eRc = EN_DEFW_RC_OK;
 
 	/* Create TCP socket */
-	rsocket = socket(AF_INET, SOCK_STREAM, IPPROTO_TCP);
+	rsocket = socket(AF_INET, SOCK_STREAM | SOCK_CLOEXEC, IPPROTO_TCP);
 	if (rsocket == -1)
 		return EN_DEFW_RC_FAIL;
 